@@ -1,12 +1,13 @@
 import xml.etree.ElementTree as ElT
 import json
+from prefetch import open_file
 
 
-def load_aquareport(arfile, timefile=None):
-    ar = ElT.parse(open(arfile)).getroot()
+def load_aquareport(arfile, timefile=None, files=None):
+    ar = ElT.parse(open_file(arfile, files=files, mode='rb')).getroot()
     mous = {'TARGET': {}, 'FLUX': {}}
     get_projectinfo(ar, mous)
-    get_stageinfo(ar, mous, timefile=timefile)
+    get_stageinfo(ar, mous, timefile=timefile, files=files)
     get_sensitivityinfo(ar, mous)
     get_fluxinfo(ar, mous)
     return mous
@@ -22,13 +23,13 @@ def get_projectinfo(ar, mous):
     mous['pipeline_version'] = {'value': list(ar.iter('PipelineVersion'))[0].text}
 
 
-def get_stageinfo(ar, mous, timefile=None):
+def get_stageinfo(ar, mous, timefile=None, files=None):
     stageinfo = {}
     for c in list(ar.find('QaPerStage')):
         stageinfo[c.attrib['Number']] = {'stage_name': {'value': c.attrib['Name']},
                                          'qa_score': {'value': c.find('RepresentativeScore').attrib['Score']}}
     if timefile:
-        timeinfo = __get_timefile__(timefile)
+        timeinfo = __get_timefile__(timefile, files=files)
         for key in timeinfo['results']:
             if key not in stageinfo:
                 stageinfo[key] = {'stage_name': {'value': 'unknown'}, 'qa_score': {'value': 'None'}}
@@ -79,5 +80,5 @@ def get_fluxinfo(ar, mous):
             mous['FLUX'][atb['Field']]['SPW'][atb['MsSpwId']][atb['Asdm']]['fitted_value'] = atb['FluxJy']
 
 
-def __get_timefile__(timefile):
-    return json.load(open(timefile, 'r'))
+def __get_timefile__(timefile, files=None):
+    return json.load(open_file(timefile, files=files))
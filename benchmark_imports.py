@@ -0,0 +1,72 @@
+# benchmark of the import time of the (non-GUI) modules, to keep the startup of short command line jobs and worker
+# processes fast. Every module is imported in a fresh interpreter, and the heavy packages that a module pulls in at
+# import time (instead of on the code path that needs them) are reported.
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# tableview is not included, it is the Qt base class of the GUIs (like comparestatsgui and plstatsgui)
+modules = ['prefetch', 'aquareport', 'plstats', 'plstatslist', 'plstatscatalog', 'comparestats', 'suppl_stats',
+           'diffstats', 'timingstats', 'timingreport', 'tableengine', 'plstatscli']
+# packages that should only be imported when they are used
+heavy = ['matplotlib', 'astropy', 'casatools', 'pyarrow', 'pypdf', 'PyQt5', 'PyQt6', 'PySide2', 'PySide6']
+# heavy packages that a module needs anyway, e.g., timingreport draws the pages with matplotlib
+expected = {'timingreport': ['matplotlib']}
+
+__child__ = '''
+import json, sys, time
+start = time.perf_counter()
+import {0}
+print(json.dumps({{'time': time.perf_counter() - start,
+                  'heavy': sorted(x for x in {1} if x in sys.modules and x not in {2})}}))
+'''
+
+
+def benchmark_imports(names=None, repeat=5):
+    """
+    Import time of each module in a fresh interpreter.
+    :param names: list of modules, default are all non-GUI modules
+    :param repeat: number of imports of each module, the fastest one is reported
+    :return: dictionary of module name to a dictionary with the import time (seconds) and the heavy packages that
+    were imported with it (other than the expected ones), or the error if the import failed
+    """
+    results = {}
+    for name in names or modules:
+        times, loaded = [], []
+        for _ in range(repeat):
+            process = subprocess.run([sys.executable, '-c', __child__.format(name, heavy, expected.get(name, []))], capture_output=True,
+                                     text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+            if process.returncode != 0:
+                results[name] = {'time': float('nan'), 'heavy': [],
+                                 'error': (process.stderr.strip().splitlines() or ['unknown error'])[-1]}
+                break
+            result = json.loads(process.stdout.strip().splitlines()[-1])
+            times.append(result['time'])
+            loaded = result['heavy']
+        else:
+            results[name] = {'time': min(times), 'heavy': loaded}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the import time of the modules')
+    parser.add_argument('modules', nargs='*', help='modules to import, default are all non-GUI modules')
+    parser.add_argument('--repeat', type=int, default=5, help='number of imports of each module')
+    parser.add_argument('--max-time', type=float, default=None,
+                        help='fail if a module takes longer than this (seconds) to import')
+    args = parser.parse_args()
+    results = benchmark_imports(args.modules, repeat=args.repeat)
+    failed = False
+    for name, result in results.items():
+        slow = args.max_time is not None and result['time'] > args.max_time
+        failed = failed or slow or bool(result['heavy']) or 'error' in result
+        print('{0:16s} {1:8.1f} ms  {2}{3}'.format(name, result['time'] * 1000,
+                                                 result.get('error', ', '.join(result['heavy'])),
+                                                 '  (too slow)' if slow else ''))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,24 @@
 # this is a place where all the comparison code lives. This could be
 # comparison between single files or between a list of files.
-import matplotlib.pyplot as plt
 import csv
+import fnmatch
+import gzip
+import json
+import zlib
 import plstats
 import numpy as np
 import glob
-from matplotlib.backends.backend_pdf import PdfPages
+import os
+from concurrent.futures import ProcessPoolExecutor
+from plstatslist import get_uidnames
+from prefetch import prefetch
+from bisect import bisect_left
+from functools import lru_cache
 
 
 def compare_benchmarks(pldir1, pldir2, csvfile=None, plot_timecomparison=True, plot_timefile='timeplot.pdf',
-                       return_diff=True, **kwargs):
+                       return_diff=True, plot_procs=1, npzfile=None, skip_unchanged=False, catalogfile=None,
+                       **kwargs):
     """
     Function to compare all the aquareports within the given pipeline directories
 
@@ -21,36 +30,80 @@ def compare_benchmarks(pldir1, pldir2, csvfile=None, plot_timecomparison=True, p
     :param pldir2: second directory with pipeline runs
     :param csvfile: the name of the CSV file in which to write the output
     :param plot_timecomparison: makes simple plots of the timing differences between plruns
-    :param plot_timefile: name of the timeplot
-    :param return_diff: will return the difference dictionary
+    :param plot_timefile: name of the timeplot, a PDF file or an HTML file (see timingreport.render_timing_report)
+    :param return_diff: will return the difference dictionaries, otherwise they are not kept (unless plotted)
+    :param plot_procs: number of worker processes that render the pages of the timeplots
+    :param npzfile: if set, all entries of the diff dictionaries are also written to this (columnar) npz file, see
+    DiffWriter
+    :param skip_unchanged: if set, only compare the sections (and projects) whose hashes changed, see
+    PLStats.get_hashes. A timing change counts as a change, and STAGE is always compared for the timeplots
+    :param catalogfile: (sqlite) catalog with the hashes of the runs for skip_unchanged, see PLStatsCatalog
     :return: if csvfile is set, a CSV file will be written. Also, will return the diff dictionary 
              if return_diff is set
     """
     projects = np.unique([x.split('/')[-2].split('_')[0] for x in sorted(glob.glob(pldir1+'/*.*/'))])
     diff = []
-    for proj in projects:
-        print('running comparison script on project: {}'.format(proj))
-        plist = glob.glob('{0}/{1}_*/S*/G*/M*/working'.format(pldir1, proj))
-        if len(plist) == 0:
-            full_dir = glob.glob('{0}/{1}'.format(pldir1, proj))[0].split('/')[-1]
-            print('{0} is not a valid project with an aquareport in the first directory.'.format(full_dir))
-            continue
-        else:
-            pl1 = plist[-1]
-        plist = glob.glob('{0}/{1}_*/S*/G*/M*/working'.format(pldir2, proj))
-        if len(plist) == 0:
-            print('{0} is not a valid project in the second directory.'.format(proj))
-            continue
-        else:
-            pl2 = plist[-1]
-        pl1 = plstats.PLStats.from_workingdir(pl1)
-        pl2 = plstats.PLStats.from_workingdir(pl2)
-        diff.append(compare_plstats(pl1, pl2, csvfile=csvfile, **kwargs))
+    writer = DiffWriter(csvfile, npzfile=npzfile) if csvfile is not None or npzfile is not None else None
+    selected = kwargs.pop('sections', None)
+    catalog = None
+    if skip_unchanged and catalogfile is not None:
+        from plstatscatalog import PLStatsCatalog
+        catalog = PLStatsCatalog(catalogfile)
+    try:
+        for proj in projects:
+            print('running comparison script on project: {}'.format(proj))
+            plist = glob.glob('{0}/{1}_*/S*/G*/M*/working'.format(pldir1, proj))
+            if len(plist) == 0:
+                full_dir = glob.glob('{0}/{1}'.format(pldir1, proj))[0].split('/')[-1]
+                print('{0} is not a valid project with an aquareport in the first directory.'.format(full_dir))
+                continue
+            else:
+                pl1 = plist[-1]
+            plist = glob.glob('{0}/{1}_*/S*/G*/M*/working'.format(pldir2, proj))
+            if len(plist) == 0:
+                print('{0} is not a valid project in the second directory.'.format(proj))
+                continue
+            else:
+                pl2 = plist[-1]
+            workdirs, sections = [pl1, pl2], selected
+            if skip_unchanged:
+                if catalog is not None:
+                    # only the runs that changed since the last update of the catalog are parsed here
+                    pl1, pl2 = [catalog.update_workingdir(x) for x in workdirs]
+                    hashes1, hashes2 = [next(iter(catalog.get_hashes(x).values()), {}) for x in workdirs]
+                else:
+                    pl1, pl2 = [plstats.PLStats.from_workingdir(x) for x in workdirs]
+                    hashes1, hashes2 = pl1.get_hashes(), pl2.get_hashes()
+                changed = [x for x in plstats.PLStats.sections if hashes1.get(x) != hashes2.get(x) and
+                           (selected is None or x == 'MOUS' or x in selected)]
+                if hashes1.get('RUN') != hashes2.get('RUN'):
+                    # the timing and versions are in the MOUS and STAGE sections
+                    changed += ['MOUS'] + (['STAGE'] if selected is None or 'STAGE' in selected else [])
+                if plot_timecomparison:
+                    changed += ['STAGE']
+                sections = [x for x in plstats.PLStats.sections if x in changed]
+                if not sections:
+                    print('no changes for project: {}'.format(proj))
+                    continue
+                print('sections to compare: {}'.format(', '.join(sections)))
+            else:
+                pl1 = pl2 = None
+            pl1 = pl1 or plstats.PLStats.from_workingdir(workdirs[0])
+            pl2 = pl2 or plstats.PLStats.from_workingdir(workdirs[1])
+            diff_dict = compare_plstats(pl1, pl2, csvfile=writer, sections=sections, **kwargs)
+            if return_diff or plot_timecomparison:
+                diff.append(diff_dict)
+    finally:
+        if writer is not None:
+            writer.close()
+        if catalog is not None:
+            catalog.close()
     if plot_timecomparison:
-        __plot_timecomp__(diff, plot_timefile.replace('.pdf', '_tasktime.pdf'), mode='task_time', pldir1=pldir1,
-                          pldir2=pldir2)
-        __plot_timecomp__(diff, plot_timefile.replace('.pdf', '_resulttime.pdf'), mode='result_time', pldir1=pldir1,
-                          pldir2=pldir2)
+        name, ext = os.path.splitext(plot_timefile)
+        __plot_timecomp__(diff, name + '_tasktime' + ext, mode='task_time', pldir1=pldir1, pldir2=pldir2,
+                          n_procs=plot_procs)
+        __plot_timecomp__(diff, name + '_resulttime' + ext, mode='result_time', pldir1=pldir1, pldir2=pldir2,
+                          n_procs=plot_procs)
     if return_diff:
         return diff
     else:
@@ -58,57 +111,277 @@ def compare_benchmarks(pldir1, pldir2, csvfile=None, plot_timecomparison=True, p
 
 
 def compare_plstats(pl1, pl2, csvfile=None, stagemap=None, selection=None, diff_only=False, limit=1E-5,
-                    compact=False, ignore_time=False):
+                    compact=False, ignore_time=False, sections=None):
     """ Creates a diff dictionary with the differences between the parameters. The parameters that are checked are
     (partly) hard-coded into this function. The result can also create a csv file of the output (if set).
 
     :param pl1: The first PLStats object
     :param pl2: The second PLStats object that will be compared to the first
-    :param stagemap: ordered list of comparison between stages. If not set, the code will make a guess that can
-    go quite wrong if the imaging stages between the pipeline runs have changed
-    :param csvfile: If set, the diff dictionary will be translated into a csvfile, no diff dictionary will be returned
+    :param stagemap: ordered list of comparison between stages. If not set, the stages are aligned on their names
+    and order (see get_stagemap)
+    :param csvfile: If set, the diff dictionary will be appended to this csvfile. This can also be an (open)
+    DiffWriter, e.g., to write the comparisons of many projects to the same file
     :param selection: Selection of outputs to plot. Currently only works for top level products, so not very useful
     :param diff_only: If set, only the differences that fall above the limit set by the keyword limit will be shown
     :param limit: Set the percentage limit in order to include the keyword in the output. For instnance a limit of
     0.05 means that any absolute change greater than 5 percent will be included in the diff_only output
     :param compact: If set, a compact version will be returned with the information on a single line
     :param ignore_time: If set, will ignore any per-stage timing information in the comparison 
+    :param sections: If set, only compare these sections (EB, STAGE, TARGET and/or FLUX) besides the MOUS level
+    keywords, e.g., the sections that changed according to PLStats.get_changed_sections
     :return: diff dictionary or None
     """
-    diff_dict = create_diff_dict(pl1, pl2, do_mous=True, do_stage=True, do_flux=True, do_target=True, limit=limit,
+    if sections is None:
+        sections = ['EB', 'STAGE', 'TARGET', 'FLUX']
+    diff_dict = create_diff_dict(pl1, pl2, do_mous=True, do_eb='EB' in sections, do_stage='STAGE' in sections,
+                                 do_flux='FLUX' in sections, do_target='TARGET' in sections, limit=limit,
                                  diff_only=diff_only, stagemap=stagemap)
     # output
-    if csvfile is not None:
-        if compact:
-            diff_dict_c = {**diff_dict['MOUS'], **diff_dict['STAGE'], **diff_dict['FLUX'], **diff_dict['TARGET']}
-            if selection is None:
-                selection = list(diff_dict_c.keys())
-            # clean up
-            for key in selection:
-                if ('task_time' in key) or ('result_time' in key):
-                    del diff_dict_c[key]
-                if ('total_time' in key) and ignore_time:
-                    del diff_dict_c[key]
-            __convdiff2csv__(diff_dict_c, csvfile, comment=None)
-        else:
-            comm = {'MOUS': 'Mous level properties', 'STAGE': 'Pipeline Stage',
-                    'FLUX': 'Flux measurements per spw for calibrator', 'TARGET': 'Imaging characteristics for target'}
-            if selection is None:
-                selection = diff_dict.keys()
-            for item in selection:
-                if item in ['STAGE']:
-                    subs = ['qa_score']
-                    if not ignore_time:
-                        subs.append('total_time')
-                elif item in ['FLUX', 'TARGET']:
-                    subs = list(set([x.split(':')[0] for x in diff_dict[item]]))
-                else:
-                    subs = ['']
-                for sub in subs:
-                    __convdiff2csv__(diff_dict[item], csvfile, sub=sub, comment=comm[item] + ':' + sub)
+    if isinstance(csvfile, DiffWriter):
+        csvfile.write(diff_dict, selection=selection, compact=compact, ignore_time=ignore_time)
+    elif csvfile is not None:
+        with DiffWriter(csvfile) as writer:
+            writer.write(diff_dict, selection=selection, compact=compact, ignore_time=ignore_time)
     return diff_dict
 
 
+def compare_uidnames(searchdir, uid_names=None, n_procs=1, cachefile=None, mp_context=None, **kwargs):
+    """
+    Creates the diff dictionaries between the first and the last pipeline run of each uid name in a stats directory
+    (e.g., the input of comparestatsgui). With n_procs > 1 the diff dictionaries are made in worker processes, which
+    send them back as compressed JSON.
+    :param searchdir: directory with the pipeline_stats (and aquareport and suppl. stats) files
+    :param uid_names: list of uid names to compare, if not set all uid names in the directory are compared
+    :param n_procs: number of worker processes
+    :param cachefile: if set, the diff dictionaries are stored in this (gzipped JSON) file, and on the next call only
+    the uid names whose files changed are compared again
+    :param mp_context: multiprocessing context of the worker processes, e.g., spawn when called from a GUI
+    :param kwargs: keywords that are passed to create_diff_dict
+    :return: list of diff dictionaries
+    """
+    return list(iter_uidnames(searchdir, uid_names=uid_names, n_procs=n_procs, cachefile=cachefile,
+                              mp_context=mp_context, **kwargs))
+
+
+def iter_uidnames(searchdir, uid_names=None, n_procs=1, cachefile=None, mp_context=None, **kwargs):
+    """
+    Generator version of compare_uidnames, the cache file is written when the generator is exhausted.
+    """
+    if type(uid_names) == str:
+        uid_names = [uid_names]
+    if uid_names is None:
+        uid_names = get_uidnames(searchdir)
+    filelist = glob.glob(searchdir + '/pipeline*')
+    uidfiles = {x: [plstats.PLStats.get_uidfiles(x, searchdir=searchdir, index=y, filelist=filelist)
+                    for y in [0, -1]] for x in uid_names}
+    signatures = {x: __get_filesignature__([z for y in uidfiles[x] for z in y.values()]) for x in uid_names}
+    options = json.dumps(kwargs, sort_keys=True, default=str)
+    cache = __read_diffcache__(cachefile, options) if cachefile else {}
+    todo = [x for x in uid_names if x not in cache or cache[x]['signature'] != signatures[x]]
+    if todo:
+        print('comparing {0} of {1} uid names'.format(len(todo), len(uid_names)))
+    pool = None
+    if n_procs > 1 and len(todo) > 1:
+        pool = ProcessPoolExecutor(max_workers=n_procs, mp_context=mp_context)
+        results = (json.loads(zlib.decompress(x)) for x in
+                   pool.map(__create_uiddiffjson__, todo, [searchdir] * len(todo), [None] * len(todo),
+                            [kwargs] * len(todo), [[z for y in uidfiles[x] for z in y.values() if z] for x in todo],
+                            chunksize=max(1, len(todo) // (4 * n_procs))))
+    else:
+        bundles = ((x, [z for y in uidfiles[x] for z in y.values()]) for x in todo)
+        results = (__create_uiddiff__(x, searchdir, files, kwargs, filelist) for x, files in prefetch(bundles))
+    todo = set(todo)
+    try:
+        for uid_name in uid_names:
+            if uid_name not in todo:
+                yield cache[uid_name]['diff']
+                continue
+            diff = next(results)
+            if cachefile:
+                cache[uid_name] = {'signature': signatures[uid_name], 'diff': diff}
+            yield diff
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    if cachefile and todo:
+        __write_diffcache__(cachefile, options, cache)
+
+
+def __create_uiddiff__(uid_name, searchdir, files, kwargs, filelist):
+    # the diff dictionary of the first and last run of a uid name for compare_uidnames
+    pl1 = plstats.PLStats.from_uidname(uid_name, searchdir=searchdir, index=0, files=files, filelist=filelist)
+    pl2 = plstats.PLStats.from_uidname(uid_name, searchdir=searchdir, index=-1, files=files, filelist=filelist)
+    return create_diff_dict(pl1, pl2, **kwargs)
+
+
+def __create_uiddiffjson__(uid_name, searchdir, files, kwargs, filelist):
+    # worker of compare_uidnames, the diff dictionary is returned as compressed JSON (faster to send than a pickle)
+    diff = __create_uiddiff__(uid_name, searchdir, files, kwargs, filelist)
+    return zlib.compress(json.dumps(diff, default=__to_json__, separators=(',', ':')).encode('utf-8'), 1)
+
+
+def __get_filesignature__(filenames):
+    # modification time and size of the files that a diff dictionary is made from
+    signature = []
+    for filename in sorted(set(x for x in filenames if x)):
+        stat = os.stat(filename)
+        signature.append('{0}:{1}:{2}'.format(filename, stat.st_mtime_ns, stat.st_size))
+    return '|'.join(signature)
+
+
+def __read_diffcache__(cachefile, options):
+    # cached diff dictionaries of compare_uidnames, empty if there is no (valid) cache for the same options
+    try:
+        with gzip.open(cachefile, 'rt', encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if cache.get('version') != 1 or cache.get('options') != options:
+        return {}
+    return cache['entries']
+
+
+def __write_diffcache__(cachefile, options, entries):
+    try:
+        with gzip.open(cachefile + '.tmp', 'wt', encoding='utf-8', compresslevel=1) as f:
+            json.dump({'version': 1, 'options': options, 'entries': entries}, f, separators=(',', ':'),
+                      default=__to_json__)
+        os.replace(cachefile + '.tmp', cachefile)
+    except OSError as err:
+        print('compare_uidnames: could not write the cache file {0}: {1}'.format(cachefile, err))
+
+
+def __to_json__(obj):
+    # numpy scalars and arrays are not json serializable
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return obj.item() if hasattr(obj, 'item') else str(obj)
+
+
+class DiffWriter:
+    """
+    Writes diff dictionaries (see create_diff_dict) to a CSV file (the layout of __convdiff2csv__, nested keys are
+    joined by ':') and/or a columnar npz file with one element per entry or channel, which is written on close.
+    """
+    comments = {'MOUS': 'Mous level properties', 'STAGE': 'Pipeline Stage',
+                'FLUX': 'Flux measurements per spw for calibrator', 'TARGET': 'Imaging characteristics for target'}
+
+    def __init__(self, csvfile=None, npzfile=None, mode='a', buffering=2 ** 20, plain_values=False):
+        self.plain_values = plain_values
+        self.csvfile = open(csvfile, mode, newline='', buffering=buffering) if csvfile is not None else None
+        self.csvwriter = csv.writer(self.csvfile) if csvfile is not None else None
+        self.npzfile = npzfile
+        self.columns = {x: [] for x in ['run', 'section', 'key', 'channel', 'PL1', 'PL2', 'diff', 'pdiff',
+                                        'PL1_text', 'PL2_text', 'CF']}
+        self.n_runs = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.csvfile is not None:
+            self.csvfile.close()
+            self.csvfile = None
+        if self.npzfile is not None:
+            np.savez_compressed(self.npzfile, run=np.array(self.columns['run'], dtype=int),
+                                channel=np.array(self.columns['channel'], dtype=int),
+                                CF=np.array(self.columns['CF'], dtype=bool),
+                                **{x: np.array(self.columns[x], dtype=float) for x in ['PL1', 'PL2', 'diff', 'pdiff']},
+                                **{x: np.array(self.columns[x], dtype=str)
+                                   for x in ['section', 'key', 'PL1_text', 'PL2_text']})
+            self.npzfile = None
+
+    def write(self, diff_dict, selection=None, compact=False, ignore_time=False):
+        """
+        Writes a diff dictionary, with the same selection options as compare_plstats.
+        """
+        if self.csvwriter is not None:
+            if compact:
+                entries = [x for section in ['MOUS', 'STAGE', 'FLUX', 'TARGET']
+                           for x in __iter_diffentries__(diff_dict[section])]
+                remove = [x[0] for x in entries if ('task_time' in x[0]) or ('result_time' in x[0]) or
+                          (('total_time' in x[0]) and ignore_time)]
+                remove = set(remove if selection is None else [x for x in remove if x in selection])
+                self.write_section([x for x in entries if x[0] not in remove])
+            else:
+                for item in (diff_dict.keys() if selection is None else selection):
+                    entries = list(__iter_diffentries__(diff_dict[item]))
+                    if item in ['STAGE']:
+                        subs = ['qa_score'] if ignore_time else ['qa_score', 'total_time']
+                    elif item in ['FLUX', 'TARGET']:
+                        subs = list(dict.fromkeys([x[0].split(':')[0] for x in entries]))
+                    else:
+                        subs = ['']
+                    self.write_section(entries, subs=subs,
+                                       comments=[self.comments.get(item, item) + ':' + x for x in subs])
+        if self.npzfile is not None:
+            for section in diff_dict:
+                for key, entry in __iter_diffentries__(diff_dict[section]):
+                    self.__add_columns__(section, key, entry)
+        self.n_runs += 1
+
+    def write_section(self, entries, subs=('',), comments=None):
+        """
+        Writes the (key, entry) tuples of a section, for each sub the keys that contain it, after the comment.
+        """
+        groups = {x: [] for x in subs}
+        for key, entry in entries:
+            if self.plain_values:
+                row = (key, entry['PL1']['value'], entry['PL2']['value'], entry['diff']['value'])
+            else:
+                row = (key, entry['PL1'], entry['PL2'], entry['diff'])
+            for sub in subs:
+                if sub in key:
+                    groups[sub].append(row)
+        for sub, comment in zip(subs, comments if comments is not None else [None] * len(subs)):
+            rows = [[comment]] if comment is not None else []
+            if groups[sub]:
+                rows.extend(list(x) for x in zip(*groups[sub]))
+            else:
+                rows.extend([[], [], [], []])
+            rows.append([])
+            self.csvwriter.writerows(rows)
+
+    def __add_columns__(self, section, key, entry):
+        values = [entry[x]['value'] for x in ['PL1', 'PL2', 'diff', 'pdiff']]
+        cf = entry['CF']['value'] if 'CF' in entry else False
+        n_channels = max([len(x) for x in values + [cf] if type(x) == list], default=0)
+        for channel in range(n_channels) if n_channels > 0 else [-1]:
+            items = [x[channel] if type(x) == list and channel < len(x) else (x if type(x) != list else '---')
+                     for x in values]
+            numbers = [__get_numbers__(x) for x in items]
+            self.columns['run'].append(self.n_runs)
+            self.columns['section'].append(section)
+            self.columns['key'].append(key)
+            self.columns['channel'].append(channel)
+            for column, number in zip(['PL1', 'PL2', 'diff', 'pdiff'], numbers):
+                self.columns[column].append(number[0] if number else np.nan)
+            for column, item, number in zip(['PL1_text', 'PL2_text'], items, numbers):
+                self.columns[column].append('' if number and number[0] == number[0] else str(item))
+            self.columns['CF'].append(bool(cf[channel] if type(cf) == list and channel < len(cf) else
+                                           (cf if type(cf) != list else False)))
+
+
+def __convdiff2csv__(diff, csvfile, sub='', comment=None):
+    with DiffWriter(csvfile) as writer:
+        writer.write_section(__iter_diffentries__(diff), subs=[sub], comments=[comment])
+
+
+def __iter_diffentries__(diff, key=None):
+    # the (key path, entry) of each entry in a (nested) section of a diff dictionary
+    for name, entry in diff.items():
+        if not isinstance(entry, dict):
+            continue
+        path = name if key is None else key + ':' + name
+        if 'PL1' in entry:
+            yield path, entry
+        else:
+            yield from __iter_diffentries__(entry, key=path)
+
+
 def create_diff_dict(pl1, pl2, do_mous=True, do_eb=True, do_stage=True, do_target=True, do_cube=True, do_mfs=True,
                      do_cont=True, do_flux=True, diff_only=False, limit=1E-5, stagemap=None):
     """
@@ -116,9 +389,11 @@ def create_diff_dict(pl1, pl2, do_mous=True, do_eb=True, do_stage=True, do_targe
 
     This is the main strcuture for the comparison codes. It is modular, so it can compare only sections
     of the pipeline structure by setting the appropriate keywords. This is done for speed, because any parameter that
-    is not present in both pipelines will be ignored and not compared.
+    is not present in both pipelines will be ignored and not compared. Image entries of preview mode suppl. stats are
+    marked with 'preview' and not flagged.
     """
     diff_dict = {'MOUS': {}, 'EB': {}, 'STAGE': {}, 'TARGET': {}, 'FLUX': {}, 'SPW': {}}
+    preview = __get_statsmode__(pl1) == 'preview' or __get_statsmode__(pl2) == 'preview'
     # get MOUS level parameters
     if do_mous:
         pcl = __get_parameter_comparison_list__(pl1, level='MOUS')
@@ -127,6 +402,8 @@ def create_diff_dict(pl1, pl2, do_mous=True, do_eb=True, do_stage=True, do_targe
             pcl.remove('proposal_code')
             pcl.insert(0, 'proposal_code')
         for key in pcl:
+            if diff_only and key != 'proposal_code' and key in pl2.mous and pl1.mous[key] == pl2.mous[key]:
+                continue
             if key not in pl2.get_keywords('MOUS'):
                 print('key: {} not present in pl2'.format(key))
             if 'value' not in pl1.mous[key]:
@@ -138,6 +415,8 @@ def create_diff_dict(pl1, pl2, do_mous=True, do_eb=True, do_stage=True, do_targe
     # per eb keywords
     if do_eb:
         for eb in pl1.mous['EB']:
+            if diff_only and eb in pl2.mous['EB'] and pl1.mous['EB'][eb] == pl2.mous['EB'][eb]:
+                continue
             pcl_eb = pl1.mous['EB'][eb].keys()
             for key in pcl_eb:
                 val1 = pl1.mous['EB'][eb][key]['value'] if key in pl1.mous['EB'][eb].keys() else '---'
@@ -147,8 +426,10 @@ def create_diff_dict(pl1, pl2, do_mous=True, do_eb=True, do_stage=True, do_targe
     # get stage info (QA scores and timing)
     if do_stage:
         if stagemap is None:
-            stagemap = __get_stagemap__(pl1, pl2)
+            stagemap = get_stagemap(pl1, pl2)
         for stage in stagemap:
+            if diff_only and pl1.mous['STAGE'][stage[0]] == pl2.mous['STAGE'][stage[1]]:
+                continue
             for k in ['qa_score', 'task_time', 'result_time', 'total_time']:
                 key = stage[0] + ':' + pl1.mous['STAGE'][stage[0]]['stage_name']['value'] + ':' + k
                 if k in pl1.mous['STAGE'][stage[0]] and k in pl2.mous['STAGE'][stage[1]]:
@@ -163,6 +444,8 @@ def create_diff_dict(pl1, pl2, do_mous=True, do_eb=True, do_stage=True, do_targe
         for target in target_list:
             if target not in pl2.mous['TARGET']:
                 continue
+            if diff_only and pl1.mous['TARGET'][target] == pl2.mous['TARGET'][target]:
+                continue
             diff_dict['TARGET'][target] = {'SPW': {}}
             # code to read in the aquareport sensitivties, should eventually be removed or integrated with below code
             # this wil actually likely crash with current structure.
@@ -183,16 +466,15 @@ def create_diff_dict(pl1, pl2, do_mous=True, do_eb=True, do_stage=True, do_targe
                     continue
                 if spw not in pl2.mous['TARGET'][target]:
                     continue
-                diff_dict['TARGET'][target]['SPW'][spw] = __image_strct__()
-                if do_mfs:
-                    __add_imstats__(pl1, pl2, target, spw, 'mfs', diff_dict)
-                    __add_imstats__(pl1, pl2, target, spw, 'mfs_selfcal', diff_dict)
-                if do_cube:
-                    __add_imstats__(pl1, pl2, target, spw, 'cube', diff_dict)
-                    __add_imstats__(pl1, pl2, target, spw, 'cube_selfcal', diff_dict)
-                if do_cont:
-                    __add_imstats__(pl1, pl2, target, spw, 'cont', diff_dict)
-                    __add_imstats__(pl1, pl2, target, spw, 'cont_selfcal', diff_dict)
+                if diff_only and pl1.mous['TARGET'][target][spw] == pl2.mous['TARGET'][target][spw]:
+                    continue
+                diff_dict['TARGET'][target]['SPW'][spw] = {} if diff_only else __image_strct__()
+                imtypes = (['mfs', 'mfs_selfcal'] if do_mfs else []) + (['cube', 'cube_selfcal'] if do_cube else []) + \
+                    (['cont', 'cont_selfcal'] if do_cont else [])
+                for imtype in imtypes:
+                    __add_imstats__(pl1, pl2, target, spw, imtype, diff_dict, diff_only=diff_only, preview=preview)
+                if diff_only and not diff_dict['TARGET'][target]['SPW'][spw]:
+                    del diff_dict['TARGET'][target]['SPW'][spw]
                 # the following is broken
                 # cf = np.any(np.concatenate([diff_dict['TARGET'][target]['SPW'][spw][x]['CF']['value']
                 #                             for x in diff_dict['TARGET'][target]['SPW'][spw] if x != 'CF']))
@@ -200,12 +482,16 @@ def create_diff_dict(pl1, pl2, do_mous=True, do_eb=True, do_stage=True, do_targe
             # cf = [diff_dict['TARGET'][target]['SPW'][x]['CF']['value']
             #       for x in diff_dict['TARGET'][target]['SPW']]
             # diff_dict['TARGET'][target]['CF'] = {'value': bool(np.any(cf))}
+            if diff_only and not diff_dict['TARGET'][target]['SPW']:
+                del diff_dict['TARGET'][target]
     # get flux info
     if do_flux:
         flux_list = [x for x in pl1.mous['FLUX']] if ('FLUX' in pl1.mous) and ('FLUX' in pl2.mous) else []
         for flux in flux_list:
             if flux not in pl2.mous['FLUX']:
                 continue
+            if diff_only and pl1.mous['FLUX'][flux] == pl2.mous['FLUX'][flux]:
+                continue
             for spw in pl1.mous['FLUX'][flux]['SPW']:
                 for asdm in pl1.mous['FLUX'][flux]['SPW'][spw]:
                     key = flux + ':' + spw + ':' + asdm
@@ -219,34 +505,355 @@ def create_diff_dict(pl1, pl2, do_mous=True, do_eb=True, do_stage=True, do_targe
     return diff_dict
 
 
+class MultiDiff:
+    """
+    Comparison of any number of pipeline runs of the same MOUS in one pass. values[offsets[i]:offsets[i + 1], run]
+    are the values (NaN if missing) of entry keys[i], a key path of the diff dictionary, e.g., ('MOUS', 'n_EB').
+    """
+    imtypes = ['mfs', 'mfs_selfcal', 'cube', 'cube_selfcal', 'cont', 'cont_selfcal']
+
+    def __init__(self, runs):
+        self.runs = runs
+        self.keys = []
+        self.raw = []
+        self.keyindex = {}
+        self.stages = {}
+        self.targets = {}
+        self.images = {}
+        self.modes = ['full'] * len(runs)
+        self.offsets = np.zeros(1, dtype=int)
+        self.values = np.zeros((0, len(runs)))
+
+    @classmethod
+    def from_plstats(cls, pllist, runs=None, do_mous=True, do_eb=True, do_stage=True, do_target=True, do_flux=True):
+        """
+        Collects the entries of a list of PLStats objects.
+        :param pllist: list of PLStats objects (the pipeline runs)
+        :param runs: labels of the runs, default is PL1, PL2, etc.
+        :return: MultiDiff object
+        """
+        n_runs = len(pllist)
+        self = cls(runs if runs is not None else ['PL' + str(x + 1) for x in range(n_runs)])
+        self.modes = [__get_statsmode__(x) for x in pllist]
+        entries = {}
+
+        def add(key, run, value):
+            if key not in entries:
+                entries[key] = ['---'] * n_runs
+            entries[key][run] = value
+
+        if do_mous:
+            for run, pl in enumerate(pllist):
+                pcl = __get_parameter_comparison_list__(pl, level='MOUS')
+                if 'proposal_code' in pcl:
+                    pcl.sort()
+                    pcl.remove('proposal_code')
+                    pcl.insert(0, 'proposal_code')
+                for key in pcl:
+                    if 'value' in pl.mous[key]:
+                        add(('MOUS', key), run, pl.mous[key]['value'])
+        if do_eb:
+            for run, pl in enumerate(pllist):
+                for eb in pl.mous.get('EB', {}):
+                    for key in pl.mous['EB'][eb]:
+                        if 'value' in pl.mous['EB'][eb][key]:
+                            add(('EB', eb, key), run, pl.mous['EB'][eb][key]['value'])
+        if do_stage:
+            for stages in get_nway_stagemap(pllist):
+                first = [x for x in stages if x is not None][0]
+                run = stages.index(first)
+                name = pllist[run].mous['STAGE'][first]['stage_name']['value']
+                label = first + ':' + name
+                self.stages[label] = (name, stages)
+                for run, stage in enumerate(stages):
+                    if stage is None:
+                        continue
+                    for k in ['qa_score', 'task_time', 'result_time', 'total_time']:
+                        if k in pllist[run].mous['STAGE'][stage]:
+                            value = pllist[run].mous['STAGE'][stage][k]['value']
+                            add(('STAGE', label, k), run, float(value) if value != 'None' else float(-1))
+        if do_target:
+            for run, pl in enumerate(pllist):
+                for target in pl.mous.get('TARGET', {}):
+                    self.targets.setdefault(target, [False] * n_runs)[run] = True
+                    for spw in pl.mous['TARGET'][target]:
+                        if 'value' in pl.mous['TARGET'][target][spw].keys() or spw == 'SPW':
+                            continue
+                        self.images.setdefault((target, spw), [False] * n_runs)[run] = True
+                        image = pl.mous['TARGET'][target][spw]
+                        for imtype in self.imtypes:
+                            rms = image.get('makeimages_science_' + imtype + '_rms', {}).get('value', '---')
+                            peak = image.get('makeimages_science_' + imtype + '_max', {}).get('value', '---')
+                            if rms != '---':
+                                add(('TARGET', target, 'SPW', spw, imtype + '_rms'), run, rms)
+                            if peak != '---':
+                                add(('TARGET', target, 'SPW', spw, imtype + '_max'), run, peak)
+                            if rms != '---' and peak != '---':
+                                add(('TARGET', target, 'SPW', spw, imtype + '_snr'), run,
+                                    [x / y for x, y in zip(peak, rms)])
+        if do_flux:
+            for run, pl in enumerate(pllist):
+                for flux in pl.mous.get('FLUX', {}):
+                    for spw in pl.mous['FLUX'][flux]['SPW']:
+                        for asdm in pl.mous['FLUX'][flux]['SPW'][spw]:
+                            fluxinfo = pl.mous['FLUX'][flux]['SPW'][spw][asdm]
+                            add(('FLUX', flux + ':' + spw + ':' + asdm), run,
+                                float(fluxinfo['fitted_value']) if fluxinfo['fitted_value'] != -1.0 else
+                                float(fluxinfo['value']))
+        self.keys = list(entries.keys())
+        self.raw = [entries[x] for x in self.keys]
+        self.keyindex = {x: idx for idx, x in enumerate(self.keys)}
+        numbers = [[__get_numbers__(x) for x in values] for values in self.raw]
+        n_rows = [max([len(x) for x in values], default=1) or 1 for values in numbers]
+        self.offsets = np.concatenate([[0], np.cumsum(n_rows)]).astype(int)
+        self.values = np.full((self.offsets[-1], n_runs), np.nan)
+        for idx, values in enumerate(numbers):
+            for run, x in enumerate(values):
+                self.values[self.offsets[idx]:self.offsets[idx] + len(x), run] = x
+        return self
+
+    @classmethod
+    def from_uidname(cls, uid_name, searchdir='.', indices=None, **kwargs):
+        """
+        Compares the pipeline runs of a uid name in a directory (see PLStats.from_uidname).
+        :param indices: indices of the runs to compare, default is all runs of the uid name in the directory
+        :param kwargs: keywords for from_plstats
+        """
+        filelist = glob.glob(searchdir + '/pipeline*')
+        if indices is None:
+            indices = range(len([x for x in fnmatch.filter(filelist, searchdir + '/pipeline_stats_*.json')
+                                 if uid_name in x]))
+        pllist = [plstats.PLStats.from_uidname(uid_name, searchdir=searchdir, index=x, filelist=filelist)
+                  for x in indices]
+        if 'runs' not in kwargs:
+            kwargs['runs'] = [x.statsfile.split('/')[-1] for x in pllist]
+        return cls.from_plstats(pllist, **kwargs)
+
+    def get(self, key, run=None):
+        """
+        The values (one per channel for per-channel entries) of an entry, for all runs or a single run.
+        """
+        idx = self.keyindex[tuple(key)]
+        values = self.values[self.offsets[idx]:self.offsets[idx + 1]]
+        return values if run is None else values[:, run]
+
+    def get_rows(self, section=None):
+        """
+        Boolean mask of the rows of the values array that belong to a section (e.g., 'TARGET'), all rows if not set.
+        """
+        if section is None:
+            return np.ones(self.offsets[-1], dtype=bool)
+        insection = np.array([x[0] == section for x in self.keys], dtype=bool)
+        return np.repeat(insection, np.diff(self.offsets))
+
+    def diff(self, run1=0, run2=1, section=None):
+        """
+        Difference (run2 - run1) of the values of two runs, for each row.
+        """
+        rows = self.get_rows(section)
+        return self.values[rows, run2] - self.values[rows, run1]
+
+    def pdiff(self, run1=0, run2=1, section=None):
+        """
+        Relative difference (run2 - run1) / run1 of the values of two runs for each row, -1 if run1 is 0.
+        """
+        rows = self.get_rows(section)
+        val1, val2 = self.values[rows, run1], self.values[rows, run2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(val1 != 0, (val2 - val1) / val1, -1.)
+
+    def get_spread(self, section=None):
+        """
+        Statistics of the values over all runs, for each row.
+        :return: dictionary with the min, max, median and the relative range ((max - min) / |median|) of each row,
+        and the number of runs with a value
+        """
+        values = self.values[self.get_rows(section)]
+        n_values = np.sum(np.isfinite(values), axis=1)
+        spread = {'min': np.full(len(values), np.nan), 'max': np.full(len(values), np.nan),
+                  'median': np.full(len(values), np.nan), 'n_values': n_values}
+        valid = n_values > 0
+        spread['min'][valid] = np.nanmin(values[valid], axis=1)
+        spread['max'][valid] = np.nanmax(values[valid], axis=1)
+        spread['median'][valid] = np.nanmedian(values[valid], axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            spread['range'] = (spread['max'] - spread['min']) / np.abs(spread['median'])
+        return spread
+
+    def get_runstats(self, reference=0, section=None, limit=5E-2):
+        """
+        Statistics of each run compared to the reference run.
+        :param reference: index of the reference run
+        :param section: only use the rows of this section (e.g., 'STAGE'), all rows if not set
+        :param limit: relative difference above which a value counts as changed
+        :return: dictionary with, for each run, the number of values, the number of values that can be compared to
+        the reference, the median and maximum absolute relative difference and the number of changed values
+        """
+        rows = self.get_rows(section)
+        values, ref = self.values[rows], self.values[rows, reference][:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pdiff = np.abs(np.where(ref != 0, (values - ref) / ref, np.nan))
+        valid = np.isfinite(pdiff)
+        runstats = {'runs': self.runs, 'n_values': np.sum(np.isfinite(values), axis=0),
+                    'n_compared': np.sum(valid, axis=0), 'n_changed': np.sum(valid & (pdiff > limit), axis=0),
+                    'median_pdiff': np.full(len(self.runs), np.nan), 'max_pdiff': np.full(len(self.runs), np.nan)}
+        for run in np.nonzero(runstats['n_compared'])[0]:
+            runstats['median_pdiff'][run] = np.median(pdiff[valid[:, run], run])
+            runstats['max_pdiff'][run] = np.max(pdiff[valid[:, run], run])
+        return runstats
+
+    def to_diff_dict(self, run1=0, run2=1, limit=1E-5, diff_only=False):
+        """
+        The diff dictionary of two of the runs (see create_diff_dict), with the stages of the n-way alignment.
+        """
+        diff_dict = {'MOUS': {}, 'EB': {}, 'STAGE': {}, 'TARGET': {}, 'FLUX': {}, 'SPW': {}}
+        preview = self.modes[run1] == 'preview' or self.modes[run2] == 'preview'
+        for key, values in zip(self.keys, self.raw):
+            val1, val2 = values[run1], values[run2]
+            if key[0] == 'MOUS' and val1 != '---':
+                __add2diff__(diff_dict, list(key), val1, val2, limit, diff_only=diff_only)
+            elif key[0] == 'EB' and val1 != '---':
+                __add2diff__(diff_dict, list(key), val1, val2, limit, diff_only=diff_only, less_than=False)
+        for label, (name, stages) in self.stages.items():
+            if stages[run1] is None or stages[run2] is None:
+                continue
+            for k in ['qa_score', 'task_time', 'result_time', 'total_time']:
+                if ('STAGE', label, k) not in self.keyindex:
+                    continue
+                val1, val2 = self.raw[self.keyindex[('STAGE', label, k)]][run1], \
+                    self.raw[self.keyindex[('STAGE', label, k)]][run2]
+                if val1 != '---' and val2 != '---':
+                    __add2diff__(diff_dict, ['STAGE', stages[run1] + ':' + name + ':' + k], val1, val2, limit,
+                                 diff_only=diff_only)
+        for target, present in self.targets.items():
+            if not (present[run1] and present[run2]):
+                continue
+            diff_dict['TARGET'][target] = {'SPW': {}}
+            for (imtarget, spw), imaged in self.images.items():
+                if imtarget != target or not (imaged[run1] and imaged[run2]):
+                    continue
+                diff_dict['TARGET'][target]['SPW'][spw] = {} if diff_only else __image_strct__()
+                for imtype in self.imtypes:
+                    values = [self.raw[self.keyindex[x]] if x in self.keyindex else ['---'] * len(self.runs)
+                              for x in [('TARGET', target, 'SPW', spw, imtype + '_rms'),
+                                        ('TARGET', target, 'SPW', spw, imtype + '_max')]]
+                    __add_imvalues__(diff_dict, target, spw, imtype, values[0][run1], values[0][run2],
+                                     values[1][run1], values[1][run2], diff_only=diff_only, preview=preview)
+                if diff_only and not diff_dict['TARGET'][target]['SPW'][spw]:
+                    del diff_dict['TARGET'][target]['SPW'][spw]
+            if diff_only and not diff_dict['TARGET'][target]['SPW']:
+                del diff_dict['TARGET'][target]
+        for key, values in zip(self.keys, self.raw):
+            if key[0] == 'FLUX' and values[run1] != '---' and values[run2] != '---':
+                __add2diff__(diff_dict, list(key), values[run1], values[run2], limit, diff_only=diff_only)
+        return diff_dict
+
+
 def __get_parameter_comparison_list__(pl, **kwargs):
     pcl = pl.get_keywords(**kwargs)
-    [pcl.pop(pcl.index(x)) for x in ['EB', 'SPW', 'TARGET', 'STAGE', 'spw_list', 'eb_list', 'target_list', 'FLUX']
-     if x in pcl]
+    [pcl.pop(pcl.index(x)) for x in ['EB', 'SPW', 'TARGET', 'STAGE', 'spw_list', 'eb_list', 'target_list', 'FLUX',
+                                     'suppl_stats_mode'] if x in pcl]
     return pcl
 
 
-def __get_stagemap__(pl1, pl2):
+def __get_statsmode__(pl):
+    # the mode with which the supplemental stats were made ('full' for older files without this keyword)
+    return pl.mous['suppl_stats_mode']['value'] if 'suppl_stats_mode' in pl.mous else 'full'
+
+
+def get_stagemap(pl1, pl2):
+    """
+    Maps the stages of two pipeline runs onto each other, aligned on their names and order (see align_stages).
+    :param pl1: first PLStats object
+    :param pl2: second PLStats object
+    :return: list of tuples with the matching stage numbers in pl1 and pl2
+    """
     if 'STAGE' not in pl1.mous or 'STAGE' not in pl2.mous:
         return []
     s1numbers = [x for x in pl1.mous['STAGE'].keys()]
     s1names = [pl1.mous['STAGE'][x]['stage_name']['value'] for x in pl1.mous['STAGE'].keys()]
     s2numbers = [x for x in pl2.mous['STAGE'].keys()]
     s2names = [pl2.mous['STAGE'][x]['stage_name']['value'] for x in pl2.mous['STAGE'].keys()]
-    tasklist = []
-    for s1number, s1name in zip(s1numbers, s1names):
+    return [(s1numbers[x], s2numbers[y]) for x, y in align_stages(s1names, s2names)]
+
+
+def align_stages(names1, names2):
+    """
+    Aligns two lists of stage names with a (Hunt-Szymanski) longest common subsequence, cached per pair of lists.
+    :param names1: list of stage names of the first run
+    :param names2: list of stage names of the second run
+    :return: list of tuples with the indices of the matching stages in names1 and names2 (in increasing order)
+    """
+    return list(__align_stagenames__(tuple(names1), tuple(names2)))
+
+
+@lru_cache(maxsize=1024)
+def __align_stagenames__(names1, names2):
+    positions = {}
+    for idx2, name in enumerate(names2):
+        positions.setdefault(name, []).append(idx2)
+    # thresh[k] is the smallest index in names2 at which a common subsequence of length k + 1 ends, and links[k] is
+    # the last (idx1, idx2, previous link) of that subsequence
+    thresh, links = [], []
+    for idx1, name in enumerate(names1):
+        for idx2 in reversed(positions.get(name, [])):
+            k = bisect_left(thresh, idx2)
+            if k == len(thresh):
+                thresh.append(idx2)
+                links.append(None)
+            thresh[k] = idx2
+            links[k] = (idx1, idx2, links[k - 1] if k > 0 else None)
+    pairs, link = [], links[-1] if links else None
+    while link is not None:
+        pairs.append((link[0], link[1]))
+        link = link[2]
+    return tuple(reversed(pairs))
+
+
+def get_nway_stagemap(pllist):
+    """
+    Maps the stages of any number of pipeline runs onto each other. Each run is aligned to the stages found so far
+    (see align_stages), and stages that do not match are inserted after the last matched stage.
+    :param pllist: list of PLStats objects
+    :return: list of tuples with the stage number in each run (None if the stage is not in that run)
+    """
+    stagemap, names = [], []
+    for run, pl in enumerate(pllist):
+        numbers = list(pl.mous['STAGE'].keys()) if 'STAGE' in pl.mous else []
+        runnames = [pl.mous['STAGE'][x]['stage_name']['value'] for x in numbers]
+        matched = dict((y, x) for x, y in align_stages(names, runnames))
+        idx = 0
+        newmap, newnames = [], []
+        for idx2, number in enumerate(numbers):
+            if idx2 not in matched:
+                newmap.append([None] * run + [number])
+                newnames.append(runnames[idx2])
+                continue
+            while idx <= matched[idx2]:
+                newmap.append(stagemap[idx] + [number if idx == matched[idx2] else None])
+                newnames.append(names[idx])
+                idx += 1
+        for idx in range(idx, len(stagemap)):
+            newmap.append(stagemap[idx] + [None])
+            newnames.append(names[idx])
+        stagemap, names = newmap, newnames
+    return [tuple(x) for x in stagemap]
+
+
+def __get_numbers__(value):
+    # the values of an entry as a list of floats (NaN for values that are not numbers), empty if missing
+    if type(value) == str and value == '---':
+        return []
+    numbers = []
+    for x in value if type(value) == list else [value]:
         try:
-            idx2 = s2names.index(s1name)
-            tasklist.append((s1number, s2numbers.pop(idx2)))
-            s2names.pop(idx2)
-        except ValueError:
-            continue
-    return tasklist
+            numbers.append(float(x))
+        except (TypeError, ValueError):
+            numbers.append(np.nan)
+    return numbers
 
 
-def __add_imstats__(pl1, pl2, target, spw, imtype, diff_dict, limit=None, diff_only=False):
-    if limit is None:
-        limit = [-1E-3, 5E-2, 5E-2]
+def __add_imstats__(pl1, pl2, target, spw, imtype, diff_dict, limit=None, diff_only=False, preview=False):
     rms1 = (pl1.mous['TARGET'][target][spw]['makeimages_science_' + imtype + '_rms']['value']
             if 'makeimages_science_' + imtype + '_rms' in pl1.mous['TARGET'][target][spw] else '---')
     rms2 = (pl2.mous['TARGET'][target][spw]['makeimages_science_' + imtype + '_rms']['value']
@@ -255,6 +862,14 @@ def __add_imstats__(pl1, pl2, target, spw, imtype, diff_dict, limit=None, diff_o
             if 'makeimages_science_' + imtype + '_max' in pl1.mous['TARGET'][target][spw] else '---')
     max2 = (pl2.mous['TARGET'][target][spw]['makeimages_science_' + imtype + '_max']['value']
             if 'makeimages_science_' + imtype + '_max' in pl2.mous['TARGET'][target][spw] else '---')
+    __add_imvalues__(diff_dict, target, spw, imtype, rms1, rms2, max1, max2, limit=limit, diff_only=diff_only,
+                     preview=preview)
+
+
+def __add_imvalues__(diff_dict, target, spw, imtype, rms1, rms2, max1, max2, limit=None, diff_only=False,
+                     preview=False):
+    if limit is None:
+        limit = [-1E-3, 5E-2, 5E-2]
     __add2diff__(diff_dict, ['TARGET', target, 'SPW', spw, imtype + '_rms'], rms1, rms2, limit[0],
                  diff_only=diff_only, less_than=True)
     __add2diff__(diff_dict, ['TARGET', target, 'SPW', spw, imtype + '_max'], max1, max2, limit[1],
@@ -264,12 +879,19 @@ def __add_imstats__(pl1, pl2, target, spw, imtype, diff_dict, limit=None, diff_o
         sn2 = [x / y for x, y in zip(max2, rms2)]
         __add2diff__(diff_dict, ['TARGET', target, 'SPW', spw, imtype + '_snr'], sn1, sn2, limit[2],
                      diff_only=diff_only, less_than=False)
-        # adjust the SNR and MAX 'CF' based on the S/N > 10 criteria
+        # adjust the SNR and MAX 'CF' based on the S/N > 10 criteria (entries can be missing in diff_only mode)
         sncut = [True if x > 10 else False for x in sn1]
-        diff_dict['TARGET'][target]['SPW'][spw][imtype + '_max']['CF']['value'] = \
-            np.logical_and(diff_dict['TARGET'][target]['SPW'][spw][imtype + '_max']['CF']['value'], sncut).tolist()
-        diff_dict['TARGET'][target]['SPW'][spw][imtype + '_snr']['CF']['value'] = \
-            np.logical_and(diff_dict['TARGET'][target]['SPW'][spw][imtype + '_snr']['CF']['value'], sncut).tolist()
+        for stat in ['_max', '_snr']:
+            if imtype + stat in diff_dict['TARGET'][target]['SPW'][spw]:
+                im_diff = diff_dict['TARGET'][target]['SPW'][spw][imtype + stat]
+                im_diff['CF']['value'] = np.logical_and(im_diff['CF']['value'], sncut).tolist()
+    if preview:  # sampled statistics are not accurate enough to flag on
+        for stat in ['_rms', '_max', '_snr']:
+            if imtype + stat in diff_dict['TARGET'][target]['SPW'].get(spw, {}):
+                im_diff = diff_dict['TARGET'][target]['SPW'][spw][imtype + stat]
+                im_diff['CF']['value'] = ([False] * len(im_diff['CF']['value'])
+                                          if type(im_diff['CF']['value']) == list else False)
+                im_diff['preview'] = {'value': True}
 
 
 def __calc_diff__(val1, val2):
@@ -320,45 +942,23 @@ def __calc_pdiff__(val1, val2):
     return pdiff
 
 
-def __convdiff2csv__(diff, csvfile, sub='', comment=None):
-    with open(csvfile, 'a', newline='') as csvfile:
-        csvwriter = csv.writer(csvfile)
-        if comment is not None:
-            csvwriter.writerow([comment])
-        csvwriter.writerow([name for name in diff if sub in name])
-        csvwriter.writerow([diff[name]['PL1'] for name in diff if sub in name])
-        csvwriter.writerow([diff[name]['PL2'] for name in diff if sub in name])
-        csvwriter.writerow([diff[name]['diff'] for name in diff if sub in name])
-        csvwriter.writerow([])
-
-
 def __add2diff__(diff_dict, keys, val1, val2, limit, diff_only=False, ignore_str=True, less_than=True):
     if val1 == '---' and val2 == '---':
         return
     diff, pdiff = __calc_diff__(val1, val2), __calc_pdiff__(val1, val2)
+    if diff_only and 'proposal_code' not in keys and not __is_changed__(val1, val2, diff, limit):
+        return
     diff_strct = diff_dict
-    for key in keys:
-        if key == keys[-1]:
-            diff_strct[key] = {'PL1': {'value': val1}, 'PL2': {'value': val2}, 'diff': {'value': diff},
-                               'pdiff': {'value': pdiff}, 'CF': {'value': False}}
-        else:
-            if key not in diff_strct:
-                diff_strct[key] = {}
-            else:
-                diff_strct = diff_strct[key]
+    for key in keys[:-1]:
+        diff_strct = diff_strct.setdefault(key, {})
+    diff_strct[keys[-1]] = {'PL1': {'value': val1}, 'PL2': {'value': val2}, 'diff': {'value': diff},
+                            'pdiff': {'value': pdiff}, 'CF': {'value': False}}
     # Here do the comparison
     if type(diff) == str:
-        if diff == '---':
-            if diff_only and 'proposal_code' not in keys:
-                return
-        else:
-            if not ignore_str:
-                diff_strct[keys[-1]]['CF'] = {'value': True}
+        if diff != '---' and not ignore_str:
+            diff_strct[keys[-1]]['CF'] = {'value': True}
     elif type(diff) == float or type(diff) == int:
-        if (pdiff > limit and less_than) or (pdiff < limit and not less_than):
-            if diff_only:
-                return
-        else:
+        if not ((pdiff > limit and less_than) or (pdiff < limit and not less_than)):
             diff_strct[keys[-1]]['CF'] = {'value': True}
     elif type(diff) == list:
         if type(diff[0]) == str:
@@ -367,62 +967,33 @@ def __add2diff__(diff_dict, keys, val1, val2, limit, diff_only=False, ignore_str
             else:
                 cf_list = [False for _x in pdiff]
         else:
+            # entries that are only in one of the runs have a '---' pdiff
             if less_than:
-                cf_list = [False if x > limit else True for x in pdiff]
+                cf_list = [False if type(x) == str or x > limit else True for x in pdiff]
             else:
-                cf_list = [False if x < limit else True for x in pdiff]
-        if diff_only:
-            return
-        else:
-            diff_strct[keys[-1]]['CF'] = {'value': cf_list}
+                cf_list = [False if type(x) == str or x < limit else True for x in pdiff]
+        diff_strct[keys[-1]]['CF'] = {'value': cf_list}
 
 
-def __plot_timecomp__(diff, plot_timefile, mode='task_time', pldir1='pl1', pldir2='pl2'):
-    stages = [x for x in diff[0]['STAGE'].keys() if mode in x]
-    stagenames = [':'.join(x.split(':')[0:2]) for x in diff[0]['STAGE'].keys() if mode in x]
-    n_stages = len(stages)
-    n_pages = int(np.ceil(n_stages / 12))
-    with PdfPages(plot_timefile) as pdf:
-        idx = 0
-        ds = []
-        for page in range(n_pages):
-            fig, axs = plt.subplots(3, 4, figsize=(10, 8))
-            plt.subplots_adjust(left=0.08, bottom=0.08, right=0.98, top=0.96, wspace=0.2, hspace=0.25)
-            fig.text(0.52, 0.02, pldir1 + ' Time (s)', ha='center')
-            fig.text(0.02, 0.52, pldir2 + ' Time (s)', rotation=90, va='center')
-            for ax in axs.reshape(-1):
-                c_stage = stages[idx]
-                c_diff = [x['STAGE'][c_stage] for x in diff if c_stage in x['STAGE'].keys()]
-                x, y = [x['PL1'] for x in c_diff], [y['PL2'] for y in c_diff]
-                maxv, minv = np.max(x + y), np.min(x + y)
-                ax.plot(x, y, 'o', color='steelblue')
-                ax.plot([minv, maxv], [minv, maxv], ':', color='black')
-                ax.set_yscale('log')
-                ax.set_xscale('log')
-                ax.set_title(stagenames[idx], fontsize=10)
-                idx += 1
-                ds.append(([ty / tx for tx, ty in zip(x, y)],
-                           [ty / tx for tx, ty in zip(x, y) if np.abs(tx - ty) > 60],
-                           np.median(x)))
-            pdf.savefig()
-            plt.close()
-        for page in range(n_pages):
-            fig, ax = plt.subplots(1, 1, figsize=(16, 7))
-            plt.subplots_adjust(left=0.06, right=0.98, bottom=0.20, top=0.96)
-            ax.violinplot([x[0] for x in ds[int(page * 12): int((page + 1) * 12)]], showmedians=True, side='low')
-            ax.violinplot([x[1] if x[1] != [] else [1] for x in ds[int(page * 12): int((page + 1) * 12)]],
-                          showmedians=True, side='high')
-            ax.legend(handles=[plt.Rectangle((0, 0), 1, 1, fc='steelblue'), plt.Rectangle((0, 0), 1, 1, fc='orange')],
-                      labels=['All data', 'Data where difference is >60s'], loc='upper right')
-            ax.axhline(1, ls='--', color='black')
-            ax.set_xticks([y + 1 for y in range(12)], labels=stagenames[int(page * 12): int((page + 1) * 12)],
-                          rotation=60, ha='right')
-            ax.set_ylabel('Ratio of time {0} / {1}'.format(pldir2.split('/')[-1], pldir1.split('/')[-1]))
-            # ax.set_title('Violin plot per task for {}'.format(time))
-            ax.set_ylim(0, 4)
-            pdf.savefig()
-            plt.close()
-    return ds
+def __is_changed__(val1, val2, diff, limit):
+    # True if the difference is above the (relative) limit, or if the values differ when there is no difference
+    # ('---'). NaN values count as changed.
+    if type(diff) == str:
+        return diff != '---' or val1 != val2
+    elif type(diff) == list:
+        return any(__is_changed__(x, y, z, limit) for x, y, z in zip(val1, val2, diff))
+    if diff != diff:
+        return True
+    return abs(diff) > abs(limit) * abs(val1)
+
+
+def __plot_timecomp__(diff, plot_timefile, mode='task_time', pldir1='pl1', pldir2='pl2', n_procs=1):
+    from timingstats import TimingMatrix
+    from timingreport import render_timing_report
+    time1 = TimingMatrix.from_diffs(diff, mode=mode, pl='PL1')
+    time2 = TimingMatrix.from_diffs(diff, mode=mode, pl='PL2')
+    return render_timing_report(time1, time2, plot_timefile, pldir1=pldir1, pldir2=pldir2, n_procs=n_procs)
+
 
 def __image_strct__():
     image_strct = {'mfs_rms': {'PL1': {'value': ['---']}, 'PL2': {'value': '---'}, 'diff': {'value': '---'},
@@ -1,17 +1,18 @@
 import os
 import sys
-import glob
-from plstats import PLStats
-from comparestats import create_diff_dict
-from copy import deepcopy as dc
+import hashlib
+import multiprocessing
+from comparestats import compare_uidnames
+from tableengine import DiffTableEngine
+from tableview import TableView
 import numpy as np
-from matplotlib.backends.qt_compat import QtWidgets, QtCore, QtGui
+from matplotlib.backends.qt_compat import QtWidgets, QtCore
 from matplotlib.backends.backend_qtagg import FigureCanvas, NavigationToolbar2QT
 from matplotlib.figure import Figure
 import json
 
 
-class ApplicationWindow(QtWidgets.QWidget):
+class ApplicationWindow(TableView, QtWidgets.QWidget):
 
     def __init__(self, input1, uid_names=None):
         # overall image parameters of gui window
@@ -30,6 +31,7 @@ class ApplicationWindow(QtWidgets.QWidget):
         else:
             print('Assuming this is a directory with pipeline-stats and pipeline_suppl-stats files')
             self.load_cf(uid_names=uid_names)
+        self.tabledata = DiffTableEngine(self.statslist)
         # create the headers from the first stats file
         self.mousheaders = self.get_keywords(level='MOUS', ignore=['EB', 'SPW', 'TARGET', 'FLUX', 'STAGE'])
         self.ebheaders = self.get_keywords(level='EB')
@@ -73,7 +75,9 @@ class ApplicationWindow(QtWidgets.QWidget):
         self.init_ui()
         self.new_window = []
         # populate the table to its initial state
-        self.model = QtGui.QStandardItemModel(0, 0)
+        self.model = None
+        self.tablelevel = None
+        self.tablecolumns = []
         self.reset_data()
 
     def init_ui(self):
@@ -166,54 +170,27 @@ class ApplicationWindow(QtWidgets.QWidget):
     def update_perxtable(self, xval, n_x, n_xheadsel, x_list):
         raise NotImplementedError('need to implement this')
 
+    def update_moustable(self):
+        self.show_table('MOUS', self.mousheadsel, [])
+
     def update_imagetable(self):
-        rowlength = 0
-        for x in self.newstatslist:
-            n_targets = len(list(x['TARGET'].keys())) - 1
-            first_target = list([y for y in x['TARGET'].keys() if y != 'CF'])[0]
-            n_sciencespw = len(list(x['TARGET'][first_target]['SPW'].keys()))
-            rowlength += n_targets * n_sciencespw
-        columnlength = len(self.imageheadsel) + len(self.mousheadsel) + 3
-        firstmousdict = self.newstatslist[0]['MOUS']
-        headers = ['mous_uid (str)', 'TARGET (str)', 'SPW (str)']
-        header2 = ([x + ' (' + str(type(firstmousdict[x]['PL1']['value']))[8:-2] + ')' for x in self.mousheadsel] +
-                   [x + ' (bool)' for x in self.imageheadsel])
-        headers.extend(header2)
-        self.model = QtGui.QStandardItemModel(rowlength, columnlength)
-        self.model.setHorizontalHeaderLabels(headers)
-        self.nrows_label.setText('Number of rows: {}'.format(rowlength))
-        rownumber = 0
-        for diff_strct in self.newstatslist:
-            for target in diff_strct['TARGET']:
-                for spw in diff_strct['TARGET'][target]['SPW']:
-                    __set_data__(self.model, diff_strct['MOUS']['mous_uid']['PL1']['value'], rownumber, 0)
-                    __set_data__(self.model, target, rownumber, 1)
-                    __set_data__(self.model, spw, rownumber, 2)
-                    for idx1, z1 in enumerate(self.mousheadsel):
-                        if z1 == 'manual_flags':
-                            __set_data__(self.model, str(diff_strct['MOUS'][z1]['PL2']['value']), rownumber, idx1 + 3)
-                        else:
-                            __set_data__(self.model, str(diff_strct['MOUS'][z1]['PL1']['value']), rownumber, idx1 + 3)
-                    for idx2, z2 in enumerate(self.imageheadsel):
-                        cf_value = (np.any(diff_strct['TARGET'][target]['SPW'][spw][z2]['CF']['value'])
-                                    if diff_strct['TARGET'][target]['SPW'][spw][z2]['CF']['value'] != [] else '')
-                        __set_data__(self.model, str(cf_value), rownumber, len(self.mousheadsel) + idx2 + 3)
-                    rownumber += 1
-        self.update_tableview()
+        self.show_table('IMAGE', self.mousheadsel, self.imageheadsel)
 
-    def update_tableview(self):
+    def update_tableview(self, model):
         proxy = QtCore.QSortFilterProxyModel()
-        proxy.setSourceModel(self.model)
+        proxy.setSourceModel(model)
         self.tableview.setModel(proxy)
         self.tableview.resizeColumnsToContents()
         self.tableview.horizontalHeader().setStretchLastSection(True)
-        for x in range(self.model.columnCount()):
+        for x in range(model.columnCount()):
             if self.tableview.columnWidth(x) > 300:
                 self.tableview.setColumnWidth(x, 300)
         self.tableview.setSortingEnabled(False)
 
     def reset_data(self):
-        self.newstatslist = dc(self.statslist)
+        self.tabledata.reset()
+        self.newstatslist = list(self.statslist)
+        self.model, self.tablelevel, self.tablecolumns = None, None, []
         self.mousheadsel = []
         self.ebheadsel = []
         self.spwheadsel = []
@@ -232,6 +209,11 @@ class ApplicationWindow(QtWidgets.QWidget):
     def on_cell_clicked(self, index):
         row = index.row()
         column = index.column()
+        text = self.model.itemFromIndex(self.model.index(row, column)).text().replace('",', '"\n')
+        self.expandcell.setText(text)
+        # only the rows of the IMAGE table have a target and spw (in the second and third column)
+        if self.tablelevel != 'IMAGE':
+            return
         mous_uid = self.model.itemFromIndex(self.model.index(row, 0)).text()
         target = self.model.itemFromIndex(self.model.index(row, 1)).text()
         spw = self.model.itemFromIndex(self.model.index(row, 2)).text()
@@ -241,36 +223,32 @@ class ApplicationWindow(QtWidgets.QWidget):
             if 'manual_flags' in self.model.horizontalHeaderItem(c).text():
                 manual_flags = self.model.itemFromIndex(self.model.index(row, c)).text()
                 break
-        text = self.model.itemFromIndex(self.model.index(row, column)).text().replace('",', '"\n')
-        self.expandcell.setText(text)
-        if ('rms' in image) or ('max' in image) or ('snr' in image):
+        # images without values (missing, or the empty placeholders of __image_strct__) are not plotted
+        images = self.statslist[self.tabledata.positions[mous_uid]]['TARGET'][target]['SPW'][spw]
+        if image in images and images[image]['CF']['value'] != [] and \
+                (('rms' in image) or ('max' in image) or ('snr' in image)):
             print(target, spw, image, manual_flags)
-            diff_dict = [x for x in self.newstatslist if x['MOUS']['mous_uid']['PL1']['value'] == mous_uid][0]
-            diff_strct = diff_dict['TARGET'][target]['SPW'][spw][image]
+            diff_strct = images[image]
             self.new_window = PlotWindow(diff_strct, image, manual_flags)
             self.new_window.show()
 
-    def load_cf(self, uid_names=None):
-        if type(uid_names) == str:
-            uid_names = [uid_names]
-        if uid_names is None:
-            uid_names = np.unique([x.split('___')[-1].split('-')[0] + '-'
-                                   for x in glob.glob(self.input1 + '/pipeline_stats*')])
-        for uid_name in uid_names:
-            print(uid_name)
-            pl1 = PLStats.from_uidname(uid_name, searchdir=self.input1, index=0)
-            pl2 = PLStats.from_uidname(uid_name, searchdir=self.input1, index=-1)
-            diff = create_diff_dict(pl1, pl2)
-            self.statslist.append(diff)
+    def load_cf(self, uid_names=None, n_procs=None, cachefile=None):
+        # the diff dictionaries are made in worker processes and cached in the user cache directory (see
+        # __get_cachefile__), so that reopening the same directory only compares the uid names whose files changed
+        if n_procs is None:
+            n_procs = os.cpu_count() or 1
+        if cachefile is None:
+            cachefile = __get_cachefile__(self.input1)
+        # the worker processes are spawned, a forked copy of the process with the running QApplication can deadlock
+        self.statslist = compare_uidnames(self.input1, uid_names=uid_names, n_procs=n_procs, cachefile=cachefile,
+                                          mp_context=multiprocessing.get_context('spawn'))
         if len(self.statslist) == 0:
             raise IOError('No json stat files found in: {}'.format(self.input1))
-        self.newstatslist = dc(self.statslist)
         print('Done loading the diff structure')
 
     def load_json(self):
         with open(self.input1, 'r') as file:
             self.statslist = json.load(file)
-            self.newstatslist = dc(self.statslist)
 
     def get_keywords(self, level, ignore=None):
         if level == 'IMAGE':
@@ -289,19 +267,6 @@ class ApplicationWindow(QtWidgets.QWidget):
                     keywords.pop(keywords.index(ignore))
         return keywords
 
-def __set_data__(model, obj, row, col):
-    newitem = QtGui.QStandardItem()
-    if type(obj) == str:
-        newitem.setData(obj, QtCore.Qt.DisplayRole)
-    elif type(obj) == dict:
-        if 'value' in obj.keys():
-            newitem.setData(str(obj['value']), QtCore.Qt.DisplayRole)
-        else:
-            newitem.setData(str(obj), QtCore.Qt.DisplayRole)
-    else:
-        raise IOError('{}-type is not defined in __set_data__'.format(type(obj)))
-    model.setItem(row, col, newitem)
-
 class PlotWindow(QtWidgets.QMainWindow):
     def __init__(self, diff_strct, image, manual_flags):
         super().__init__()
@@ -327,6 +292,15 @@ class PlotWindow(QtWidgets.QMainWindow):
         # toolbar as a plain widget instead.
 
 
+def __get_cachefile__(directory):
+    # cache file of the diff dictionaries of a stats directory, in the user cache directory ($XDG_CACHE_HOME or
+    # ~/.cache) rather than in the (possibly shared or read-only) data directory
+    cachedir = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'plstats')
+    os.makedirs(cachedir, exist_ok=True)
+    key = hashlib.sha1(os.path.abspath(directory).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cachedir, 'comparestats_diffs_{}.json.gz'.format(key))
+
+
 def main():
     qapp = QtWidgets.QApplication(['1'])
     if len(sys.argv) == 1:
@@ -0,0 +1,175 @@
+# code to calculate statistics over the per-channel image comparisons (rms, max and snr, see
+# comparestats.create_diff_dict) of many MOUSes. All channels of all images are concatenated into flat arrays, with
+# index arrays that give the MOUS, target, spw, image type and channel of each element, so that group-by statistics
+# and histograms are single vectorized calls instead of loops over the nested diff dictionaries.
+import numpy as np
+
+
+class ImageDiffStats:
+    """
+    Flat arrays of the per-channel image entries of a list of diff dictionaries. The values (PL1, PL2, diff, pdiff)
+    are floats (NaN if missing or not a number) and CF is boolean. The index arrays mous, target, spw and imtype are
+    codes into the label lists self.labels[x] (e.g., self.labels['imtype'][self.imtype[i]] is 'cube_rms'), and
+    channel is the channel number within the image.
+    """
+    indices = ['mous', 'target', 'spw', 'imtype']
+    columns = ['PL1', 'PL2', 'diff', 'pdiff']
+
+    def __init__(self):
+        self.labels = {x: [] for x in self.indices}
+        self.arrays = {x: np.zeros(0, dtype=int) for x in self.indices + ['channel']}
+        self.arrays.update({x: np.zeros(0) for x in self.columns})
+        self.arrays['CF'] = np.zeros(0, dtype=bool)
+
+    def __getattr__(self, name):
+        # the arrays can be used as attributes, e.g., self.pdiff
+        if name != 'arrays' and name in self.arrays:
+            return self.arrays[name]
+        raise AttributeError(name)
+
+    def __len__(self):
+        return len(self.arrays['channel'])
+
+    @classmethod
+    def from_diffs(cls, diffs):
+        """
+        Collects the per-channel image entries of a list of diff dictionaries (see comparestats.create_diff_dict).
+        Image entries that are missing in both pipeline runs (the placeholders of create_diff_dict) are skipped.
+        """
+        self = cls()
+        codes = {x: {} for x in self.indices}
+        chunks = {x: [] for x in self.arrays}
+        for idx, diff in enumerate(diffs):
+            mous = diff['MOUS']['mous_uid']['PL1']['value'] if 'mous_uid' in diff.get('MOUS', {}) else str(idx)
+            for target in diff.get('TARGET', {}):
+                for spw in diff['TARGET'][target].get('SPW', {}):
+                    for imtype, entry in diff['TARGET'][target]['SPW'][spw].items():
+                        if not isinstance(entry, dict) or 'PL1' not in entry:
+                            continue
+                        values = [__to_array__(entry[x]['value']) for x in self.columns]
+                        n_channels = max(len(x) for x in values)
+                        if n_channels == 0 or not (np.any(np.isfinite(values[0])) or np.any(np.isfinite(values[1]))):
+                            continue
+                        for column, value in zip(self.columns, values):
+                            chunks[column].append(__pad__(value, n_channels, np.nan))
+                        cf = entry['CF']['value'] if 'CF' in entry else False
+                        chunks['CF'].append(__pad__(np.asarray(cf if type(cf) == list else [cf] * n_channels,
+                                                               dtype=bool), n_channels, False))
+                        for index, label in zip(self.indices, [mous, target, spw, imtype]):
+                            code = codes[index].setdefault(label, len(codes[index]))
+                            chunks[index].append(np.full(n_channels, code, dtype=int))
+                        chunks['channel'].append(np.arange(n_channels))
+        self.labels = {x: list(codes[x].keys()) for x in self.indices}
+        for key in chunks:
+            if chunks[key]:
+                self.arrays[key] = np.concatenate(chunks[key])
+        return self
+
+    def get_mask(self, **selection):
+        """
+        Boolean mask of the elements that match the selection, e.g., get_mask(imtype='cube_rms', spw=['25', '27']).
+        Selections on the index arrays are labels (or lists of labels), selections on channel are numbers.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for key, value in selection.items():
+            values = value if type(value) in [list, tuple] else [value]
+            if key in self.indices:
+                values = [self.labels[key].index(x) for x in values if x in self.labels[key]]
+            mask &= np.isin(self.arrays[key], values)
+        return mask
+
+    def groupby(self, by, column='pdiff', stat='mean', mask=None):
+        """
+        Statistic of a column for each group.
+        :param by: index (mous, target, spw, imtype or channel) or list of indices to group on
+        :param column: PL1, PL2, diff, pdiff or CF (the mean of CF is the fraction of flagged channels)
+        :param stat: count, sum, mean, median, min, max or std; NaN values are ignored
+        :param mask: boolean mask of the elements to use (see get_mask)
+        :return: dictionary with the labels of the groups (tuples if grouped on more than one index), the statistic
+        and the number of (finite) values of each group; groups without any element are left out
+        """
+        by = [by] if type(by) == str else list(by)
+        values = self.arrays[column].astype(float)
+        valid = np.isfinite(values) if mask is None else np.isfinite(values) & mask
+        sizes = [len(self.labels[x]) if x in self.indices else int(np.max(self.arrays[x], initial=-1)) + 1
+                 for x in by]
+        groups = np.ravel_multi_index([self.arrays[x][valid] for x in by], sizes) if len(sizes) > 0 else \
+            np.zeros(np.sum(valid), dtype=int)
+        values = values[valid]
+        n_groups = int(np.prod(sizes))
+        count = np.bincount(groups, minlength=n_groups)
+        if stat in ['count', 'sum', 'mean', 'std']:
+            total = np.bincount(groups, weights=values, minlength=n_groups)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean = total / count
+                result = {'count': count.astype(float), 'sum': total, 'mean': mean}.get(stat)
+                if stat == 'std':
+                    result = np.sqrt(np.bincount(groups, weights=(values - mean[groups]) ** 2,
+                                                 minlength=n_groups) / count)
+        elif stat in ['median', 'min', 'max']:
+            order = np.lexsort((values, groups))
+            values, starts = values[order], np.concatenate([[0], np.cumsum(count)[:-1]])
+            result = np.full(n_groups, np.nan)
+            filled = count > 0
+            if stat == 'min':
+                result[filled] = values[starts[filled]]
+            elif stat == 'max':
+                result[filled] = values[starts[filled] + count[filled] - 1]
+            else:
+                result[filled] = (values[starts[filled] + (count[filled] - 1) // 2] +
+                                  values[starts[filled] + count[filled] // 2]) / 2
+        else:
+            raise ValueError('groupby: unknown statistic {}'.format(stat))
+        present = np.nonzero(count)[0]
+        labels = [tuple(self.__get_label__(x, code) for x, code in zip(by, codes))
+                  for codes in zip(*np.unravel_index(present, sizes))]
+        return {'groups': [x[0] if len(by) == 1 else x for x in labels], stat: result[present],
+                'n': count[present]}
+
+    def histogram(self, column='pdiff', bins=50, value_range=None, by=None, mask=None):
+        """
+        Histogram of a column, for all elements or for each group.
+        :param column: PL1, PL2, diff or pdiff
+        :param bins: number of bins or bin edges, see numpy.histogram
+        :param value_range: range of the histogram, default is the range of the (finite) values
+        :param by: if set, an index (e.g., imtype) to make a histogram for each of its labels
+        :param mask: boolean mask of the elements to use (see get_mask)
+        :return: tuple of the counts (an array of shape (number of labels, number of bins) if by is set) and the bin
+        edges
+        """
+        values = self.arrays[column].astype(float)
+        valid = np.isfinite(values) if mask is None else np.isfinite(values) & mask
+        edges = np.histogram_bin_edges(values[valid], bins=bins, range=value_range)
+        if by is None:
+            return np.histogram(values[valid], bins=edges)[0], edges
+        n_bins, n_labels = len(edges) - 1, len(self.labels[by]) if by in self.indices else \
+            int(np.max(self.arrays[by], initial=-1)) + 1
+        bin_idx = np.clip(np.searchsorted(edges, values[valid], side='right') - 1, 0, n_bins - 1)
+        inrange = (values[valid] >= edges[0]) & (values[valid] <= edges[-1])
+        counts = np.bincount(self.arrays[by][valid][inrange] * n_bins + bin_idx[inrange],
+                             minlength=n_labels * n_bins)
+        return counts.reshape(n_labels, n_bins), edges
+
+    def __get_label__(self, index, code):
+        return self.labels[index][code] if index in self.indices else int(code)
+
+
+def __to_array__(value):
+    # list (or single value) to a float array, with NaN for the entries that are not numbers (e.g., '---')
+    values = value if type(value) == list else [value]
+    try:
+        return np.asarray(values, dtype=float)
+    except (TypeError, ValueError):
+        array = np.full(len(values), np.nan)
+        for idx, x in enumerate(values):
+            try:
+                array[idx] = float(x)
+            except (TypeError, ValueError):
+                continue
+        return array
+
+
+def __pad__(array, n, fill):
+    if len(array) >= n:
+        return array[:n]
+    return np.concatenate([array, np.full(n - len(array), fill, dtype=array.dtype)])
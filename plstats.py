@@ -1,17 +1,23 @@
 # code to read in the stats of a pipeline directory and provide manipulation of this data.
 # ideally the code would take info only from stats file, but for know allow other inputs
 import json
+import hashlib
 from aquareport import load_aquareport
+from prefetch import open_file, file_exists
 # from tables import load_tables
 import glob
-import numpy as np
+import fnmatch
 import os.path
 
 
 class PLStats:
+    sections = ['MOUS', 'EB', 'SPW', 'TARGET', 'STAGE', 'FLUX']
+    # keywords that differ between any two pipeline runs (timing and versions), these are hashed separately
+    run_keys = ['total_time', 'task_time', 'result_time', 'casa_version', 'pipeline_version']
+
     @classmethod
-    def from_statsfile(cls, statsfile, suppl_statsfile=None):
-        tempjson = json.load(open(statsfile, 'r'))
+    def from_statsfile(cls, statsfile, suppl_statsfile=None, files=None, summarize=True):
+        tempjson = json.load(open_file(statsfile, files=files))
         self = cls()
         self.statsfile = statsfile
         self.statsheader = tempjson['header']
@@ -24,19 +30,23 @@ class PLStats:
         self.mous['spw_list'] = {'value': list(self.get_keywords(level='SPW', return_sublevel=False))}
         if suppl_statsfile is None:
             suppl_statsfile = statsfile.replace('pipeline_stats_', 'pipeline-suppl_stats_')
-        if os.path.isfile(suppl_statsfile):
+        if file_exists(suppl_statsfile, files=files):
             self.suppl_statsfile = suppl_statsfile
-            self.__mergedict__(json.load(open(self.suppl_statsfile, 'r')))
+            self.__mergedict__(json.load(open_file(self.suppl_statsfile, files=files)))
             self.analyze_stats()
         else:
             print('Suppl_statsfile was not used for {}'.format(statsfile))
+        if summarize:
+            self.summarize()
         return self
 
     @classmethod
-    def from_aquareport(cls, arfile, timefile=None):
+    def from_aquareport(cls, arfile, timefile=None, files=None, summarize=True):
         self = cls()
         self.arfile = arfile
-        self.mous = load_aquareport(arfile, timefile=timefile)
+        self.mous = load_aquareport(arfile, timefile=timefile, files=files)
+        if summarize:
+            self.summarize()
         return self
 
     # @classmethod
@@ -47,51 +57,84 @@ class PLStats:
     #     return self
 
     @classmethod
-    def from_workingdir(cls, workdir, use_statsfile=True, use_arfile=True, use_tables=False, use_timefile=True):
+    def from_workingdir(cls, workdir, use_statsfile=True, use_arfile=True, use_tables=False, use_timefile=True,
+                        files=None, workdirfiles=None):
         self = cls()
         self.workdir = workdir
-        self.statsfile = glob.glob(workdir + '/pipeline_stats_*.json')[0].split('/')[-1]
+        if workdirfiles is None:
+            workdirfiles = self.get_workdirfiles(workdir)
+        self.statsfile = workdirfiles['statsfile'].split('/')[-1]
         if self.statsfile and use_statsfile:
-            self.__mergedict__(self.from_statsfile(self.workdir + '/' + self.statsfile).mous)
-        self.arfile = glob.glob(workdir + '/pipeline_aquareport.xml')[0].split('/')[-1]
+            self.__mergedict__(self.from_statsfile(self.workdir + '/' + self.statsfile, files=files,
+                                                   summarize=False).mous)
+        self.arfile = workdirfiles['arfile'].split('/')[-1]
         if self.arfile and use_arfile:
-            tlist = glob.glob(workdir + '/pipeline-*.timetracker.json')
-            tlist.sort()
-            self.timefile = tlist[-1]
-            if self.timefile and use_timefile:
-                self.__mergedict__(self.from_aquareport(self.workdir + '/' + self.arfile, timefile=self.timefile).mous)
-            elif self.timefile and not use_timefile:
-                self.__mergedict__(self.from_aquareport(self.workdir + '/' + self.arfile).mous)
+            self.timefile = workdirfiles['timefile']
+            # without a timetracker file the aquareport is merged without the timing information
+            self.__mergedict__(self.from_aquareport(self.workdir + '/' + self.arfile,
+                                                    timefile=self.timefile if use_timefile else None,
+                                                    files=files, summarize=False).mous)
         self.tablelist = [x.split('/')[-1] for x in glob.glob(workdir + '/*.tbl')]
         if self.tablelist and use_tables:
             pass
         #     self.__mergedict__(self.from_tablelist([self.workdir + '/' + x for x in self.tablelist]).mous)
+        self.summarize()
         return self
 
     @classmethod
-    def from_uidname(cls, uid_name, searchdir='.', index=0):
+    def from_uidname(cls, uid_name, searchdir='.', index=0, files=None, filelist=None):
         self = cls()
-        uid_list = glob.glob(searchdir + '/pipeline_stats_*.json')
-        all_uid = sorted([x for x in uid_list if uid_name in x])
-        self.statsfile = all_uid[index]
-        self.__mergedict__(self.from_statsfile(self.statsfile).mous)
-        uid_supplist = glob.glob(searchdir + '/pipeline_aquareport-*.xml')
-        ar_file = self.statsfile.replace('pipeline_stats_', 'pipeline_aquareport-')
-        ar_file = ar_file.replace('json', 'xml')
-        self.arfile = ar_file if ar_file in uid_supplist else ''
+        uidfiles = self.get_uidfiles(uid_name, searchdir=searchdir, index=index, filelist=filelist)
+        self.statsfile = uidfiles['statsfile']
+        self.suppl_statsfile = uidfiles['suppl_statsfile']
+        # the suppl. stats are merged (and analyzed) by from_statsfile, the summary is made of the merged dictionary
+        self.__mergedict__(self.from_statsfile(self.statsfile, suppl_statsfile=self.suppl_statsfile or None,
+                                               files=files, summarize=False).mous)
+        self.arfile = uidfiles['arfile']
         if self.arfile != '':
-            self.__mergedict__(self.from_aquareport(self.arfile).mous)
-        uid_supplist = glob.glob(searchdir + '/pipeline-suppl_stats_*.json')
-        suppl_file = self.statsfile.replace('pipeline', 'pipeline-suppl')
-        self.suppl_statsfile = suppl_file if suppl_file in uid_supplist else ''
-        if self.suppl_statsfile != '':
-            self.__mergedict__(json.load(open(self.suppl_statsfile, 'r')))
-            self.analyze_stats()
+            self.__mergedict__(self.from_aquareport(self.arfile, files=files, summarize=False).mous)
+        self.summarize()
         return self
 
+    @staticmethod
+    def get_uidfiles(uid_name, searchdir='.', index=0, filelist=None):
+        """
+        The stats, aquareport and suppl. stats files that from_uidname will read for the given uid name and index.
+        The aquareport and suppl. stats file names are empty strings if they do not exist. If filelist is given, it
+        is used as the list of files in searchdir instead of globbing the directory (for scans over many uid names).
+        """
+        if filelist is None:
+            filelist = glob.glob(searchdir + '/pipeline*')
+        uid_list = fnmatch.filter(filelist, searchdir + '/pipeline_stats_*.json')
+        all_uid = sorted([x for x in uid_list if uid_name in x])
+        statsfile = all_uid[index]
+        ar_list = fnmatch.filter(filelist, searchdir + '/pipeline_aquareport-*.xml')
+        ar_file = statsfile.replace('pipeline_stats_', 'pipeline_aquareport-')
+        ar_file = ar_file.replace('json', 'xml')
+        suppl_list = fnmatch.filter(filelist, searchdir + '/pipeline-suppl_stats_*.json')
+        suppl_file = statsfile.replace('pipeline', 'pipeline-suppl')
+        return {'statsfile': statsfile, 'arfile': ar_file if ar_file in ar_list else '',
+                'suppl_statsfile': suppl_file if suppl_file in suppl_list else ''}
+
+    @staticmethod
+    def get_workdirfiles(workdir):
+        """
+        The stats, aquareport, timetracker and suppl. stats files that from_workingdir will read for the given
+        working directory. The timetracker and suppl. stats file names are empty strings if they do not exist.
+        """
+        statsfile = glob.glob(workdir + '/pipeline_stats_*.json')[0]
+        arfile = glob.glob(workdir + '/pipeline_aquareport.xml')[0]
+        tlist = glob.glob(workdir + '/pipeline-*.timetracker.json')
+        tlist.sort()
+        suppl_statsfile = statsfile.replace('pipeline_stats_', 'pipeline-suppl_stats_')
+        return {'statsfile': statsfile, 'arfile': arfile, 'timefile': tlist[-1] if tlist else '',
+                'suppl_statsfile': suppl_statsfile if os.path.isfile(suppl_statsfile) else ''}
+
     def get_keywords(self, level='MOUS', return_sublevel=True, ignore=None):
         if level == 'MOUS':
             keywords = list(self.mous.keys())
+        elif level == 'SUMMARY':
+            keywords = list(self.summary.keys())
         else:
             if level not in self.mous.keys():
                 return []
@@ -118,6 +161,13 @@ class PLStats:
             level = self.__get_level__(key)
             if level == 'N/A':
                 return {}
+        if level == 'SUMMARY':
+            if key not in self.summary or self.summary['mous_uid'] is None:
+                return {}
+            value = self.summary[key]
+            if subkey and type(value) == dict:
+                value = value.get(subkey)
+            return {'|'.join([self.summary['mous_uid'], 'SUMMARY', key]): value if value_only else {'value': value}}
         if key in self.mous and level == 'MOUS':
             if value_only:
                 try:
@@ -154,37 +204,116 @@ class PLStats:
         return values
 
     def analyze_stats(self):
-        self.mous['manual_flags'] = {'value': []}
-        for eb in self.mous['EB']:
-            n_manualflags = len(self.mous['EB'][eb]['flagdata_manual_flags']['value'])
-            self.mous['EB'][eb]['n_manualflags'] = {'value': n_manualflags}
-            pereb_flags = ["eb='" + eb + "' " + x for x in self.mous['EB'][eb]['flagdata_manual_flags']['value']]
-            self.mous['manual_flags']['value'].extend(pereb_flags)
-        for target in self.mous['TARGET']:
+        manual_flags = []
+        for eb in self.mous.get('EB', {}):
+            if 'flagdata_manual_flags' not in self.mous['EB'][eb]:
+                continue
+            flags = self.mous['EB'][eb]['flagdata_manual_flags']['value']
+            self.mous['EB'][eb]['n_manualflags'] = {'value': len(flags)}
+            manual_flags.extend("eb='{0}' {1}".format(eb, x) for x in flags)
+        self.mous['manual_flags'] = {'value': manual_flags}
+        mous_images = 0
+        for target in self.mous.get('TARGET', {}):
+            target_images = 0
             for spw in self.mous['TARGET'][target]:
-                n_images = len([x for x in self.mous['TARGET'][target][spw].keys() if 'rms' in x])
+                if spw == 'SPW' or 'value' in self.mous['TARGET'][target][spw]:
+                    continue
+                n_images = sum('rms' in x for x in self.mous['TARGET'][target][spw] if x != 'n_images')
                 self.mous['TARGET'][target][spw]['n_images'] = {'value': n_images}
-            n_images = np.sum([self.mous['TARGET'][target][spw]['n_images']['value']
-                               for spw in self.mous['TARGET'][target]])
-            self.mous['TARGET'][target]['n_images'] = {'value': n_images}
-        n_images = np.sum([self.mous['TARGET'][target]['n_images']['value']
-                           for target in self.mous['TARGET']])
-        self.mous['n_images'] = {'value': int(n_images)}
+                target_images += n_images
+            self.mous['TARGET'][target]['n_images'] = {'value': target_images}
+            mous_images += target_images
+        self.mous['n_images'] = {'value': mous_images}
+
+    def summarize(self):
+        """
+        Builds the summary record of the MOUS: a flat dictionary with a fixed set of aggregates (counts, flag totals,
+        worst rms per target, time per stage, etc.) that is computed once at load time, so that filtering and the GUIs
+        do not need to walk the nested mous dictionary. Missing information is set to None. The summary keys can be
+        used as keywords of level 'SUMMARY' in get_keywords and get_values.
+        """
+        eb, target, stage = self.mous.get('EB', {}), self.mous.get('TARGET', {}), self.mous.get('STAGE', {})
+        flags = [len(eb[x]['flagdata_manual_flags']['value']) for x in eb if 'flagdata_manual_flags' in eb[x]]
+        worst_rms = {}
+        for t in target:
+            rms = [__get_floats__(target[t][spw][x]['value']) for spw in target[t]
+                   if spw != 'SPW' and 'value' not in target[t][spw] for x in target[t][spw] if x.endswith('_rms')]
+            rms = [x for y in rms for x in y]
+            worst_rms[t] = max(rms) if rms else None
+        stage_time = {x: sum(__get_floats__(stage[x]['total_time']['value'])) if 'total_time' in stage[x] else None
+                      for x in stage}
+        times = [x for x in stage_time.values() if x is not None]
+        qa_scores = [x for y in stage if 'qa_score' in stage[y] for x in __get_floats__(stage[y]['qa_score']['value'])]
+        self.summary = {'mous_uid': self.mous['mous_uid']['value'] if 'mous_uid' in self.mous else None,
+                        'n_eb': len(eb), 'n_spw': len(self.mous.get('SPW', {})), 'n_target': len(target),
+                        'n_stages': len(stage),
+                        'n_images': self.mous['n_images']['value'] if 'n_images' in self.mous else None,
+                        'n_manualflags': sum(flags) if flags else None,
+                        'worst_rms': worst_rms,
+                        'max_rms': max([x for x in worst_rms.values() if x is not None], default=None),
+                        'stage_time': stage_time,
+                        'total_stage_time': sum(times) if times else None,
+                        'min_qa_score': min(qa_scores) if qa_scores else None}
+        return self.summary
+
+    def get_hashes(self, update=False):
+        """
+        Content hashes of the sections of the MOUS (see PLStats.sections), to quickly find out which sections of two
+        PLStats objects differ. Each hash is the sha1 digest of the canonical (sorted keys, compact) JSON of the
+        section, where the MOUS section consists of the MOUS level keywords only. The hash of a section that is not
+        present is None. The run dependent keywords (see PLStats.run_keys) are left out of the section hashes, as
+        they would make the sections of any two pipeline runs differ, and are hashed together as the extra entry
+        'RUN'. The hashes are calculated on the first call (or when update is set) and stored in self.hashes, so they
+        should be updated if self.mous is changed afterwards.
+        """
+        if update or not self.hashes:
+            mous = {x: self.mous[x] for x in self.mous if x not in self.sections}
+            run = {}
+            self.hashes = {x: __get_hash__(__strip_keys__(mous if x == 'MOUS' else self.mous[x], self.run_keys, run,
+                                                          path=x + ':'))
+                           if x == 'MOUS' or x in self.mous else None for x in self.sections}
+            self.hashes['RUN'] = __get_hash__(run)
+        return self.hashes
+
+    def get_changed_sections(self, other):
+        """
+        List of the sections (see get_hashes) that differ between this and the other PLStats object. Differences in
+        the run dependent keywords only (timing and versions) are not counted.
+        """
+        hashes1, hashes2 = self.get_hashes(), other.get_hashes()
+        return [x for x in self.sections if hashes1[x] != hashes2[x]]
 
     def __init__(self):
         self.mous = {}
+        self.summary = {}
+        self.hashes = {}
 
-    def __mergedict__(self, b: dict, a=None, path=None):
-        if not a:
+    def __mergedict__(self, b: dict, a=None, conflicts=None):
+        """
+        Merges dictionary b into dictionary a (self.mous by default). Keys of b that are not in a are added by
+        reference, i.e., whole subtrees are adopted without walking or copying them, so b should not be used after the
+        merge. If self.mous is still empty, b itself is adopted. The values in a take precedence over those in b.
+        :param b: dictionary to merge
+        :param a: dictionary to merge into, self.mous if not set
+        :param conflicts: if set to a list, the key paths (tuples) of values that differ between a and b are appended
+        :return: conflicts
+        """
+        if a is None:
+            if not self.mous:
+                self.mous = b
+                return conflicts
             a = self.mous
-        if path is None:
-            path = []
-        for key in b:
-            if key in a.keys():
-                if isinstance(a[key], dict) and isinstance(b[key], dict):
-                    self.__mergedict__(b[key], a=a[key], path=path + [str(key)])
-            else:
-                a[key] = b[key]
+        stack = [(a, b, ())]
+        while stack:
+            a, b, path = stack.pop()
+            for key in b:
+                if key not in a:
+                    a[key] = b[key]
+                elif isinstance(a[key], dict) and isinstance(b[key], dict):
+                    stack.append((a[key], b[key], path + (key,) if conflicts is not None else path))
+                elif conflicts is not None and a[key] != b[key]:
+                    conflicts.append(path + (key,))
+        return conflicts
 
     def __get_level__(self, key):
         if key in self.get_keywords(level='MOUS'):
@@ -197,10 +326,45 @@ class PLStats:
             return 'TARGET'
         elif key in self.get_keywords(level='STAGE'):
             return 'STAGE'
+        elif key in self.summary:
+            return 'SUMMARY'
         else:
             return 'N/A'
 
 
+def __get_floats__(value):
+    # the numeric entries of a stats value (a number, a string or a list of these), skipping NaN and 'None'
+    values = []
+    for x in value if type(value) == list else [value]:
+        try:
+            x = float(x)
+        except (TypeError, ValueError):
+            continue
+        if x == x:
+            values.append(x)
+    return values
+
+
+def __strip_keys__(obj, keys, removed, path=''):
+    # copy of a nested dictionary without the given keys, the values of which are collected in removed by key path
+    if type(obj) != dict:
+        return obj
+    stripped = {}
+    for key, value in obj.items():
+        if key in keys:
+            removed[path + key] = value
+        else:
+            stripped[key] = __strip_keys__(value, keys, removed, path=path + key + ':')
+    return stripped
+
+
+def __get_hash__(section):
+    # numpy scalars are hashed as the equivalent python numbers, as they are stored in json files and the catalog
+    text = json.dumps(section, sort_keys=True, separators=(',', ':'),
+                      default=lambda x: x.item() if hasattr(x, 'item') else str(x))
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
 def findkeys(node, kv):
     if isinstance(node, list):
         for i in node:
@@ -0,0 +1,169 @@
+# code to keep a local (sqlite) catalog of the PLStats objects of one or more stats directories, which is updated
+# incrementally and can be queried on indexed MOUS level keywords.
+import glob
+import fnmatch
+import json
+import os
+import sqlite3
+from plstats import PLStats
+from plstatslist import get_uidnames, passes_criterion
+
+
+class PLStatsCatalog:
+    # MOUS level keywords that get their own (indexed) column in the catalog
+    columns = ['mous_uid', 'proposal_code', 'pipeline_version', 'pipeline_recipe', 'casa_version', 'n_images',
+               'n_EB', 'n_spw', 'n_target']
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.db = sqlite3.connect(dbfile)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS mous (statsfile TEXT PRIMARY KEY, searchdir TEXT, uid_name TEXT,
+                run_index INTEGER, n_runs INTEGER, signature TEXT, arfile TEXT, suppl_statsfile TEXT, record TEXT,
+                hashes TEXT, summary TEXT, {0});
+            CREATE INDEX IF NOT EXISTS idx_searchdir ON mous (searchdir, run_index, n_runs);
+            {1}
+        '''.format(', '.join(self.columns),
+                   '\n'.join('CREATE INDEX IF NOT EXISTS idx_{0} ON mous ({0});'.format(x) for x in self.columns)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def update(self, directory):
+        """
+        Parses the stats files of the directory that are new or changed since the last update, and removes the
+        entries of stats files that no longer exist.
+        :param directory: directory with the pipeline_stats (and aquareport and suppl. stats) files
+        :return: tuple with the number of new, changed and removed entries
+        """
+        searchdir = directory
+        filelist = glob.glob(searchdir + '/pipeline*')
+        known = dict(self.db.execute('SELECT statsfile, signature FROM mous WHERE searchdir = ?', (searchdir,)))
+        n_new, n_changed, seen = 0, 0, set()
+        for uid_name in get_uidnames(searchdir):
+            statsfiles = [x for x in fnmatch.filter(filelist, searchdir + '/pipeline_stats_*.json') if uid_name in x]
+            for run_index in range(len(statsfiles)):
+                uidfiles = PLStats.get_uidfiles(uid_name, searchdir=searchdir, index=run_index, filelist=filelist)
+                statsfile = uidfiles['statsfile']
+                seen.add(statsfile)
+                signature = __get_signature__(uidfiles)
+                if known.get(statsfile) == signature:
+                    self.db.execute('UPDATE mous SET run_index = ?, n_runs = ? WHERE statsfile = ?',
+                                    (run_index, len(statsfiles), statsfile))
+                    continue
+                n_new, n_changed = (n_new + 1, n_changed) if statsfile not in known else (n_new, n_changed + 1)
+                plstats = PLStats.from_uidname(uid_name, searchdir=searchdir, index=run_index, filelist=filelist)
+                self.__insert__(plstats, searchdir, uid_name, run_index, len(statsfiles), signature)
+        removed = [x for x in known if x not in seen]
+        self.db.executemany('DELETE FROM mous WHERE statsfile = ?', [(x,) for x in removed])
+        self.db.commit()
+        return n_new, n_changed, len(removed)
+
+    def update_workingdir(self, workdir):
+        """
+        Adds (or updates) a pipeline working directory, e.g., of a benchmark run, with the working directory as its
+        directory.
+        :param workdir: pipeline working directory
+        :return: the PLStats object if the working directory was (re)parsed, None if the entry was up to date
+        """
+        workdirfiles = PLStats.get_workdirfiles(workdir)
+        signature = __get_signature__(workdirfiles)
+        known = self.db.execute('SELECT signature FROM mous WHERE statsfile = ?', (workdirfiles['statsfile'],))
+        if (known.fetchone() or [None])[0] == signature:
+            return None
+        plstats = PLStats.from_workingdir(workdir, workdirfiles=workdirfiles)
+        self.__insert__(plstats, workdir, plstats.mous['mous_uid']['value'], 0, 1, signature, uidfiles=workdirfiles)
+        self.db.commit()
+        return plstats
+
+    def query(self, directory=None, index=0, criteria=None):
+        """
+        Returns the PLStats objects in the catalog that pass all criteria, the criteria on the catalog columns are
+        evaluated in SQL.
+        :param directory: if set, only return the objects of this directory
+        :param index: index of the pipeline run for each uid name (see PLStats.from_uidname), None for all runs
+        :param criteria: list of (key, operator, criterion) tuples
+        :return: list of PLStats objects
+        """
+        return list(self.iter_query(directory=directory, index=index, criteria=criteria))
+
+    def iter_query(self, directory=None, index=0, criteria=None):
+        """
+        Generator version of query, the catalog should not be closed (or updated) before it is exhausted.
+        """
+        where, parameters, py_criteria = [], [], []
+        if directory is not None:
+            where.append('searchdir = ?')
+            parameters.append(directory)
+        if index is not None:
+            where.append('(run_index = ? OR run_index - n_runs = ?)')
+            parameters.extend([index, index])
+        for key, operator, criterion in criteria or []:
+            if key not in self.columns:
+                py_criteria.append((key, operator, criterion))
+            elif operator == 'contains':
+                where.append('instr(CAST({} AS TEXT), ?) > 0'.format(key))
+                parameters.append(str(criterion))
+            else:
+                where.append('{0} {1} ?'.format(key, {'==': '=', '!=': '!=', '>=': '>=', '<=': '<='}[operator]))
+                parameters.append(criterion)
+        sql = 'SELECT statsfile, arfile, suppl_statsfile, record, hashes, summary FROM mous'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        for statsfile, arfile, suppl_statsfile, record, hashes, summary in self.db.execute(sql + ' ORDER BY statsfile',
+                                                                                          parameters):
+            plstats = PLStats()
+            plstats.mous = json.loads(record)
+            plstats.hashes = json.loads(hashes) if hashes else {}
+            plstats.summary = json.loads(summary) if summary else plstats.summarize()
+            plstats.statsfile, plstats.arfile, plstats.suppl_statsfile = statsfile, arfile, suppl_statsfile
+            if all(passes_criterion(plstats, *x) for x in py_criteria):
+                yield plstats
+
+    def get_hashes(self, directory, index=0):
+        """
+        The section hashes (see PLStats.get_hashes) of the objects of a directory, without loading the objects.
+        :param directory: directory with the stats files
+        :param index: index of the pipeline run for each uid name (see PLStats.from_uidname)
+        :return: dictionary of uid name to the dictionary with the hash of each section
+        """
+        rows = self.db.execute('SELECT uid_name, hashes FROM mous WHERE searchdir = ? AND '
+                               '(run_index = ? OR run_index - n_runs = ?)', (directory, index, index))
+        return {uid_name: json.loads(hashes) for uid_name, hashes in rows if hashes}
+
+    def __insert__(self, plstats, searchdir, uid_name, run_index, n_runs, signature, uidfiles=None):
+        # the file names are taken from uidfiles if given, e.g., the full paths of a working directory
+        files = [uidfiles[x] for x in ['statsfile', 'arfile', 'suppl_statsfile']] if uidfiles is not None else \
+            [plstats.statsfile, plstats.arfile, plstats.suppl_statsfile]
+        values = [plstats.mous[x]['value'] if x in plstats.mous and 'value' in plstats.mous[x] else None
+                  for x in self.columns]
+        values = [x if x is None or type(x) in [str, int, float] else json.dumps(x, default=__to_json__)
+                  for x in values]
+        names = ['statsfile', 'searchdir', 'uid_name', 'run_index', 'n_runs', 'signature', 'arfile', 'suppl_statsfile',
+                 'record', 'hashes', 'summary'] + self.columns
+        self.db.execute('INSERT OR REPLACE INTO mous ({0}) VALUES ({1})'.format(', '.join(names),
+                                                                               ', '.join(['?'] * len(names))),
+                        [files[0], searchdir, uid_name, run_index, n_runs, signature, files[1], files[2],
+                         json.dumps(plstats.mous, default=__to_json__),
+                         json.dumps(plstats.get_hashes()), json.dumps(plstats.summary, default=__to_json__)] + values)
+
+
+def __get_signature__(uidfiles):
+    # modification time and size of all files that make up a PLStats object
+    signature = []
+    for filename in [uidfiles.get(x) for x in ['statsfile', 'arfile', 'suppl_statsfile', 'timefile']]:
+        if filename:
+            stat = os.stat(filename)
+            signature.append('{0}:{1}:{2}'.format(filename, stat.st_mtime_ns, stat.st_size))
+    return '|'.join(signature)
+
+
+def __to_json__(obj):
+    # numpy scalars (e.g., from np.sum) are not json serializable
+    return obj.item() if hasattr(obj, 'item') else str(obj)
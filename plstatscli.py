@@ -0,0 +1,270 @@
+# command line tool to run the batch jobs of the package (supplemental stats, comparisons, filtering and exporting of
+# the stats of a directory) without writing a python script, e.g., on batch nodes:
+#   python plstatscli.py suppl BMDIR --jobs 8
+#   python plstatscli.py compare PLDIR1 PLDIR2 --csv diff.csv --plot timeplot.pdf --jobs 8
+#   python plstatscli.py compare CFDIR --json diffs.json --cache diffs.json.gz --jobs 8
+#   python plstatscli.py filter CFDIR -c n_spw '>=' 4 -o list.txt --jobs 8
+#   python plstatscli.py export CFDIR --level SPW --mous-keys proposal_code --keys spw_freq \
+#       --number-keys spw_freq -o spw.parquet
+# The heavy modules are only imported by the subcommand that needs them.
+import argparse
+import glob
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 1
+    return args.func(args) or 0
+
+
+def get_parser():
+    """
+    The argument parser with the subcommands suppl, compare, filter and export.
+    """
+    parser = argparse.ArgumentParser(description='Batch tool for pipeline stats, supplemental stats and comparisons')
+    subparsers = parser.add_subparsers(dest='command')
+    jobs = argparse.ArgumentParser(add_help=False)
+    jobs.add_argument('-j', '--jobs', type=int, default=1, help='number of worker processes (default: 1)')
+    select = argparse.ArgumentParser(add_help=False)
+    select.add_argument('directory', help='directory with the pipeline_stats (and aquareport and suppl. stats) files')
+    select.add_argument('-c', '--criterion', nargs=3, action='append', default=[], metavar=('KEY', 'OP', 'VALUE'),
+                        help='only use the MOUSes where any value of KEY satisfies OP (==, !=, >=, <= or contains) '
+                             'VALUE; can be given more than once')
+    select.add_argument('--index', type=int, default=0, help='index of the pipeline run of each uid name (default: 0)')
+    select.add_argument('--cache', default=None, metavar='DBFILE',
+                        help='(sqlite) catalog of the directory, which is updated and queried instead of parsing all '
+                             'stats files, see plstatscatalog')
+    select.add_argument('--stream', action=argparse.BooleanOptionalAction, default=True,
+                        help='process the MOUSes one at a time, in constant memory (default), or load all of them '
+                             'first (--no-stream)')
+
+    suppl = subparsers.add_parser('suppl', parents=[jobs],
+                                  help='make the supplemental stats files of a benchmark directory '
+                                       '(suppl_stats.benchmark_make_suppl_statfile)')
+    suppl.add_argument('bmdir', help='main directory that contains the individual pipeline runs')
+    suppl.add_argument('-o', '--outdir', default='./', help='directory for the output files (default: ./)')
+    suppl.add_argument('--overwrite', action='store_true', help='make the files again, same as --no-cache')
+    suppl.add_argument('--cache', action=argparse.BooleanOptionalAction, default=True,
+                       help='keep the existing suppl. stats files, i.e., they act as the cache (default), or make '
+                            'them again (--no-cache)')
+    suppl.add_argument('--stream', '--fast-mad', dest='fast_mad', action=argparse.BooleanOptionalAction,
+                       default=False,
+                       help='read each cube in chunks, in constant memory, with the approximate (streaming) median '
+                            'and MAD estimators, or load each cube as a whole for the exact statistics (default)')
+    suppl.add_argument('--preview', action='store_true', help='only calculate the (quick) preview statistics')
+    suppl.add_argument('--threads', type=int, default=1, help='number of threads for the per-channel statistics')
+    suppl.set_defaults(func=run_suppl)
+
+    compare = subparsers.add_parser('compare', parents=[jobs],
+                                    help='compare two benchmark directories (comparestats.compare_benchmarks), or the '
+                                         'first and last run of each uid name in a stats directory '
+                                         '(comparestats.compare_uidnames)')
+    compare.add_argument('directories', nargs='+', metavar='DIR',
+                         help='two benchmark directories, or a single stats directory')
+    compare.add_argument('--csv', default=None, help='CSV file for the differences')
+    compare.add_argument('--npz', default=None, help='(columnar) npz file for the differences')
+    compare.add_argument('--json', default=None, help='JSON file with the diff dictionaries')
+    compare.add_argument('--plot', default=None, metavar='FILE',
+                         help='timing comparison plots (PDF or HTML) of two benchmark directories')
+    compare.add_argument('--cache', default=None, metavar='FILE',
+                         help='(gzipped JSON) cache of the diff dictionaries of a stats directory; only the uid names '
+                              'whose files changed are compared again')
+    compare.add_argument('--skip-unchanged', action='store_true',
+                         help='skip the projects (and sections) whose content hashes did not change')
+    compare.add_argument('--catalog', default=None, metavar='DBFILE',
+                         help='(sqlite) catalog with the content hashes of the runs of two benchmark directories for '
+                              '--skip-unchanged, so that only new or changed runs are parsed, see plstatscatalog')
+    compare.add_argument('--diff-only', action='store_true',
+                         help='only keep the differences that are above the limit')
+    compare.add_argument('--limit', type=float, default=1E-5, help='relative limit for --diff-only (default: 1E-5)')
+    compare.add_argument('--stream', action=argparse.BooleanOptionalAction, default=True,
+                         help='write the differences of each project when it is compared (default), or compare all '
+                              'projects first (--no-stream); the diff dictionaries of two benchmark directories are '
+                              'kept in memory for --json and --plot')
+    compare.set_defaults(func=run_compare)
+
+    filt = subparsers.add_parser('filter', parents=[select, jobs],
+                                 help='write the list of MOUS uids that pass the criteria (PLStatsList.to_list)')
+    filt.add_argument('-o', '--output', required=True, help='output file with one mous uid per line')
+    filt.set_defaults(func=run_filter)
+
+    export = subparsers.add_parser('export', parents=[select, jobs],
+                                   help='export a table of the MOUSes that pass the criteria to a CSV, parquet or npz '
+                                        'file')
+    export.add_argument('-o', '--output', required=True,
+                        help='output file, the format is taken from the extension (.csv, .parquet or .npz)')
+    export.add_argument('--level', default='MOUS', choices=['MOUS', 'EB', 'SPW', 'TARGET'],
+                        help='one row per MOUS, EB, SPW or TARGET (default: MOUS)')
+    export.add_argument('--mous-keys', default='', help='comma separated list of MOUS level keywords')
+    export.add_argument('--keys', default='', help='comma separated list of keywords of the level')
+    export.add_argument('--number-keys', default='',
+                        help='comma separated list of the (MOUS or level) keywords with numbers, which are float64 '
+                             'columns in a parquet file; the other columns are strings')
+    export.set_defaults(func=run_export)
+    return parser
+
+
+def run_suppl(args):
+    from suppl_stats import benchmark_make_suppl_statfile
+    benchmark_make_suppl_statfile(args.bmdir, outdir=args.outdir, overwrite=args.overwrite or not args.cache,
+                                  fast_mad=args.fast_mad, preview=args.preview, n_threads=args.threads,
+                                  n_procs=args.jobs)
+
+
+def run_compare(args):
+    import comparestats
+    if len(args.directories) == 2:
+        if args.cache is not None:
+            print('compare: --cache is only used for a single stats directory, ignoring it')
+        diffs = comparestats.compare_benchmarks(args.directories[0], args.directories[1], csvfile=args.csv,
+                                               npzfile=args.npz, plot_timecomparison=args.plot is not None,
+                                               plot_timefile=args.plot or 'timeplot.pdf', plot_procs=args.jobs,
+                                               return_diff=args.json is not None or not args.stream,
+                                               skip_unchanged=args.skip_unchanged, catalogfile=args.catalog,
+                                               diff_only=args.diff_only, limit=args.limit)
+        if args.json is not None:
+            with open(args.json, 'w') as f:
+                json.dump(diffs, f, default=__to_json__)
+    elif len(args.directories) == 1:
+        if args.plot is not None or args.skip_unchanged or args.catalog is not None:
+            print('compare: --plot, --skip-unchanged and --catalog need two benchmark directories, ignoring them')
+        compare = comparestats.iter_uidnames if args.stream else comparestats.compare_uidnames
+        diffs = compare(args.directories[0], n_procs=args.jobs, cachefile=args.cache, diff_only=args.diff_only,
+                        limit=args.limit)
+        n_diffs = __write_diffs__(diffs, args.csv, args.npz, args.json)
+        print('compared {} projects'.format(n_diffs))
+        return
+    else:
+        print('compare: give two benchmark directories or a single stats directory')
+        return 1
+    if args.json is not None or not args.stream:
+        print('compared {} projects'.format(len(diffs)))
+
+
+def __write_diffs__(diffs, csvfile, npzfile, jsonfile):
+    # writes the diff dictionaries one at a time to the CSV, npz and JSON files, returns the number of them
+    from comparestats import DiffWriter
+    n_diffs = 0
+    writer = DiffWriter(csvfile, npzfile=npzfile) if csvfile is not None or npzfile is not None else None
+    f = open(jsonfile, 'w') if jsonfile is not None else None
+    try:
+        for diff in diffs:
+            if writer is not None:
+                writer.write(diff)
+            if f is not None:
+                f.write((', ' if n_diffs else '[') + json.dumps(diff, default=__to_json__))
+            n_diffs += 1
+        if f is not None:
+            f.write(']' if n_diffs else '[]')
+    finally:
+        if writer is not None:
+            writer.close()
+        if f is not None:
+            f.close()
+    return n_diffs
+
+
+def run_filter(args):
+    n_uids = 0
+    with open(args.output, 'w') as f:
+        for plstats in __iter_selection__(args):
+            f.write('{}\n'.format(plstats.mous['mous_uid']['value']))
+            n_uids += 1
+    print('{0} MOUSes written to {1}'.format(n_uids, args.output))
+
+
+def run_export(args):
+    import plstatslist
+    fmt = os.path.splitext(args.output)[1].lower()
+    mous_keys = [x for x in args.mous_keys.split(',') if x]
+    keys = [x for x in args.keys.split(',') if x]
+    if fmt not in ['.csv', '.parquet', '.npz']:
+        print('export: unknown output format {}, use .csv, .parquet or .npz'.format(fmt))
+        return 1
+    if fmt == '.npz':
+        # the npz file has the typed columns of the table engine, which needs all objects in memory (also when
+        # streaming), use .csv or .parquet for large selections
+        from tableengine import TableEngine
+        engine = TableEngine(list(__iter_selection__(args)))
+        n_rows = engine.write_npz(args.output, args.level, mous_keys=mous_keys, level_keys=keys)
+    else:
+        rows = plstatslist.iter_rows(__iter_selection__(args), mous_keys=mous_keys, level=args.level,
+                                     level_keys=keys)
+        columns = ['mous_uid'] + mous_keys + ([args.level] + keys if args.level != 'MOUS' else [])
+        if fmt == '.csv':
+            n_rows = plstatslist.write_csv(rows, args.output, columns=columns)
+        else:
+            number_columns = [x for x in args.number_keys.split(',') if x]
+            n_rows = plstatslist.write_parquet(rows, args.output, columns=columns, number_columns=number_columns)
+    print('{0} rows written to {1}'.format(n_rows, args.output))
+
+
+def __iter_selection__(args):
+    # the PLStats objects of the directory that pass the criteria, from the catalog, from worker processes or parsed
+    # one after the other. Unless streaming, all objects are loaded before the first one is returned.
+    stream = __iter_stream__(args)
+    return stream if args.stream else iter(list(stream))
+
+
+def __iter_stream__(args):
+    import plstatslist
+    criteria = [(key, op, value if op == 'contains' else __parse_value__(value)) for key, op, value in args.criterion]
+    if args.cache is not None:
+        from plstatscatalog import PLStatsCatalog
+        with PLStatsCatalog(args.cache) as catalog:
+            print('catalog update: {0} new, {1} changed, {2} removed'.format(*catalog.update(args.directory)))
+            yield from catalog.iter_query(directory=args.directory, index=args.index, criteria=criteria)
+        return
+    uid_names = plstatslist.get_uidnames(args.directory)
+    if args.jobs > 1:
+        yield from __iter_parallel__(args.directory, uid_names, args.index, criteria, args.jobs)
+    else:
+        yield from plstatslist.iter_plstats(args.directory, uid_names=uid_names, index=args.index, criteria=criteria)
+
+
+def __iter_parallel__(directory, uid_names, index, criteria, jobs):
+    # the objects are parsed (and checked against the criteria) in worker processes, and returned in order. The
+    # directory is listed once, and each worker gets the files of its uid name.
+    filelist = glob.glob(directory + '/pipeline*')
+    filelists = [[x for x in filelist if uid_name in x] for uid_name in uid_names]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for plstats in pool.map(__load_worker__, uid_names, [directory] * len(uid_names), [index] * len(uid_names),
+                                [criteria] * len(uid_names), filelists,
+                                chunksize=max(1, len(uid_names) // (8 * jobs))):
+            if plstats is not None:
+                yield plstats
+
+
+def __load_worker__(uid_name, directory, index, criteria, filelist):
+    from plstats import PLStats
+    from plstatslist import passes_criterion
+    plstats = PLStats.from_uidname(uid_name, searchdir=directory, index=index, filelist=filelist)
+    return plstats if all(passes_criterion(plstats, *x) for x in criteria) else None
+
+
+def __parse_value__(value):
+    # criterion values from the command line are numbers if they can be, otherwise strings
+    for convert in [int, float]:
+        try:
+            return convert(value)
+        except ValueError:
+            continue
+    return value
+
+
+def __to_json__(obj):
+    # numpy scalars and arrays are not json serializable
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    return str(obj)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
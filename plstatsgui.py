@@ -1,13 +1,16 @@
 import os
 import sys
 import glob
+import fnmatch
 from plstats import PLStats
-from copy import deepcopy as dc
+from prefetch import prefetch
+from tableengine import TableEngine
+from tableview import TableView
 import numpy as np
-from matplotlib.backends.qt_compat import QtWidgets, QtCore, QtGui
+from matplotlib.backends.qt_compat import QtWidgets, QtCore
 
 
-class ApplicationWindow(QtWidgets.QWidget):
+class ApplicationWindow(TableView, QtWidgets.QWidget):
 
     def __init__(self, directory, dir_type='Benchmark'):
         # overall image parameters of gui window
@@ -47,6 +50,7 @@ class ApplicationWindow(QtWidgets.QWidget):
         self.criterion2 = QtWidgets.QComboBox()
         self.criterion3 = QtWidgets.QLineEdit()
         self.criterion4 = QtWidgets.QLabel(self)
+        self.criterion5 = QtWidgets.QComboBox()
         self.dataselectbutton = QtWidgets.QPushButton('Apply Criterion', self)
         self.mousselect = QtWidgets.QGroupBox('MOUS level columns')
         self.ebselect = QtWidgets.QGroupBox('EB level columns')
@@ -60,27 +64,34 @@ class ApplicationWindow(QtWidgets.QWidget):
         self.targetselectbutton = QtWidgets.QPushButton('Apply Selection', self)
         self.ebselectlist = QtWidgets.QListWidget()
         self.ebselectbutton = QtWidgets.QPushButton('Apply Selection', self)
+        self.tabledata = TableEngine(self.statslist)
+        self.criteria = []
+        self.model = None
+        self.tablelevel = None
+        self.tablecolumns = []
         self.init_ui()
         # populate the table to its initial state
         self.reset_data()
 
     def load_cf(self):
+        # the directory is listed once, instead of once for every uid name
+        filelist = glob.glob(self.directory + '/pipeline*')
         uid_names = np.unique([x.split('___')[-1].split('-')[0] + '-'
-                               for x in glob.glob(self.directory + '/pipeline_stats*')])
-        for uid_name in uid_names:
-            self.statslist.append(PLStats.from_uidname(uid_name, searchdir=self.directory))
+                               for x in fnmatch.filter(filelist, self.directory + '/pipeline_stats*')])
+        bundles = ((x, PLStats.get_uidfiles(x, searchdir=self.directory, filelist=filelist).values())
+                   for x in uid_names)
+        for uid_name, files in prefetch(bundles):
+            self.statslist.append(PLStats.from_uidname(uid_name, searchdir=self.directory, files=files,
+                                                       filelist=filelist))
         if len(self.statslist) == 0:
             raise IOError('No json stat files found in: {}'.format(self.directory))
-        self.newstatslist = dc(self.statslist)
 
     def load_benchmark(self):
         dirs = glob.glob(self.directory + '/*/')
-        for cdir in dirs:
-            if os.path.exists(cdir + 'working'):
-                self.statslist.append(PLStats.from_workingdir(cdir + 'working'))
+        for (workdir, workdirfiles), files in prefetch(__get_workdirbundles__(dirs)):
+            self.statslist.append(PLStats.from_workingdir(workdir, files=files, workdirfiles=workdirfiles))
         if len(self.statslist) == 0:
             raise IOError('No json stat files found in: {}'.format(self.directory))
-        self.newstatslist = dc(self.statslist)
 
     def init_ui(self):
         self.setWindowTitle(self.directory)
@@ -100,11 +111,14 @@ class ApplicationWindow(QtWidgets.QWidget):
         self.criterion1.setPlaceholderText("Enter parameter name")
         self.criterion2.addItems(['==', '!=', '>=', '<=', 'contains'])
         self.criterion3.setPlaceholderText("Enter value")
+        self.criterion5.addItems(['and', 'or'])
+        self.criterion5.setToolTip('How the criteria of the same level are combined')
         self.dataselectbutton.clicked.connect(self.apply_criterion)
         layout = QtWidgets.QVBoxLayout()
         layout.addWidget(self.criterion1)
         layout.addWidget(self.criterion2)
         layout.addWidget(self.criterion3)
+        layout.addWidget(self.criterion5)
         layout.addWidget(self.criterion4)
         layout.addWidget(self.dataselectbutton)
         self.dataselect.setLayout(layout)
@@ -161,46 +175,10 @@ class ApplicationWindow(QtWidgets.QWidget):
             self.update_moustable()
 
     def update_moustable(self):
-        self.nrows_label.setText('Number of rows: {}'.format(len(self.newstatslist)))
-        if len(self.newstatslist) == 0:
-            model = QtGui.QStandardItemModel()
-        else:
-            model = QtGui.QStandardItemModel(len(self.newstatslist), len(self.mousheadsel) + 1)
-            hhlabels = ['PID (str)']
-            for idx1, x in enumerate(self.newstatslist):
-                __set_data__(model, x.mous['mous_uid'], idx1, 0)
-                for idx2, y in enumerate(self.mousheadsel):
-                    __set_data__(model, x.mous[y], idx1, idx2 + 1)
-                    if idx1 == 0:
-                        if 'value' in x.mous[y]:
-                            hhlabels.append(str(y) + ' (' + str(type(x.mous[y]['value']))[8:-2] + ')')
-                        else:
-                            hhlabels.append(str(y) + ' (' + str(type(x.mous[y]))[8:-2] + ')')
-            model.setHorizontalHeaderLabels(hhlabels)
-        self.update_tableview(model)
+        self.show_table('MOUS', self.mousheadsel, [])
 
     def update_perxtable(self, xval, n_x, n_xheadsel, x_list):
-        rowlength = np.sum([x.mous[n_x]['value'] for x in self.newstatslist])
-        columnlength = len(n_xheadsel) + len(self.mousheadsel) + 2
-        firstxdict = self.newstatslist[0].mous[xval][self.newstatslist[0].mous[x_list]['value'][0]]
-        headers = ['PID (str)', xval + ' (str)']
-        header2 = ([x + ' (' + str(type(self.newstatslist[0].mous[x]['value']))[8:-2] + ')' for x in self.mousheadsel] +
-                   [x + ' (' + str(type(firstxdict[x]['value']))[8:-2] + ')' for x in n_xheadsel])
-        headers.extend(header2)
-        model = QtGui.QStandardItemModel(rowlength, columnlength)
-        model.setHorizontalHeaderLabels(headers)
-        self.nrows_label.setText('Number of rows: {}'.format(rowlength))
-        rownumber = 0
-        for idx1, x in enumerate(self.newstatslist):
-            for idx2, y in enumerate(x.mous[x_list]['value']):
-                __set_data__(model, x.mous['mous_uid'], rownumber, 0)
-                __set_data__(model, y, rownumber, 1)
-                for idx3, z1 in enumerate(self.mousheadsel):
-                    __set_data__(model, x.mous[z1], rownumber, idx3 + 2)
-                for idx4, z2 in enumerate(n_xheadsel):
-                    __set_data__(model, x.mous[xval][y][z2], rownumber, len(self.mousheadsel) + idx4 + 2)
-                rownumber += 1
-        self.update_tableview(model)
+        self.show_table(xval, self.mousheadsel, n_xheadsel)
 
     def update_tableview(self, model):
         proxy = QtCore.QSortFilterProxyModel()
@@ -219,61 +197,52 @@ class ApplicationWindow(QtWidgets.QWidget):
             self.apply_mouscriterion()
         elif self.criterion1.text() in self.ebheaders:
             self.criterion4.setText('found header in EB')
-            self.apply_xciterion('EB', 'n_EB', 'eb_list')
+            self.apply_xciterion('EB')
         elif self.criterion1.text() in self.spwheaders:
             self.criterion4.setText('found header in SPW')
-            self.apply_xciterion('SPW', 'n_spw', 'spw_list')
+            self.apply_xciterion('SPW')
         elif self.criterion1.text() in self.targetheaders:
             self.criterion4.setText('found header in TARGET')
-            self.apply_xciterion('TARGET', 'n_target', 'target_list')
+            self.apply_xciterion('TARGET')
         else:
             self.criterion4.setText('{} Not a valid parameter name'.format(self.criterion1.text()))
             self.criterion1.setText('')
 
     def apply_mouscriterion(self):
-        try:
-            crit = type(self.newstatslist[0].mous[self.criterion1.text()]['value'])(self.criterion3.text())
-        except ValueError:
-            self.criterion4.setText('Inconsistent type for {}'.format(self.criterion1))
-            return
-        criterion = {'==': [x for x in self.newstatslist if x.mous[self.criterion1.text()]['value'] == crit],
-                     '!=': [x for x in self.newstatslist if x.mous[self.criterion1.text()]['value'] != crit],
-                     '>=': [x for x in self.newstatslist if x.mous[self.criterion1.text()]['value'] >= crit],
-                     '<=': [x for x in self.newstatslist if x.mous[self.criterion1.text()]['value'] <= crit],
-                     'contains': [x for x in self.newstatslist
-                                  if self.criterion3.text() in str(x.mous[self.criterion1.text()]['value'])]}
-        self.newstatslist = criterion[self.criterion2.currentText()]
-        self.update_table()
+        self.apply_xciterion('MOUS')
 
-    def apply_xciterion(self, xval, n_x, x_list):
+    def apply_xciterion(self, xval):
+        # the criterion is added to the criteria that are already applied: it is combined with the selected and/or with
+        # the earlier criteria of the same level, criteria of different levels are combined with and
+        criteria = self.criteria + [(xval, self.criterion1.text(), self.criterion2.currentText(),
+                                     self.criterion3.text(), self.criterion5.currentText())]
         try:
-            row = self.newstatslist[0].mous
-            crit = type(row[xval][row[x_list]['value'][0]][self.criterion1.text()]['value'])(self.criterion3.text())
-        except ValueError:
-            self.criterion4.setText('Inconsistent type for {}'.format(self.criterion1))
-            return
-        projects = [x for x in self.newstatslist]
-        for x in projects:
-            tlist = []
-            for y in x.mous[x_list]['value']:
-                criterion = {'==': x.mous[xval][y][self.criterion1.text()]['value'] == crit,
-                             '!=': x.mous[xval][y][self.criterion1.text()]['value'] != crit,
-                             '>=': x.mous[xval][y][self.criterion1.text()]['value'] >= crit,
-                             '<=': x.mous[xval][y][self.criterion1.text()]['value'] <= crit,
-                             'contains': self.criterion3.text() in str(x.mous[xval][y]
-                                                                       [self.criterion1.text()]['value'])}
-                if not criterion[self.criterion2.currentText()]:
-                    del x.mous[xval][y]
-                    x.mous[n_x]['value'] -= 1
-                else:
-                    tlist.append(y)
-            x.mous[x_list]['value'] = tlist
-            if x.mous[n_x]['value'] <= 0:
-                self.newstatslist.remove(x)
+            self.set_criteria(criteria)
+        except ValueError as err:
+            self.criterion4.setText('Inconsistent type for {0} ({1})'.format(self.criterion1.text(), err))
+            self.set_criteria(self.criteria)
+        else:
+            levels = [x[0] for x in self.criteria]
+            self.criterion4.setText('Criteria: ' + ', '.join(
+                ('{4} {1} {2} {3}' if levels.index(x[0]) < idx else '{1} {2} {3}').format(*x)
+                for idx, x in enumerate(self.criteria)))
         self.update_table()
 
+    def set_criteria(self, criteria):
+        # criteria are (level, key, operator, criterion, and/or) tuples, see TableEngine.apply_criteria
+        self.tabledata.reset()
+        levels = []
+        for level in [x[0] for x in criteria]:
+            if level not in levels:
+                levels.append(level)
+        for level in levels:
+            self.tabledata.apply_criteria(level, [x[1:] for x in criteria if x[0] == level])
+        self.criteria = criteria
+        self.newstatslist = [self.statslist[x] for x in self.tabledata.get_rows('MOUS')]
+        self.model, self.tablelevel, self.tablecolumns = None, None, []
+
     def reset_data(self):
-        self.newstatslist = dc(self.statslist)
+        self.set_criteria([])
         self.mousheadsel = []
         self.ebheadsel = []
         self.spwheadsel = []
@@ -285,18 +254,12 @@ class ApplicationWindow(QtWidgets.QWidget):
         self.update_table()
 
 
-def __set_data__(model, obj, row, col):
-    newitem = QtGui.QStandardItem()
-    if type(obj) == str:
-        newitem.setData(obj, QtCore.Qt.DisplayRole)
-    elif type(obj) == dict:
-        if 'value' in obj.keys():
-            newitem.setData(str(obj['value']), QtCore.Qt.DisplayRole)
-        else:
-            newitem.setData(str(obj), QtCore.Qt.DisplayRole)
-    else:
-        raise IOError('{}-type is not defined in __set_data__'.format(type(obj)))
-    model.setItem(row, col, newitem)
+def __get_workdirbundles__(dirs):
+    # the files of each working directory are listed (once) in the prefetch thread, see PLStats.get_workdirfiles
+    for cdir in dirs:
+        if os.path.exists(cdir + 'working'):
+            workdirfiles = PLStats.get_workdirfiles(cdir + 'working')
+            yield (cdir + 'working', workdirfiles), workdirfiles.values()
 
 
 def main():
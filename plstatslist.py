@@ -3,9 +3,11 @@
 ## code is a list of plstats objects that can then be viewed in the plstatsgui, or it
 ## can be used for further analysis
 import glob
-import numpy as np
+import csv
 from plstats import PLStats
-from copy import deepcopy as dc
+from prefetch import prefetch as prefetch_files
+# pyarrow is only needed by write_parquet, and is imported on first use (see __get_pyarrow__)
+pyarrow = None
 
 
 class PLStatsList:
@@ -14,42 +16,209 @@ class PLStatsList:
         self.statslist = []
 
     @classmethod
-    def from_directory(cls, directory, index=0):
+    def from_directory(cls, directory, index=0, prefetch=True, max_inflight=16):
         self = cls(directory)
-        uid_names = np.unique([x.split('___')[-1].split('-')[0] + '-'
-                               for x in glob.glob(self.directory + '/pipeline_stats*')])
-        for uid_name in uid_names:
-            self.statslist.append(PLStats.from_uidname(uid_name, searchdir=self.directory, index=index))
+        self.__load_uidnames__(get_uidnames(directory), index=index, prefetch=prefetch, max_inflight=max_inflight)
         if len(self.statslist) == 0:
             raise IOError('No json stat files found in: {}'.format(self.directory))
         return self
 
     @classmethod
-    def from_list(cls, listname, directory, index=0):
+    def from_list(cls, listname, directory, index=0, prefetch=True, max_inflight=16):
         self = cls(directory)
         with open(listname, 'r', encoding='utf-8') as f:
-            for uid_name in f:
-                uid_name = uid_name.strip()
-                if uid_name[0] != '#':
-                    self.statslist.append(PLStats.from_uidname(uid_name, searchdir=self.directory, index=index))
+            uid_names = [x.strip() for x in f if x.strip()[:1] not in ['', '#']]
+        self.__load_uidnames__(uid_names, index=index, prefetch=prefetch, max_inflight=max_inflight)
         return self
 
+    @classmethod
+    def from_catalog(cls, catalog, directory, index=0, criteria=None):
+        """
+        Loads the list from a PLStatsCatalog (which should have been updated for this directory) instead of parsing
+        the stats files. The criteria are (key, operator, criterion) tuples, see PLStatsCatalog.query.
+        """
+        self = cls(directory)
+        self.statslist = catalog.query(directory=directory, index=index, criteria=criteria)
+        return self
+
+    def __load_uidnames__(self, uid_names, index=0, prefetch=True, max_inflight=16):
+        self.statslist.extend(iter_plstats(self.directory, uid_names=uid_names, index=index, prefetch=prefetch,
+                                           max_inflight=max_inflight))
+
     def apply_criterion(self, key, operator, criterion):
-        new_list = []
-        for plstats in self.statslist:
-            values = plstats.get_values(key, value_only=True)
-            for y in values:
-                if type(values[y]) is list:
-                    values[y] = ' '.join(values[y])
-                crit = {'==': values[y] == criterion, '!=': values[y] != criterion,
-                        '>=': values[y] >= criterion, '<=': values[y] <= criterion,
-                        'contains': str(criterion) in str(values[y])}
-                if crit[operator]:
-                    new_list.append(plstats)
-                    break
-        self.statslist = new_list
+        self.statslist = [x for x in self.statslist if passes_criterion(x, key, operator, criterion)]
 
     def to_list(self, listname):
         with open(listname, "w") as file:
             for plstats in self.statslist:
                 file.write(f"{plstats.mous['mous_uid']['value']}\n")
+
+
+def get_uidnames(directory):
+    return sorted(set(x.split('___')[-1].split('-')[0] + '-' for x in glob.glob(directory + '/pipeline_stats*')))
+
+
+def passes_criterion(plstats, key, operator, criterion):
+    """
+    True if any of the values of key in the PLStats object satisfies the criterion (see PLStatsList.apply_criterion)
+    """
+    values = plstats.get_values(key, value_only=True)
+    for y in values:
+        value = ' '.join(values[y]) if type(values[y]) is list else values[y]
+        crit = {'==': lambda: value == criterion, '!=': lambda: value != criterion,
+                '>=': lambda: value >= criterion, '<=': lambda: value <= criterion,
+                'contains': lambda: str(criterion) in str(value)}
+        if crit[operator]():
+            return True
+    return False
+
+
+def iter_plstats(directory, uid_names=None, index=0, criteria=None, prefetch=True, max_inflight=16):
+    """
+    Generator that yields the PLStats objects of a directory one at a time, so that large directories can be scanned
+    in constant memory.
+    :param directory: directory with the pipeline_stats (and aquareport and suppl. stats) files
+    :param uid_names: list of uid names to load, if not set all uid names in the directory are loaded
+    :param index: index of the pipeline run to load for each uid name (see PLStats.from_uidname)
+    :param criteria: list of (key, operator, criterion) tuples. Only the objects that pass all criteria are yielded.
+    :param prefetch: if set, the files are read concurrently ahead of the parsing (see prefetch.prefetch)
+    :param max_inflight: maximum number of concurrent file reads when prefetching
+    :return: generator of PLStats objects
+    """
+    if uid_names is None:
+        uid_names = get_uidnames(directory)
+    # the directory is listed once, instead of once for every uid name
+    filelist = glob.glob(directory + '/pipeline*')
+    if prefetch:
+        bundles = ((x, PLStats.get_uidfiles(x, searchdir=directory, index=index, filelist=filelist).values())
+                   for x in uid_names)
+        stream = (PLStats.from_uidname(uid_name, searchdir=directory, index=index, files=files, filelist=filelist)
+                  for uid_name, files in prefetch_files(bundles, max_inflight=max_inflight))
+    else:
+        stream = (PLStats.from_uidname(uid_name, searchdir=directory, index=index, filelist=filelist)
+                  for uid_name in uid_names)
+    for plstats in stream:
+        if all(passes_criterion(plstats, *x) for x in (criteria or [])):
+            yield plstats
+
+
+def iter_rows(stream, mous_keys=None, level='MOUS', level_keys=None):
+    """
+    Generator that flattens a stream of PLStats objects into rows (dictionaries) with the selected columns. For level
+    'MOUS' there is one row per PLStats object, for 'EB', 'SPW' and 'TARGET' there is one row for each EB, SPW or
+    target, as in the per-EB/SPW/TARGET tables of plstatsgui.
+    :param stream: iterable of PLStats objects (e.g., iter_plstats)
+    :param mous_keys: list of MOUS level keywords to include
+    :param level: level of the rows
+    :param level_keys: list of keywords of the given level to include
+    :return: generator of dictionaries
+    """
+    mous_keys = mous_keys or []
+    level_keys = level_keys or []
+    for plstats in stream:
+        mous_row = {'mous_uid': plstats.mous['mous_uid']['value']}
+        mous_row.update({x: __get_rowvalue__(plstats.mous.get(x)) for x in mous_keys})
+        if level == 'MOUS':
+            yield mous_row
+            continue
+        for item in plstats.mous.get(level, {}):
+            row = dict(mous_row)
+            row[level] = item
+            row.update({x: __get_rowvalue__(plstats.mous[level][item].get(x)) for x in level_keys})
+            yield row
+
+
+def write_csv(rows, filename, columns=None):
+    """
+    Writes a stream of rows (see iter_rows) to a CSV file, one row at a time. The columns are taken from the first
+    row if not given. Returns the number of rows written.
+    """
+    n_rows = 0
+    with open(filename, 'w', newline='') as csvfile:
+        csvwriter = None
+        for row in rows:
+            if csvwriter is None:
+                csvwriter = csv.DictWriter(csvfile, fieldnames=columns or list(row.keys()), extrasaction='ignore')
+                csvwriter.writeheader()
+            csvwriter.writerow(row)
+            n_rows += 1
+    return n_rows
+
+
+def write_parquet(rows, filename, columns=None, number_columns=None, batch_size=10000):
+    """
+    Writes a stream of rows (see iter_rows) to a columnar parquet file, in row groups of batch_size rows. The schema is
+    declared before the first row is written: the columns in number_columns are float64 columns, all other columns are
+    string columns (values that are not strings are written as their string representation). Missing values are
+    written as nulls. This requires pyarrow. Returns the number of rows written.
+    :param rows: iterable of dictionaries (e.g., iter_rows)
+    :param filename: name of the parquet file
+    :param columns: list of columns, taken from the first row if not given
+    :param number_columns: list of columns with numbers (int, float or bool), which are written as float64
+    :param batch_size: number of rows in each row group
+    :return: number of rows written
+    """
+    __get_pyarrow__()
+    number_columns = number_columns or []
+    n_rows, batch, writer = 0, [], None
+    try:
+        for row in rows:
+            if writer is None:
+                columns = columns or list(row.keys())
+                writer = pyarrow.parquet.ParquetWriter(filename, __get_schema__(columns, number_columns))
+            batch.append(row)
+            if len(batch) == batch_size:
+                __write_batch__(writer, batch)
+                n_rows, batch = n_rows + len(batch), []
+        if writer is None:
+            writer = pyarrow.parquet.ParquetWriter(filename, __get_schema__(columns or [], number_columns))
+        if batch or n_rows == 0:
+            __write_batch__(writer, batch)
+            n_rows += len(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+    return n_rows
+
+
+def __get_schema__(columns, number_columns):
+    return pyarrow.schema([(x, pyarrow.float64() if x in number_columns else pyarrow.string()) for x in columns])
+
+
+def __write_batch__(writer, batch):
+    data = {}
+    for field in writer.schema:
+        if pyarrow.types.is_floating(field.type):
+            data[field.name] = [__get_numbervalue__(row.get(field.name), field.name) for row in batch]
+        else:
+            data[field.name] = [__get_stringvalue__(row.get(field.name)) for row in batch]
+    writer.write_table(pyarrow.table(data, schema=writer.schema))
+
+
+def __get_pyarrow__():
+    global pyarrow
+    if pyarrow is None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ModuleNotFoundError:
+            raise ModuleNotFoundError('write_parquet: pyarrow not found, cannot write parquet files')
+    return pyarrow
+
+
+def __get_rowvalue__(obj):
+    if type(obj) == dict:
+        return obj['value'] if 'value' in obj else str(obj)
+    return obj
+
+
+def __get_numbervalue__(value, column):
+    if value is None:
+        return None
+    if type(value) not in [int, float, bool]:
+        raise ValueError('write_parquet: column {0} has a value that is not a number: {1}'.format(column, value))
+    return float(value)
+
+
+def __get_stringvalue__(value):
+    return value if value is None or type(value) == str else str(value)
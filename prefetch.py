@@ -0,0 +1,111 @@
+# code to read the (many, small) files of a stats directory ahead of the parsers. Reading these files is latency
+# bound (e.g., on NFS), so the reads are done concurrently in an asyncio loop in a background thread, and the file
+# contents are handed to the (CPU bound) parsers in the main thread through a queue.
+import asyncio
+import io
+import os.path
+import queue
+import threading
+
+
+def prefetch(bundles, max_inflight=16, max_ahead=32):
+    """
+    Generator that reads the files of a list of bundles concurrently and yields them in the order of the bundles.
+
+    A bundle is a tuple of a key (e.g., the uid name or working directory) and a list of file names (empty file names
+    are ignored). The contents of each bundle are yielded as (key, files), where files is a dictionary of file name
+    to bytes that can be passed to the files keyword of the PLStats constructors. Files that cannot be read are left
+    out of the dictionary, so that the parser will open (and fail on) them itself.
+    :param bundles: iterable of (key, list of file names)
+    :param max_inflight: maximum number of file reads that are in flight at the same time
+    :param max_ahead: maximum number of bundles that are read ahead of the parser
+    :return: generator of (key, files)
+    """
+    results = queue.Queue(maxsize=max_ahead)
+    stop = threading.Event()
+    thread = threading.Thread(target=asyncio.run, args=(__produce__(bundles, results, stop, max_inflight, max_ahead),),
+                              daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = results.get()
+            if item is __done__:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def open_file(filename, files=None, mode='r'):
+    """
+    Opens a file from the prefetched files dictionary (see prefetch) if it is present, otherwise from disk.
+    """
+    if files and filename in files:
+        return io.BytesIO(files[filename]) if 'b' in mode else io.StringIO(files[filename].decode())
+    return open(filename, mode)
+
+
+def file_exists(filename, files=None):
+    return bool(files and filename in files) or os.path.isfile(filename)
+
+
+__done__ = object()
+
+
+async def __produce__(bundles, results, stop, max_inflight, max_ahead):
+    semaphore = asyncio.Semaphore(max_inflight)
+    window = []
+    bundles = iter(bundles)
+    try:
+        while True:
+            # the bundles can be made lazily (e.g., by listing a directory per bundle), which is done in a worker
+            # thread so that it does not block the reads that are in flight
+            bundle = await asyncio.to_thread(next, bundles, None)
+            if bundle is None:
+                break
+            key, filenames = bundle
+            window.append(asyncio.create_task(__read_bundle__(key, filenames, semaphore)))
+            if len(window) >= max_ahead:
+                if not await __put__(results, await window.pop(0), stop):
+                    return
+        while window:
+            if not await __put__(results, await window.pop(0), stop):
+                return
+    except Exception as e:
+        await __put__(results, e, stop)
+    finally:
+        for task in window:
+            task.cancel()
+        await __put__(results, __done__, stop)
+
+
+async def __read_bundle__(key, filenames, semaphore):
+    contents = await asyncio.gather(*[__read_file__(x, semaphore) for x in filenames if x])
+    return key, {filename: data for filename, data in contents if data is not None}
+
+
+async def __read_file__(filename, semaphore):
+    async with semaphore:
+        try:
+            return filename, await asyncio.to_thread(__read_bytes__, filename)
+        except OSError:
+            return filename, None
+
+
+def __read_bytes__(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+async def __put__(results, item, stop):
+    # blocking put on the (bounded) queue, which gives up when the consumer has stopped
+    while not stop.is_set():
+        try:
+            await asyncio.to_thread(results.put, item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
@@ -0,0 +1,83 @@
+# behaviour checks of the numerical and algorithmic helpers against plain (slow) reference implementations, e.g.:
+#   python selfcheck.py
+import argparse
+import sys
+import numpy as np
+
+
+def check_histogramquantile(n_trials=200, seed=1):
+    """
+    Compares the median of suppl_stats.HistogramQuantile with np.median on odd, even, gapped and blanked inputs, fed
+    in chunks. Returns the list of failures.
+    """
+    from suppl_stats import HistogramQuantile
+    rng = np.random.default_rng(seed)
+    cases = [np.array([[0., 0., 10., 10.]]), np.array([[3., 3., 3., 3.]]), np.array([[1.]]), np.array([[0., 1., 9.]])]
+    for trial in range(n_trials):
+        nchan, npix = rng.integers(1, 4), rng.integers(1, 200)
+        data = rng.normal(size=(nchan, npix)) * rng.uniform(0.1, 10)
+        if trial % 3 == 1:
+            # two groups of values with a gap between them
+            data[:, :npix // 2] += 100
+        if trial % 3 == 2:
+            data[:, 1:][rng.random((nchan, npix - 1)) < 0.3] = np.nan
+        cases.append(data)
+    failures = []
+    for data in cases:
+        h = HistogramQuantile(np.nanmin(data, axis=1), np.nanmax(data, axis=1), nbins=64)
+        for chunk in np.array_split(data, 3, axis=1):
+            h.update(chunk, chan_axis=0)
+        expected = np.nanmedian(data, axis=1)
+        if np.any(np.abs(h.quantile(0.5) - expected) > h.error * (1 + 1E-9) + 1E-12):
+            failures.append('HistogramQuantile: median {0} instead of {1} for {2}'.format(h.quantile(0.5), expected,
+                                                                                         data.tolist()))
+    return failures
+
+
+def check_align_stages(n_trials=200, seed=1):
+    """
+    Compares the (Hunt-Szymanski) alignment of comparestats.align_stages with a plain dynamic programming longest
+    common subsequence on random stage lists with repeated names. Returns the list of failures.
+    """
+    from comparestats import align_stages
+    rng = np.random.default_rng(seed)
+    stages = ['hifa_importdata', 'hifa_flagdata', 'hif_makeimages', 'hif_makeimages', 'hifa_imageprecheck',
+              'hif_applycal', 'hif_findcont', 'hif_uvcontsub']
+    failures = []
+    for _ in range(n_trials):
+        names1 = list(rng.choice(stages, size=rng.integers(0, 25)))
+        names2 = list(rng.choice(stages, size=rng.integers(0, 25)))
+        pairs = align_stages(names1, names2)
+        valid = (all(names1[x] == names2[y] for x, y in pairs) and
+                 all(x1 < x2 and y1 < y2 for (x1, y1), (x2, y2) in zip(pairs, pairs[1:])))
+        if not valid or len(pairs) != __get_lcslength__(names1, names2):
+            failures.append('align_stages: {0} for {1} and {2}'.format(pairs, names1, names2))
+    return failures
+
+
+def __get_lcslength__(names1, names2):
+    # length of the longest common subsequence, O(n m) dynamic programming
+    lengths = np.zeros((len(names1) + 1, len(names2) + 1), dtype=int)
+    for idx1, name1 in enumerate(names1):
+        for idx2, name2 in enumerate(names2):
+            lengths[idx1 + 1, idx2 + 1] = (lengths[idx1, idx2] + 1 if name1 == name2 else
+                                           max(lengths[idx1, idx2 + 1], lengths[idx1 + 1, idx2]))
+    return lengths[-1, -1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Behaviour checks of the numerical and algorithmic helpers')
+    parser.add_argument('--trials', type=int, default=200, help='number of random inputs of each check')
+    args = parser.parse_args()
+    failures = []
+    for check in [check_histogramquantile, check_align_stages]:
+        result = check(n_trials=args.trials)
+        print('{0:28s} {1}'.format(check.__name__, 'ok' if not result else '{} failures'.format(len(result))))
+        failures.extend(result)
+    for failure in failures[:10]:
+        print(failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,33 +1,39 @@
 import glob
 import numpy as np
 import os
-try:
-    from astropy.io import fits
-except ModuleNotFoundError:
-    print('suppl_stats: astropy not found, cannot load fits images')
 import json
-try:
-    ia.isopen
-except NameError:
-    from casatools import image as ima
-    ia = ima()
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+from itertools import count
+from multiprocessing import shared_memory, resource_tracker
+# astropy and the CASA image tool are slow to import, they are only loaded when the first image is read (see
+# __get_fits__ and __get_ia__)
+fits = None
+ia = None
 
 
-def benchmark_make_suppl_statfile(bmdir, outdir='./', overwrite=False):
+def benchmark_make_suppl_statfile(bmdir, outdir='./', overwrite=False, fast_mad=False, preview=False, n_threads=1,
+                                  n_procs=1):
     """
     simple wrapper program to get the supplemental stats file for a whole directory (e.g., benchmark run).
     :param bmdir: main directory that contains the individual pl_runs
     :param outdir: direcoty that contains the output files
     :param overwrite: if set, it will overwrite the existing outputfile
+    :param fast_mad: if set, will use the approximate (streaming) MAD estimator, see make_suppl_statfile
+    :param preview: if set, will only calculate the (quick) preview statistics, see make_suppl_statfile
+    :param n_threads: number of threads used for the per-channel statistics, see make_suppl_statfile
+    :param n_procs: number of worker processes that share the image data, see make_suppl_statfile
     :return: None
     """
     projects = list(np.unique([x.split('/')[-2] for x in sorted(glob.glob(bmdir + '/*.*/'))]))
     for pldir in projects:
         print('{0}: {1} of {2}'.format(pldir, projects.index(pldir) + 1, len(projects)))
-        make_suppl_statfile(bmdir + '/' + pldir + '/working', overwrite=overwrite, outdir=outdir)
+        make_suppl_statfile(bmdir + '/' + pldir + '/working', overwrite=overwrite, outdir=outdir,
+                            fast_mad=fast_mad, preview=preview, n_threads=n_threads, n_procs=n_procs)
 
 
-def make_suppl_statfile(workingdir, return_mous=False, overwrite=False, outdir=None, use_product_folder=False):
+def make_suppl_statfile(workingdir, return_mous=False, overwrite=False, outdir=None, use_product_folder=False,
+                        fast_mad=False, preview=False, n_threads=1, n_procs=1):
     """
     creates a supplemental stats file in JSON form with additional information that is not prenst in the
     current stats file
@@ -36,6 +42,11 @@ def make_suppl_statfile(workingdir, return_mous=False, overwrite=False, outdir=N
     :param overwrite: if set, it will overwrite the existing outputfile
     :param outdir: The directory to put the output into. The default is the current (working directory)
     :param use_product_folder: if set, will use the fits files in the product foler instead of the .image files
+    :param fast_mad: if set, the cubes are read in chunks and the median and MAD are approximate (streaming histogram
+    estimators), the error bound is stored in the _mad entries
+    :param preview: if set, the image statistics are calculated from a strided subset of the pixels and channels
+    :param n_threads: number of threads over which the channels of each cube are divided
+    :param n_procs: number of worker processes that share the image data (in shared memory), overrides n_threads
     :return: dictionary of the supplemental stats (optional)
     """
     # define the naming of the suppl. stats file. This is done first, to see if the file exists, and if so,
@@ -53,11 +64,17 @@ def make_suppl_statfile(workingdir, return_mous=False, overwrite=False, outdir=N
         print('make_suppl_statfile: file: {} already exists will not overwrite it'.format(outdir + jsonfile))
         return
     # create the dictionary
-    mous = {'EB': {}, 'TARGET': {}}
+    mous = {'EB': {}, 'TARGET': {}, 'suppl_stats_mode': {'value': 'preview' if preview else 'full'}}
     scrape_flagfiles(mous, workingdir)
     im_list, image_path = __get_imagelist__(workingdir, use_product_folder=use_product_folder)
-    for image in im_list:
-        get_imagestats(mous, image_path + image)
+    pool = ProcessPoolExecutor(max_workers=n_procs) if n_procs > 1 and im_list else None
+    try:
+        for image in im_list:
+            get_imagestats(mous, image_path + image, fast_mad=fast_mad, preview=preview, n_threads=n_threads,
+                           pool=pool)
+    finally:
+        if pool is not None:
+            pool.shutdown()
     # output the file and optionally return the dictionary
     with open(outdir + jsonfile, 'w') as fp:
         json.dump(mous, fp)
@@ -82,12 +99,33 @@ def scrape_flagfiles(mous, workingdir):
                                                                      if not line.strip().startswith('#')])
 
 
-def get_imagestats(mous, image):
-    header, im, im_pbcor, im_pb, im_mask = __load_images__(image)
+def get_imagestats(mous, image, fast_mad=False, preview=False, n_threads=1, pool=None):
+    fast_mad = fast_mad and not preview
+    if fast_mad:
+        header, stats = __get_streamstats__(image, pool=pool)
+        spatial_stride, channel_stride = 1, 1
+    elif pool is not None:
+        header, stats, (spatial_stride, channel_stride) = __get_shmstats__(image, pool, preview=preview)
+    else:
+        family = ImageFamily(image)
+        header, chan_axis = family.header, family.chan_axis
+        spatial_stride, channel_stride = 1, 1
+        if preview:  # only the sampled pixels are read from disk
+            sampling, spatial_stride, channel_stride = __get_preview_sampling__(family.shape, chan_axis)
+            im, im_pb, im_mask = family.read_chunk(sampling)
+        else:
+            im, im_pb, im_mask = family.im, family.pb, family.mask
+        stats = __get_channelstats__(im, im_pb, im_mask, header, chan_axis, n_threads=n_threads)
+        family.close()
+    im_rms, im_mad, im_maderror, im_max, im_totalflux, im_masksize = stats
+    if preview:  # every sampled pixel represents spatial_stride**2 pixels of the full image
+        im_totalflux = [x * spatial_stride ** 2 for x in im_totalflux]
+        if type(im_masksize) == list:
+            im_masksize = [x * spatial_stride ** 2 for x in im_masksize]
+        else:
+            im_masksize = im_masksize * spatial_stride ** 2
     if header['OBJECT'].strip() not in mous['TARGET']:
         mous['TARGET'][header['OBJECT'].strip()] = {}
-    im_rms, im_mad = __get_rms__(im, im_pb, im_mask)
-    im_max, im_totalflux, im_masksize = __get_max__(im, im_mask, header)
     if header['SPW'].strip() not in mous['TARGET'][header['OBJECT'].strip()]:
         mous['TARGET'][header['OBJECT'].strip()][header['SPW'].strip()] = {}
     t_im = mous['TARGET'][header['OBJECT'].strip()][header['SPW'].strip()]
@@ -104,45 +142,211 @@ def get_imagestats(mous, image):
     t_im[imroot + '_bmin'] = {'value': float(header['BMIN']) * 3600}
     t_im[imroot + '_bpa'] = {'value': float(header['BPA'])}
     t_im[imroot + '_rms'] = {'value': im_rms}
-    t_im[imroot + '_mad'] = {'value': im_mad}
+    if fast_mad:
+        t_im[imroot + '_mad'] = {'value': im_mad, 'error': im_maderror, 'approximate': True}
+    else:
+        t_im[imroot + '_mad'] = {'value': im_mad}
     t_im[imroot + '_max'] = {'value': im_max}
     t_im[imroot + '_totalflux'] = {'value': im_totalflux}
     t_im[imroot + '_masksize'] = {'value': im_masksize}
+    if preview:
+        t_im[imroot + '_preview'] = {'value': True, 'spatial_stride': spatial_stride,
+                                     'channel_stride': channel_stride}
 
 
-def __load_images__(image):
-    if image[-5:] == '.fits':
-        hdu = fits.open(image)
-        header = hdu[0].header
-        im_pbcor = np.squeeze(hdu[0].data)
-        if '.tt0' in image:
-            ext = '.tt0'
+class ImageFamily:
+    """
+    Access to the image, pbcor, pb and mask images that belong to a single science image. Each image is read at most
+    once and kept in its native axis order, see chan_axis.
+    """
+    def __init__(self, image):
+        self.image = image
+        self.is_fits = image[-5:] == '.fits'
+        if self.is_fits:
+            ext = '.tt0' if '.tt0' in image else ''
+            self.paths = {'pbcor': image, 'pb': image.replace(ext + '.pbcor', '.pb' + ext),
+                          'mask': image.replace(ext + '.pbcor', '.mask')}
         else:
-            ext = ''
-        im_pb = np.squeeze(fits.open(image.replace(ext + '.pbcor', '.pb' + ext))[0].data)
-        if os.path.exists(image.replace(ext + '.pbcor', 'mask')):
-            im_mask = np.squeeze(fits.open(image.replace(ext + '.pbcor', '.mask'))[0].data).astype(bool)
+            root = image[:-len('image')] if image[-len('image'):] == 'image' else image + '.'
+            self.paths = {'image': image, 'pbcor': image + '.pbcor', 'pb': root + 'pb', 'mask': root + 'mask'}
+        for imtype in ['pbcor', 'mask']:
+            if not os.path.exists(self.paths[imtype]):
+                del self.paths[imtype]
+        self.cache = {}
+        self.fitsheader = None
+        self.rawshape = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def header(self):
+        if self.fitsheader is None:
+            self.__read_header__()
+        return self.fitsheader
+
+    @property
+    def shape(self):
+        # shape of the images without the degenerate axes (as the data is returned), from the header only
+        if self.rawshape is None:
+            self.__read_header__()
+        return tuple(x for x in self.rawshape if x != 1)
+
+    @property
+    def im(self):
+        if 'image' not in self.cache:
+            if self.is_fits:
+                self.cache['image'] = self.pbcor * self.pb
+            else:
+                self.__read__('image')
+        return self.cache['image']
+
+    @property
+    def pbcor(self):
+        if 'pbcor' not in self.cache:
+            if 'pbcor' in self.paths:
+                self.__read__('pbcor')
+            else:
+                self.cache['pbcor'] = self.im / self.pb
+        return self.cache['pbcor']
+
+    @property
+    def pb(self):
+        if 'pb' not in self.cache:
+            self.__read__('pb')
+        return self.cache['pb']
+
+    @property
+    def mask(self):
+        if 'mask' not in self.cache:
+            if 'mask' in self.paths:
+                self.__read__('mask')
+                self.cache['mask'] = self.cache['mask'].astype(bool)
+            else:
+                self.cache['mask'] = np.zeros(self.im.shape, dtype=bool)
+        return self.cache['mask']
+
+    @property
+    def chan_axis(self):
+        if len(self.shape) == 2:
+            return None
+        return 0 if self.is_fits else len(self.shape) - 1
+
+    def read(self, imtype, chunk):
+        """
+        Reads a part of one of the images from disk (or from the cache if the whole image was read).
+        :param imtype: image, pbcor, pb or mask
+        :param chunk: tuple with a slice for each axis of the (squeezed) image, the slices can have a step
+        :return: array with the data of the chunk
+        """
+        if imtype in self.cache:
+            return self.cache[imtype][chunk]
+        if imtype == 'image' and self.is_fits:
+            return self.read('pbcor', chunk) * self.read('pb', chunk)
+        if imtype == 'pbcor' and 'pbcor' not in self.paths:
+            return self.read('image', chunk) / self.read('pb', chunk)
+        index, shape = self.__get_rawindex__(chunk)
+        if imtype == 'mask' and 'mask' not in self.paths:
+            return np.zeros(shape, dtype=bool)
+        if self.is_fits:  # a memory map only reads the pages of the chunk (a strided section is read per element)
+            with __get_fits__().open(self.paths[imtype], memmap=True) as hdu:
+                data = np.array(hdu[0].data[index])
         else:
-            im_mask = np.zeros_like(im_pbcor).astype(bool)
-        im = im_pbcor * im_pb
-    else:
-        casa_im = ia.newimagefromfile(image)
-        header = casa_im.fitsheader()
-        im = np.transpose(np.squeeze(casa_im.getchunk()))
-        casa_im.done()
-        casa_im = ia.newimagefromfile(image + '.pbcor')
-        im_pbcor = np.transpose(np.squeeze(casa_im.getchunk()))
-        casa_im.done()
-        casa_im = ia.newimagefromfile(image.replace('image', 'pb'))
-        im_pb = np.transpose(np.squeeze(casa_im.getchunk()))
-        casa_im.done()
-        if os.path.exists(image.replace('image', 'mask')):
-            casa_im = ia.newimagefromfile(image.replace('image', 'mask'))
-            im_mask = np.transpose(np.squeeze(casa_im.getchunk()).astype(bool))
-            casa_im.done()
+            ia = __get_ia__()
+            ia.open(self.paths[imtype])
+            try:
+                data = ia.getchunk(blc=[x.start for x in index], trc=[x.stop - 1 for x in index],
+                                   inc=[x.step for x in index])
+            finally:
+                ia.close()
+        data = np.reshape(data, shape)
+        return data.astype(bool) if imtype == 'mask' else data
+
+    def read_chunk(self, chunk):
+        """
+        Reads the image, pb and mask of a part of the images, see read.
+        :return: tuple with the image, pb and mask arrays of the chunk
+        """
+        im_pb = self.read('pb', chunk)
+        if self.is_fits and 'image' not in self.cache:
+            im = self.read('pbcor', chunk) * im_pb
         else:
-            im_mask = np.zeros_like(im).astype(bool)
-    return header, im, im_pbcor, im_pb, im_mask
+            im = self.read('image', chunk)
+        return im, im_pb, self.read('mask', chunk)
+
+    def close(self):
+        self.cache = {}
+
+    def __get_rawindex__(self, chunk):
+        # the slices of the chunk (with explicit start, stop and step) for all axes of the image on disk, including
+        # the degenerate ones, and the shape of the chunk
+        if self.rawshape is None:
+            self.__read_header__()
+        slices = iter(chunk)
+        index, shape = [], []
+        for size in self.rawshape:
+            if size == 1:
+                index.append(slice(0, 1, 1))
+                continue
+            start, stop, step = next(slices).indices(size)
+            n = len(range(start, stop, step))
+            index.append(slice(start, start + (n - 1) * step + 1, step))
+            shape.append(n)
+        return tuple(index), tuple(shape)
+
+    def __read_header__(self):
+        if self.is_fits:
+            with __get_fits__().open(self.paths['pbcor']) as hdu:
+                self.fitsheader, self.rawshape = hdu[0].header, tuple(hdu[0].shape)
+        else:
+            ia = __get_ia__()
+            ia.open(self.paths['image'])
+            try:
+                self.fitsheader, self.rawshape = ia.fitsheader(), tuple(ia.shape())
+            finally:
+                ia.close()
+
+    def __read__(self, imtype):
+        if self.is_fits:
+            with __get_fits__().open(self.paths[imtype]) as hdu:
+                if self.fitsheader is None and imtype == 'pbcor':
+                    self.fitsheader, self.rawshape = hdu[0].header, tuple(hdu[0].shape)
+                self.cache[imtype] = np.squeeze(hdu[0].data)
+        else:
+            ia = __get_ia__()
+            ia.open(self.paths[imtype])
+            try:
+                if self.fitsheader is None and imtype == 'image':
+                    self.fitsheader, self.rawshape = ia.fitsheader(), tuple(ia.shape())
+                self.cache[imtype] = np.squeeze(ia.getchunk())
+            finally:
+                ia.close()
+
+
+def __get_fits__():
+    global fits
+    if fits is None:
+        try:
+            from astropy.io import fits
+        except ModuleNotFoundError:
+            raise ModuleNotFoundError('suppl_stats: astropy not found, cannot load fits images')
+    return fits
+
+
+def __get_ia__():
+    # the single CASA image tool of the module (or the one of the CASA session, if there is one)
+    global ia
+    if ia is None:
+        try:
+            import builtins
+            ia = builtins.ia
+        except AttributeError:
+            from casatools import image as ima
+            ia = ima()
+    return ia
 
 
 def __get_imagelist__(workingdir, use_product_folder=False):
@@ -163,49 +367,324 @@ def __get_imagelist__(workingdir, use_product_folder=False):
         return image_list, workingdir
 
 
-def __get_rms__(im, im_pb, im_mask):
-    if im.ndim == 2:
-        pb_limit = __get_pblimit__(im_pb)
-        im_pbmaskcomp = np.where((~im_mask) & (im_pb > pb_limit[0]) & (im_pb < pb_limit[1]), im, np.nan)
-        im_rms = [np.sqrt(np.nanmean(np.square(im_pbmaskcomp))).astype(np.float64)]
-        im_mad = [np.nanmedian(np.abs(im_pbmaskcomp - np.nanmedian(im_pbmaskcomp))).astype(np.float64)]
+def __get_channelstats__(im, im_pb, im_mask, header, chan_axis, n_threads=1, max_block=2 ** 24):
+    # the cube is divided in blocks of channels (at least one per thread, and at most max_block pixels each), which
+    # are calculated in a pool of threads if n_threads > 1.
+    blocks = __get_channelblocks__(im.shape, chan_axis, max_block=max_block, n_blocks=n_threads)
+    get_blockstats = partial(__get_blockstats__, im=im, im_pb=im_pb, im_mask=im_mask, header=header,
+                             chan_axis=chan_axis)
+    if n_threads > 1 and len(blocks) > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            results = list(pool.map(get_blockstats, blocks))
     else:
-        im_rms, temp_rmsidx, im_mad = [], [], []
-        for channel in np.arange(im.shape[-3]):
-            pb_limit = __get_pblimit__(im_pb[channel, :])
-            im_pbmaskcomp = np.where(~im_mask[channel, :] & (im_pb[channel, :] > pb_limit[0]) &
-                                     (im_pb[channel, :] < pb_limit[1]), im[channel, :], np.nan)
-            im_rms.append(np.sqrt(np.nanmean(np.square(im_pbmaskcomp))).astype(np.float64))
-            im_mad.append(np.nanmedian(np.abs(im_pbmaskcomp - np.nanmedian(im_pbmaskcomp))).astype(np.float64))
-    return im_rms, im_mad
+        results = [get_blockstats(block) for block in blocks]
+    return __join_blockstats__(results, chan_axis)
+
+
+def __get_channelblocks__(shape, chan_axis, max_block=2 ** 24, max_channels=None, n_blocks=1):
+    if chan_axis is None:
+        return [tuple(slice(None) for _ in shape)]
+    nchan = shape[chan_axis]
+    step = min(max(1, max_block // (int(np.prod(shape)) // max(nchan, 1))), int(np.ceil(nchan / max(n_blocks, 1))))
+    if max_channels is not None:
+        step = min(step, max_channels)
+    blocks = []
+    for start in range(0, nchan, step):
+        block = [slice(None)] * len(shape)
+        block[chan_axis] = slice(start, start + step)
+        blocks.append(tuple(block))
+    return blocks
+
+
+def __join_blockstats__(results, chan_axis):
+    # concatenate the per-block lists of statistics (2D images have a single block)
+    if chan_axis is None:
+        return results[0]
+    return tuple(None if results[0][idx] is None else [x for result in results for x in result[idx]]
+                 for idx in range(len(results[0])))
+
 
+__shm_counter__ = count()
 
-def __get_max__(im, im_mask, header):
+
+def __get_shmstats__(image, pool, preview=False, max_block=2 ** 24):
+    # one worker loads the image data into shared memory, the other workers attach to it per block of channels. The
+    # segments are named here, so that they are removed even if a worker crashed.
+    prefix = 'plstats_{0}_{1}'.format(os.getpid(), next(__shm_counter__))
+    names = {x: prefix + '_' + x for x in ['im', 'pb', 'mask']}
     try:
-        beam_in_pix = np.abs(2 * np.pi * header['BMAJ'] * header['BMIN'] / (8 * np.log(2)) /
-                             (header['CDELT'][0] * header['CDELT'][1]))
-    except KeyError:
-        beam_in_pix = np.abs(2 * np.pi * header['BMAJ'] * header['BMIN'] / (8 * np.log(2)) /
-                             (header['CDELT1'] * header['CDELT2']))
-    if im.ndim == 2:
-        im_max = [np.nanmax(im).astype(np.float64)]
-        im_totalflux = [(np.nansum(np.where(im_mask, im, np.nan)) / beam_in_pix).astype(np.float64)]
-        im_masksize = int(np.nansum(im_mask))
+        meta = pool.submit(__load_shm__, image, names, preview=preview).result()
+        blocks = __get_channelblocks__(meta['shape'], meta['chan_axis'], max_block=max_block)
+        futures = {task: [pool.submit(__shm_worker__, task, block, names, meta)
+                          for block in blocks] for task in ['rms', 'max', 'masksize']}
+        results = {task: __join_blockstats__([x.result() for x in futures[task]], meta['chan_axis'])
+                   for task in futures}
+    finally:
+        __unlink_shm__(names)
+    stats = results['rms'] + results['max'] + results['masksize']
+    return meta['header'], stats, (meta['spatial_stride'], meta['channel_stride'])
+
+
+def __load_shm__(image, names, preview=False):
+    family = ImageFamily(image)
+    meta = {'header': family.header, 'chan_axis': family.chan_axis, 'spatial_stride': 1, 'channel_stride': 1,
+            'dtype': {}}
+    if preview:
+        sampling, meta['spatial_stride'], meta['channel_stride'] = __get_preview_sampling__(family.shape,
+                                                                                           family.chan_axis)
+        arrays = dict(zip(['im', 'pb', 'mask'], family.read_chunk(sampling)))
     else:
-        im_max, im_totalflux, im_masksize = [], [], []
-        for channel in np.arange(im.shape[-3]):
-            im_max.append(np.nanmax(im[channel, :]).astype(np.float64))
-            im_totalflux.append((np.nansum(np.where(im_mask[channel, :], im[channel, :], np.nan)) /
-                                 beam_in_pix).astype(np.float64))
-            im_masksize.append(int(np.nansum(im_mask[channel, :])))
-    return im_max, im_totalflux, im_masksize
-
-
-def __get_pblimit__(im_pb):
-    if np.min(im_pb) > 1.1 * 0.3:
-        pb_limit = [0.2, 1.1 * np.min(im_pb)]
+        arrays = {'im': family.im, 'pb': family.pb, 'mask': family.mask}
+    for x in arrays:
+        segment = __open_shm__(names[x], create=True, size=max(arrays[x].nbytes, 1))
+        np.ndarray(arrays[x].shape, dtype=arrays[x].dtype, buffer=segment.buf)[...] = arrays[x]
+        meta['shape'], meta['dtype'][x] = arrays[x].shape, arrays[x].dtype.str
+        segment.close()
+    family.close()
+    return meta
+
+
+def __shm_worker__(task, block, names, meta):
+    segments = {x: __open_shm__(names[x]) for x in names}
+    try:
+        return __get_shmtask__(task, block, segments, meta)
+    finally:
+        for segment in segments.values():
+            segment.close()
+
+
+def __get_shmtask__(task, block, segments, meta):
+    arrays = {x: np.ndarray(meta['shape'], dtype=meta['dtype'][x], buffer=segments[x].buf)[block] for x in segments}
+    if task == 'rms':
+        return __get_rms__(arrays['im'], arrays['pb'], arrays['mask'], meta['chan_axis']) + (None,)
+    elif task == 'max':
+        return __get_max__(arrays['im'], arrays['mask'], meta['header'], meta['chan_axis'])[:2]
     else:
-        pb_limit = [0.2, 0.33]
+        return __get_masksize__(arrays['mask'], meta['chan_axis']),
+
+
+def __open_shm__(name, create=False, size=0):
+    # the segments are owned (and removed) by the process that runs __get_shmstats__, so the workers should not
+    # register them with their own resource tracker, which would remove (or warn about) them when the worker exits
+    try:
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    except TypeError:  # python < 3.13 has no track keyword
+        segment = shared_memory.SharedMemory(name=name, create=create, size=size)
+        resource_tracker.unregister(segment._name, 'shared_memory')
+        return segment
+
+
+def __unlink_shm__(names):
+    for name in names.values():
+        try:
+            segment = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            continue
+        segment.close()
+        segment.unlink()
+
+
+def __get_blockstats__(block, im=None, im_pb=None, im_mask=None, header=None, chan_axis=None):
+    im_rms, im_mad = __get_rms__(im[block], im_pb[block], im_mask[block], chan_axis)
+    im_max, im_totalflux, im_masksize = __get_max__(im[block], im_mask[block], header, chan_axis)
+    return im_rms, im_mad, None, im_max, im_totalflux, im_masksize
+
+
+def __get_rms__(im, im_pb, im_mask, chan_axis=None):
+    axes = __get_spatialaxes__(im, chan_axis)
+    pb_limit = __get_pblimit__(im_pb, axes=axes)
+    im_pbmaskcomp = __get_pbmaskcomp__(im, im_pb, im_mask, pb_limit)
+    im_rms = np.sqrt(np.nanmean(np.square(im_pbmaskcomp), axis=axes)).astype(np.float64)
+    im_mad = np.nanmedian(np.abs(im_pbmaskcomp - np.nanmedian(im_pbmaskcomp, axis=axes, keepdims=True)),
+                          axis=axes).astype(np.float64)
+    return np.atleast_1d(im_rms).tolist(), np.atleast_1d(im_mad).tolist()
+
+
+def __get_streamstats__(image, pool=None, nbins=4096, max_chunk=2 ** 22):
+    # statistics with the streaming estimators per block of channels, the histograms of a block (max_chunk / nbins
+    # channels) are not larger than its chunks
+    family = ImageFamily(image)
+    blocks = __get_channelblocks__(family.shape, family.chan_axis, max_block=max_chunk,
+                                   max_channels=max(1, max_chunk // nbins))
+    get_blockstats = partial(__get_streamblock__, family, nbins=nbins, max_chunk=max_chunk)
+    if pool is not None and len(blocks) > 1:
+        results = list(pool.map(get_blockstats, blocks))
+    else:
+        results = [get_blockstats(block) for block in blocks]
+    return family.header, __join_blockstats__(results, family.chan_axis)
+
+
+def __get_streamblock__(family, block, nbins=4096, max_chunk=2 ** 22):
+    # passes over the chunks of a block: the pb limits, the range and exact statistics, the median and the MAD. A block
+    # that fits in a single chunk is only read once.
+    chan_axis = family.chan_axis
+    axes = None if chan_axis is None else tuple(x for x in range(len(family.shape)) if x != chan_axis)
+    nchan = 1 if chan_axis is None else len(range(*block[chan_axis].indices(family.shape[chan_axis])))
+    chunks = __get_chunks__(family.shape, chan_axis, block, max_chunk=max_chunk)
+    if len(chunks) == 1:
+        im, im_pb, im_mask = family.read_chunk(chunks[0])
+        pb_limit = __get_pblimit__(im_pb, axes=axes)
+        cached = [(im, im_mask, __get_pbmaskcomp__(im, im_pb, im_mask, pb_limit))]
+        del im, im_pb, im_mask
+    else:
+        pb_min = np.min([np.min(family.read('pb', x), axis=axes, keepdims=True) for x in chunks], axis=0)
+        pb_limit = __get_pbrange__(pb_min)
+        cached = None
+    im_min, im_max, sumsq, npix = np.full(nchan, np.inf), np.full(nchan, -np.inf), np.zeros(nchan), np.zeros(nchan)
+    peak, flux, masksize = np.full(nchan, np.nan), np.zeros(nchan), np.zeros(nchan, dtype=int)
+    for im, im_mask, im_pbmaskcomp in cached or __iter_pbmaskcomp__(family, chunks, pb_limit):
+        finite = np.isfinite(im_pbmaskcomp)
+        im_min = np.fmin(im_min, np.atleast_1d(np.fmin.reduce(im_pbmaskcomp, axis=axes)))
+        im_max = np.fmax(im_max, np.atleast_1d(np.fmax.reduce(im_pbmaskcomp, axis=axes)))
+        sumsq += np.atleast_1d(np.sum(np.where(finite, np.square(im_pbmaskcomp), 0), axis=axes))
+        npix += np.atleast_1d(np.sum(finite, axis=axes))
+        peak = np.fmax(peak, np.atleast_1d(np.fmax.reduce(im, axis=axes)))
+        flux += np.atleast_1d(np.nansum(np.where(im_mask, im, np.nan), axis=axes))
+        masksize += np.atleast_1d(np.count_nonzero(im_mask, axis=axes))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        im_rms = np.sqrt(sumsq / npix)
+    median = HistogramQuantile(im_min, im_max, nbins=nbins)
+    for _im, _mask, im_pbmaskcomp in cached or __iter_pbmaskcomp__(family, chunks, pb_limit):
+        median.update(im_pbmaskcomp, chan_axis=chan_axis)
+    im_median = median.quantile(0.5)
+    deviation = HistogramQuantile(np.zeros(nchan), np.fmax(im_max - im_median, im_median - im_min), nbins=nbins)
+    im_median_b = im_median if chan_axis is None else np.expand_dims(im_median, axes)
+    for _im, _mask, im_pbmaskcomp in cached or __iter_pbmaskcomp__(family, chunks, pb_limit):
+        deviation.update(np.abs(im_pbmaskcomp - im_median_b), chan_axis=chan_axis)
+    im_mad = deviation.quantile(0.5)
+    im_maderror = median.error + deviation.error
+    im_totalflux = flux / __get_beampix__(family.header)
+    return (im_rms.tolist(), im_mad.tolist(), im_maderror.tolist(), peak.tolist(), im_totalflux.tolist(),
+            int(masksize[0]) if chan_axis is None else masksize.tolist())
+
+
+def __iter_pbmaskcomp__(family, chunks, pb_limit):
+    # the image and mask of each chunk (read from disk), and the part of the image that is outside the clean mask and
+    # within the pb limits
+    for chunk in chunks:
+        im, im_pb, im_mask = family.read_chunk(chunk)
+        yield im, im_mask, __get_pbmaskcomp__(im, im_pb, im_mask, pb_limit)
+
+
+def __get_pbmaskcomp__(im, im_pb, im_mask, pb_limit):
+    # NaN inside the clean mask and outside the pb limits
+    return np.where(~im_mask & (im_pb > pb_limit[0]) & (im_pb < pb_limit[1]), im, np.nan)
+
+
+class HistogramQuantile:
+    """
+    Streaming quantile estimator for a set of channels, based on a fixed-range histogram [lo, hi] per channel. The
+    quantiles are within self.error (one bin width) of np.quantile, if all values are within [lo, hi].
+    """
+    def __init__(self, lo, hi, nbins=4096):
+        self.lo = np.atleast_1d(np.asarray(lo, dtype=np.float64))
+        self.hi = np.atleast_1d(np.asarray(hi, dtype=np.float64))
+        self.nbins = nbins
+        valid = np.isfinite(self.lo) & np.isfinite(self.hi)
+        self.width = np.where(valid, (self.hi - self.lo) / nbins, np.nan)
+        with np.errstate(divide='ignore'):
+            self.scale = np.where(valid & (self.width > 0), 1 / self.width, 0)
+        self.counts = np.zeros((len(self.lo), nbins), dtype=np.int64)
+
+    @property
+    def error(self):
+        return self.width
+
+    def update(self, data, chan_axis=None):
+        # only the finite values are binned, so the (often many) blanked pixels cost nothing after the first selection
+        shape = [1] * data.ndim
+        if chan_axis is not None:
+            shape[chan_axis] = -1
+        finite = np.isfinite(data)
+        chan = np.broadcast_to(np.arange(len(self.lo)).reshape(shape), data.shape)[finite]
+        idx = np.clip((data[finite] - self.lo[chan]) * self.scale[chan], 0, self.nbins - 1).astype(np.int64)
+        self.counts += np.bincount(chan * self.nbins + idx, minlength=self.counts.size).reshape(self.counts.shape)
+
+    def quantile(self, q=0.5):
+        # as np.quantile: interpolated between the elements of rank floor(h) and floor(h) + 1, with h = q * (n - 1)
+        cum = np.cumsum(self.counts, axis=1)
+        n = cum[:, -1]
+        h = q * np.maximum(n - 1, 0)
+        rank = np.floor(h)
+        frac = h - rank
+        value = ((1 - frac) * self.__get_ranked__(cum, rank) +
+                 frac * self.__get_ranked__(cum, np.minimum(rank + 1, np.maximum(n - 1, 0))))
+        return np.where(n > 0, value, np.nan)
+
+    def __get_ranked__(self, cum, rank):
+        # estimate of the element of (0-based) rank of each channel, with the elements of a bin spread evenly over it
+        idx = np.argmax(cum > rank[:, None], axis=1)
+        rows = np.arange(len(self.lo))
+        before = np.where(idx > 0, cum[rows, idx - 1], 0)
+        inbin = self.counts[rows, idx]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = np.where(inbin > 0, (rank - before + 0.5) / inbin, 0)
+        return self.lo + (idx + frac) * np.nan_to_num(self.width)
+
+
+def __get_chunks__(shape, chan_axis, block, max_chunk=2 ** 22):
+    # slabs along the first spatial axis of a block of channels that contain at most max_chunk pixels
+    slab_axis = 0 if chan_axis is None or chan_axis != 0 else 1
+    n_pixels = int(np.prod([len(range(*x.indices(y))) for x, y in zip(block, shape)]))
+    n_rows = max(1, max_chunk // max(n_pixels // shape[slab_axis], 1))
+    chunks = []
+    for start in range(0, shape[slab_axis], n_rows):
+        chunk = list(block)
+        chunk[slab_axis] = slice(start, start + n_rows)
+        chunks.append(tuple(chunk))
+    return chunks
+
+
+def __get_max__(im, im_mask, header, chan_axis=None):
+    axes = __get_spatialaxes__(im, chan_axis)
+    im_max = np.atleast_1d(np.nanmax(im, axis=axes).astype(np.float64)).tolist()
+    im_totalflux = np.atleast_1d((np.nansum(np.where(im_mask, im, np.nan), axis=axes) /
+                                  __get_beampix__(header)).astype(np.float64)).tolist()
+    return im_max, im_totalflux, __get_masksize__(im_mask, chan_axis)
+
+
+def __get_beampix__(header):
+    # the area of the beam in pixels
+    try:
+        return np.abs(2 * np.pi * header['BMAJ'] * header['BMIN'] / (8 * np.log(2)) /
+                      (header['CDELT'][0] * header['CDELT'][1]))
+    except KeyError:
+        return np.abs(2 * np.pi * header['BMAJ'] * header['BMIN'] / (8 * np.log(2)) /
+                      (header['CDELT1'] * header['CDELT2']))
+
+
+def __get_masksize__(im_mask, chan_axis=None):
+    if chan_axis is None:
+        return int(np.count_nonzero(im_mask))
+    return np.count_nonzero(im_mask, axis=__get_spatialaxes__(im_mask, chan_axis)).tolist()
+
+
+def __get_preview_sampling__(shape, chan_axis, max_planepix=2 ** 16, max_channels=64):
+    # strides such that at most max_planepix pixels per plane and max_channels channels are sampled
+    spatial_axes = [x for x in range(len(shape)) if chan_axis is None or x != chan_axis % len(shape)]
+    spatial_stride = int(np.ceil(np.sqrt(np.prod([shape[x] for x in spatial_axes]) / max_planepix)))
+    sampling = [slice(None, None, spatial_stride)] * len(shape)
+    if chan_axis is None:
+        channel_stride = 1
+    else:
+        channel_stride = int(np.ceil(shape[chan_axis] / max_channels))
+        sampling[chan_axis] = slice(None, None, channel_stride)
+    return tuple(sampling), spatial_stride, channel_stride
+
+
+def __get_spatialaxes__(im, chan_axis):
+    # the axes to reduce over to get per-channel statistics (None for 2D images, i.e., all axes)
+    if chan_axis is None:
+        return None
+    return tuple(x for x in range(im.ndim) if x != chan_axis % im.ndim)
+
+
+def __get_pblimit__(im_pb, axes=None):
+    return __get_pbrange__(np.min(im_pb, axis=axes, keepdims=True))
+
+
+def __get_pbrange__(pb_min):
+    pb_limit = [0.2, np.where(pb_min > 1.1 * 0.3, 1.1 * pb_min, 0.33)]
     return pb_limit
 
 
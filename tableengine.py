@@ -0,0 +1,313 @@
+# code to build the tables of plstatsgui and comparestatsgui without Qt, so that the same tables can be made (and
+# exported) in batch jobs
+import csv
+import numpy as np
+
+
+class TableEngine:
+    """
+    Row layouts, (cached) column values and row selections of the tables of a list of PLStats objects. The criteria
+    set a mask on the rows of each level.
+    """
+    lists = {'EB': 'eb_list', 'SPW': 'spw_list', 'TARGET': 'target_list'}
+
+    def __init__(self, statslist):
+        self.statslist = statslist
+        self.layouts = {}
+        self.columns = {}
+        self.values = {}
+        self.masks = {}
+
+    def get_fixed(self, level):
+        """
+        Keys of the columns that every table of the level starts with: the mous uid (PID) and the EB, SPW or TARGET.
+        """
+        return ['PID'] if level == 'MOUS' else ['PID', level]
+
+    def get_layout(self, level):
+        """
+        The position in statslist and the EB, SPW or TARGET (None for MOUS) of all rows of the table of a level.
+        """
+        if level not in self.layouts:
+            if level == 'MOUS':
+                self.layouts[level] = (np.arange(len(self.statslist)), [None] * len(self.statslist))
+            else:
+                rows = [(idx, y) for idx, x in enumerate(self.statslist) for y in x.mous[self.lists[level]]['value']]
+                self.layouts[level] = (np.array([x[0] for x in rows], dtype=int), [x[1] for x in rows])
+        return self.layouts[level]
+
+    def get_mask(self, level):
+        """
+        Boolean mask of the rows of a level that pass the criteria of the level, and whose MOUS passes all criteria.
+        """
+        positions = self.get_layout(level)[0]
+        mask = self.masks.get(level, np.ones(len(positions), dtype=bool))
+        if 'MOUS' in self.masks:
+            mask = mask & self.masks['MOUS'][positions]
+        return mask
+
+    def get_rows(self, level):
+        """
+        Indices (in the layout of the level) of the rows that pass the criteria.
+        """
+        return np.nonzero(self.get_mask(level))[0]
+
+    def get_column(self, level, xlevel, key):
+        """
+        Display texts of a keyword of level xlevel (MOUS or level) at the selected rows of the table of a level.
+        """
+        texts = self.__get_texts__(level, xlevel, key)
+        return [texts[x] for x in self.get_rows(level)]
+
+    def get_header(self, level, xlevel, key):
+        """
+        Header of a column: the keyword and the type of its value in the first row that has one.
+        """
+        values = self.get_rawvalues(level, xlevel, key)
+        value = next((values[x] for x in self.get_rows(level) if values[x] is not None), None)
+        if value is None:
+            return key
+        return key + ' (' + str(type(value))[8:-2] + ')'
+
+    def get_table(self, level, mous_keys=None, level_keys=None):
+        """
+        The table of a level as typed arrays, for the rows that pass the criteria.
+        :param level: level of the table (one row per MOUS, EB, SPW or TARGET)
+        :param mous_keys: list of MOUS level keywords
+        :param level_keys: list of keywords of the level
+        :return: dictionary of column name (MOUS:key for a MOUS keyword that is also a level keyword) to a typed array,
+        object arrays for other or mixed types
+        """
+        rows = self.get_rows(level)
+        columns = self.get_columns(level, mous_keys, level_keys)
+        return {name: self.__get_values__(level, *column)[rows]
+                for name, column in zip(self.get_names(level, mous_keys, level_keys), columns)}
+
+    def get_columns(self, level, mous_keys=None, level_keys=None):
+        """
+        The (xlevel, key) tuples of the columns of a table: the fixed columns, the MOUS and the level keywords.
+        """
+        return ([(level, x) for x in self.get_fixed(level)] + [('MOUS', x) for x in mous_keys or []] +
+                [(level, x) for x in level_keys or [] if level != 'MOUS'])
+
+    def get_names(self, level, mous_keys=None, level_keys=None):
+        """
+        Names of the columns of a table (see get_table).
+        """
+        return [('MOUS:' + key if xlevel == 'MOUS' and level != 'MOUS' and key in (level_keys or []) else key)
+                for xlevel, key in self.get_columns(level, mous_keys, level_keys)]
+
+    def write_csv(self, filename, level, mous_keys=None, level_keys=None):
+        """
+        Writes a table (see get_table) to a CSV file with the display texts of the values. Returns the number of rows.
+        """
+        columns = self.get_columns(level, mous_keys, level_keys)
+        texts = [self.get_column(level, *x) for x in columns]
+        with open(filename, 'w', newline='') as csvfile:
+            csvwriter = csv.writer(csvfile)
+            csvwriter.writerow(self.get_names(level, mous_keys, level_keys))
+            csvwriter.writerows(zip(*texts))
+        return len(self.get_rows(level))
+
+    def write_npz(self, filename, level, mous_keys=None, level_keys=None, compressed=True):
+        """
+        Writes a table (see get_table) to a (columnar) npz file and returns the number of rows.
+        """
+        table = self.get_table(level, mous_keys, level_keys)
+        for (xlevel, key), name in zip(self.get_columns(level, mous_keys, level_keys),
+                                       self.get_names(level, mous_keys, level_keys)):
+            if table[name].dtype == object:
+                table[name] = np.array(self.get_column(level, xlevel, key), dtype=str)
+        (np.savez_compressed if compressed else np.savez)(filename, **table)
+        return len(self.get_rows(level))
+
+    def apply_criteria(self, level, criteria, combine='and'):
+        """
+        Applies a list of criteria (combined from left to right) to the rows of the table of a level, a MOUS is removed
+        from all tables if none of its rows pass.
+        :param level: MOUS, EB, SPW or TARGET
+        :param criteria: list of (key, operator, criterion) tuples, with an optional fourth element (and or or) that
+        combines the criterion with the ones before it
+        :param combine: and or or, for the criteria without a fourth element
+        :return: boolean mask of the rows of the layout of the level that pass the criteria
+        """
+        mask = None
+        for criterion in criteria:
+            result = self.evaluate(level, *criterion[:3])
+            if mask is None:
+                mask = result
+            elif (criterion[3] if len(criterion) > 3 else combine) == 'or':
+                mask = mask | result
+            else:
+                mask = mask & result
+        if mask is None:
+            return self.get_mask(level)
+        positions = self.get_layout(level)[0]
+        self.masks[level] = self.masks.get(level, np.ones(len(positions), dtype=bool)) & mask
+        if level != 'MOUS':
+            passed = np.bincount(positions[self.masks[level]], minlength=len(self.statslist)) > 0
+            self.masks['MOUS'] = self.masks.get('MOUS', np.ones(len(self.statslist), dtype=bool)) & passed
+        return self.get_mask(level)
+
+    def evaluate(self, level, key, operator, criterion):
+        """
+        Boolean array with the result of a single criterion for every row of a level. Raises a ValueError if the
+        criterion can not be converted to the type of the column.
+        """
+        xlevel = self.get_xlevel(level, key)
+        values = self.__get_values__(level, xlevel, key)
+        if operator != 'contains' and values.dtype == object:
+            types = __get_types__(self.get_rawvalues(level, xlevel, key))
+            if len(types) > 1:
+                raise ValueError('{0} has mixed types: {1}'.format(key, ', '.join(sorted(x.__name__ for x in types))))
+        if operator == 'contains' or values.dtype == object:
+            values, criterion = np.array(self.__get_texts__(level, xlevel, key), dtype=str), str(criterion)
+            if operator == 'contains':
+                return np.char.find(values, criterion) >= 0
+        elif values.dtype == bool:
+            if str(criterion).lower() not in ['true', 'false', '1', '0']:
+                raise ValueError('{} is not a boolean'.format(criterion))
+            criterion = str(criterion).lower() in ['true', '1']
+        elif values.dtype.kind in 'fi':
+            criterion = float(criterion)
+        else:
+            criterion = str(criterion)
+        return {'==': np.equal, '!=': np.not_equal, '>=': np.greater_equal,
+                '<=': np.less_equal}[operator](values, criterion)
+
+    def reset(self):
+        self.masks = {}
+
+    def get_xlevel(self, level, key):
+        """
+        Level of a keyword in the table of a level, the level itself takes precedence over MOUS.
+        """
+        positions, items = self.get_layout(level)
+        if level != 'MOUS' and len(positions) > 0 and key in self.statslist[positions[0]].mous[level][items[0]]:
+            return level
+        return 'MOUS'
+
+    def get_rawvalues(self, level, xlevel, key):
+        """
+        Values of a keyword at all rows of the level, None if missing.
+        """
+        positions, items = self.get_layout(level)
+        if key == 'PID':
+            return [self.statslist[x].mous['mous_uid']['value'] for x in positions]
+        elif key == level:
+            return items
+        elif xlevel == 'MOUS':
+            values = [__get_value__(x.mous.get(key)) for x in self.statslist]
+            return [values[x] for x in positions]
+        return [__get_value__(self.statslist[x].mous[xlevel][y].get(key)) for x, y in zip(positions, items)]
+
+    def __get_texts__(self, level, xlevel, key):
+        if (level, xlevel, key) not in self.columns:
+            self.columns[(level, xlevel, key)] = [__get_text__(x) for x in
+                                                  self.get_rawvalues(level, xlevel, key)]
+        return self.columns[(level, xlevel, key)]
+
+    def __get_values__(self, level, xlevel, key):
+        # typed array of the values: int if all values are ints, float for other numbers (NaN if missing), bool (if
+        # none are missing), str ('' if missing), or object for other and mixed types
+        if (level, xlevel, key) not in self.values:
+            values = self.get_rawvalues(level, xlevel, key)
+            types = __get_types__(values)
+            if types == {int} and None not in values:
+                array = np.array(values, dtype=int)
+            elif types and types <= {int, float}:
+                array = np.array([np.nan if x is None else x for x in values], dtype=float)
+            elif types == {bool} and None not in values:
+                array = np.array(values, dtype=bool)
+            elif types == {str}:
+                array = np.array(['' if x is None else x for x in values], dtype=str)
+            else:
+                array = np.empty(len(values), dtype=object)
+                array[:] = values
+            self.values[(level, xlevel, key)] = array
+        return self.values[(level, xlevel, key)]
+
+
+class DiffTableEngine(TableEngine):
+    """
+    Tables of a list of diff dictionaries (see comparestats.create_diff_dict) as shown by comparestatsgui, with the
+    MOUS and IMAGE (one row per target and spw) levels.
+    """
+    pl2_keys = ['manual_flags']
+
+    def __init__(self, statslist):
+        super().__init__(statslist)
+        self.uids = [x['MOUS']['mous_uid']['PL1']['value'] for x in statslist]
+        self.positions = {x: idx for idx, x in enumerate(self.uids)}
+        self.imtypes = []
+        self.cf = None
+
+    def get_fixed(self, level):
+        return ['mous_uid'] if level == 'MOUS' else ['mous_uid', 'TARGET', 'SPW']
+
+    def get_layout(self, level):
+        """
+        The position in statslist and the (target, spw) (None for MOUS) of all rows of the table of a level. The IMAGE
+        level also sets the CF summary of each image in self.cf (1 flagged, 0 not flagged, -1 no CF values).
+        """
+        if level in self.layouts or level == 'MOUS':
+            return super().get_layout(level)
+        rows, imtypes, cf_entries = [], {}, []
+        for position, diff_strct in enumerate(self.statslist):
+            for target in diff_strct['TARGET']:
+                if type(diff_strct['TARGET'][target]) != dict or 'SPW' not in diff_strct['TARGET'][target]:
+                    continue
+                for spw, images in diff_strct['TARGET'][target]['SPW'].items():
+                    for image, entry in images.items():
+                        if type(entry) == dict and 'CF' in entry:
+                            cf = entry['CF']['value']
+                            cf_entries.append((len(rows), imtypes.setdefault(image, len(imtypes)),
+                                               -1 if type(cf) == list and len(cf) == 0 else int(bool(np.any(cf)))))
+                    rows.append((position, (target, spw)))
+        self.imtypes = list(imtypes.keys())
+        self.cf = np.full((len(rows), len(imtypes)), -1, dtype=np.int8)
+        if cf_entries:
+            cf_entries = np.array(cf_entries)
+            self.cf[cf_entries[:, 0], cf_entries[:, 1]] = cf_entries[:, 2]
+        self.layouts[level] = (np.array([x[0] for x in rows], dtype=int), [x[1] for x in rows])
+        return self.layouts[level]
+
+    def get_header(self, level, xlevel, key):
+        if xlevel == 'IMAGE' and key not in self.get_fixed(level):
+            return key + ' (bool)'
+        return super().get_header(level, xlevel, key)
+
+    def get_xlevel(self, level, key):
+        self.get_layout(level)
+        return 'MOUS' if level == 'MOUS' or key not in self.imtypes else level
+
+    def get_rawvalues(self, level, xlevel, key):
+        positions, items = self.get_layout(level)
+        if key == 'mous_uid' and xlevel != 'MOUS':
+            return [self.uids[x] for x in positions]
+        elif key in ['TARGET', 'SPW'] and xlevel != 'MOUS':
+            return [x[['TARGET', 'SPW'].index(key)] for x in items]
+        elif xlevel == 'MOUS':
+            values = [__get_value__(x['MOUS'][key]['PL2' if key in self.pl2_keys else 'PL1'])
+                      if key in x['MOUS'] else None for x in self.statslist]
+            return [values[x] for x in positions]
+        if key not in self.imtypes:
+            return [None] * len(positions)
+        return [[None, False, True][x + 1] for x in self.cf[:, self.imtypes.index(key)]]
+
+
+def __get_value__(obj):
+    return obj['value'] if type(obj) == dict and 'value' in obj else obj
+
+
+def __get_types__(values):
+    # types of the values that are not missing (None)
+    return set(type(x) for x in values if x is not None)
+
+
+def __get_text__(obj):
+    if obj is None:
+        return ''
+    if type(obj) == dict:
+        return str(obj['value']) if 'value' in obj.keys() else str(obj)
+    return str(obj)
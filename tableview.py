@@ -0,0 +1,52 @@
+# Qt view of the tables of tableengine, shared by plstatsgui and comparestatsgui. All the table logic (rows, columns
+# and criteria) is in the engine, this only turns the columns into Qt items.
+from matplotlib.backends.qt_compat import QtCore, QtGui
+
+
+class TableView:
+    """
+    Mixin for the application windows of the GUIs, which shows the tables of a TableEngine (self.tabledata) in
+    self.tableview. The window keeps the shown table in self.model, self.tablelevel and self.tablecolumns (set
+    self.model to None when the rows change), and has a label self.nrows_label and a method update_tableview(model).
+    """
+    def show_table(self, level, mous_keys, x_keys):
+        """
+        Shows the table of the given level with the given MOUS and level columns. If the table already shows this
+        level, only the columns that were added or removed are changed in the model; the values of the columns come
+        from (and are cached by) self.tabledata.
+        """
+        columns = self.tabledata.get_columns(level, mous_keys, x_keys)
+        fixed = len(self.tabledata.get_fixed(level))
+        n_rows = len(self.tabledata.get_rows(level))
+        self.nrows_label.setText('Number of rows: {}'.format(n_rows))
+        kept = [x for x in self.tablecolumns if x in columns]
+        if (self.model is not None and self.tablelevel == level and kept[:fixed] == columns[:fixed] and
+                kept == [x for x in columns if x in kept]):
+            for idx in reversed(range(len(self.tablecolumns))):
+                if self.tablecolumns[idx] not in columns:
+                    self.model.removeColumn(idx)
+            for idx, column in enumerate(columns):
+                if column not in kept:
+                    self.model.insertColumn(idx, self.get_items(level, *column))
+                    self.model.setHorizontalHeaderItem(idx, QtGui.QStandardItem(
+                        self.tabledata.get_header(level, *column)))
+                    self.tableview.resizeColumnToContents(idx)
+                    if self.tableview.columnWidth(idx) > 300:
+                        self.tableview.setColumnWidth(idx, 300)
+            self.tablecolumns = columns
+            return
+        model = QtGui.QStandardItemModel()
+        if n_rows > 0:
+            for column in columns:
+                model.appendColumn(self.get_items(level, *column))
+            model.setHorizontalHeaderLabels([self.tabledata.get_header(level, *x) for x in columns])
+        self.model, self.tablelevel, self.tablecolumns = model, level, columns
+        self.update_tableview(model)
+
+    def get_items(self, level, xlevel, key):
+        items = []
+        for text in self.tabledata.get_column(level, xlevel, key):
+            item = QtGui.QStandardItem()
+            item.setData(text, QtCore.Qt.DisplayRole)
+            items.append(item)
+        return items
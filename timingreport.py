@@ -0,0 +1,135 @@
+# code to render the timing comparison reports (PDF or HTML) of comparestats.compare_benchmarks, the pages are drawn
+# without pyplot so that they can be rendered in worker processes
+import os
+import html
+import tempfile
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.figure import Figure
+from matplotlib.patches import Rectangle
+
+
+def render_timing_report(time1, time2, filename, pldir1='pl1', pldir2='pl2', n_procs=1, stages_per_page=12):
+    """
+    Renders the timing comparison of two sets of runs, with scatter plots of the stage times and violin plots of the
+    time ratios.
+    :param time1: TimingMatrix of the first pipeline runs (see timingstats)
+    :param time2: TimingMatrix of the second pipeline runs
+    :param filename: name of the report, a PDF file or an HTML file (with the PNG images in <name>_files)
+    :param pldir1: label of the first pipeline runs
+    :param pldir2: label of the second pipeline runs
+    :param n_procs: number of worker processes that render the pages
+    :param stages_per_page: number of stages per page
+    :return: list with for each stage the time ratios, the time ratios of the runs with a difference of more than 60
+    seconds, and the median time of the first run
+    """
+    valid, ratio = time1.get_valid(time2), time1.get_ratio(time2)
+    ds = [(ratio[idx][valid[idx]].tolist(),
+           ratio[idx][valid[idx] & (np.abs(time2.times[idx] - time1.times[idx]) > 60)].tolist(),
+           np.median(time1.times[idx][valid[idx]]) if np.any(valid[idx]) else np.nan)
+          for idx in range(len(time1.stages))]
+    pages = []
+    for kind in ['scatter', 'violin']:
+        for start in range(0, len(time1.stages), stages_per_page):
+            rows = range(start, min(start + stages_per_page, len(time1.stages)))
+            pages.append({'kind': kind, 'stages': [time1.stages[x] for x in rows], 'pldir1': pldir1, 'pldir2': pldir2,
+                          'x': [time1.times[x][valid[x]] for x in rows], 'y': [time2.times[x][valid[x]] for x in rows],
+                          'ratio': [ds[x][0] for x in rows], 'ratio60': [ds[x][1] for x in rows],
+                          'n_columns': 4, 'n_rows': int(np.ceil(stages_per_page / 4))})
+    if filename.endswith('.html'):
+        __render_html__(pages, filename, n_procs, time1.get_slowdowns(time2))
+    else:
+        __render_pdf__(pages, filename, n_procs)
+    return ds
+
+
+def __render_pdf__(pages, filename, n_procs):
+    # the pages are rendered in parallel if they can be merged with pypdf
+    PdfWriter = None
+    if n_procs > 1 and len(pages) > 1:
+        try:
+            from pypdf import PdfWriter
+        except ModuleNotFoundError:
+            print('timingreport: pypdf not found, rendering the pages serially')
+    if PdfWriter is not None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            pagefiles = [os.path.join(tmpdir, 'page{:05d}.pdf'.format(x)) for x in range(len(pages))]
+            with ProcessPoolExecutor(max_workers=n_procs) as pool:
+                list(pool.map(__save_page__, pages, pagefiles))
+            writer = PdfWriter()
+            for pagefile in pagefiles:
+                writer.append(pagefile)
+            with open(filename, 'wb') as f:
+                writer.write(f)
+    else:
+        from matplotlib.backends.backend_pdf import PdfPages
+        with PdfPages(filename) as pdf:
+            for page in pages:
+                pdf.savefig(__draw_page__(page))
+
+
+def __render_html__(pages, filename, n_procs, slowdowns):
+    pngdir = filename[:-len('.html')] + '_files'
+    os.makedirs(pngdir, exist_ok=True)
+    pngfiles = [os.path.join(pngdir, 'page{:05d}.png'.format(x)) for x in range(len(pages))]
+    if n_procs > 1 and len(pages) > 1:
+        with ProcessPoolExecutor(max_workers=n_procs) as pool:
+            list(pool.map(__save_page__, pages, pngfiles))
+    else:
+        for page, pngfile in zip(pages, pngfiles):
+            __save_page__(page, pngfile)
+    rows = ['<tr><td>{0}</td><td>{1}</td><td>{2}</td><td>{3:.3f}</td><td>{4:.2g}</td><td>{5}</td></tr>'.format(
+            html.escape(stage), n, n_slower, ratio, p_value, 'yes' if slowdown else '')
+            for stage, n, n_slower, ratio, p_value, slowdown in
+            zip(slowdowns['stages'], slowdowns['n'], slowdowns['n_slower'], slowdowns['median_ratio'],
+                slowdowns['p_value'], slowdowns['slowdown'])]
+    with open(filename, 'w') as f:
+        f.write('<html><head><title>Timing comparison</title></head><body>\n')
+        f.write('<h1>Timing comparison: {0} vs {1}</h1>\n'.format(html.escape(pages[0]['pldir1']),
+                                                                html.escape(pages[0]['pldir2']))
+                if pages else '<h1>Timing comparison</h1>\n')
+        f.write('<table border="1"><tr><th>Stage</th><th>Runs</th><th>Slower</th><th>Median ratio</th>'
+                '<th>p-value</th><th>Slowdown</th></tr>\n' + '\n'.join(rows) + '\n</table>\n')
+        for pngfile in pngfiles:
+            f.write('<p><img src="{}"></p>\n'.format(html.escape(os.path.relpath(pngfile, os.path.dirname(filename)
+                                                                                 or '.'))))
+        f.write('</body></html>\n')
+
+
+def __save_page__(page, filename):
+    __draw_page__(page).savefig(filename)
+    return filename
+
+
+def __draw_page__(page):
+    if page['kind'] == 'scatter':
+        fig = Figure(figsize=(10, 8))
+        axs = fig.subplots(page['n_rows'], page['n_columns'], squeeze=False)
+        fig.subplots_adjust(left=0.08, bottom=0.08, right=0.98, top=0.96, wspace=0.2, hspace=0.25)
+        fig.text(0.52, 0.02, page['pldir1'] + ' Time (s)', ha='center')
+        fig.text(0.02, 0.52, page['pldir2'] + ' Time (s)', rotation=90, va='center')
+        for idx, ax in enumerate(axs.reshape(-1)):
+            if idx >= len(page['stages']):
+                ax.set_visible(False)
+                continue
+            x, y = page['x'][idx], page['y'][idx]
+            if len(x) > 0:
+                maxv, minv = np.max(np.concatenate([x, y])), np.min(np.concatenate([x, y]))
+                ax.plot(x, y, 'o', color='steelblue')
+                ax.plot([minv, maxv], [minv, maxv], ':', color='black')
+                ax.set_yscale('log')
+                ax.set_xscale('log')
+            ax.set_title(page['stages'][idx], fontsize=10)
+    else:
+        fig = Figure(figsize=(16, 7))
+        ax = fig.subplots(1, 1)
+        fig.subplots_adjust(left=0.06, right=0.98, bottom=0.20, top=0.96)
+        ax.violinplot([x if x != [] else [1] for x in page['ratio']], showmedians=True, side='low')
+        ax.violinplot([x if x != [] else [1] for x in page['ratio60']], showmedians=True, side='high')
+        ax.legend(handles=[Rectangle((0, 0), 1, 1, fc='steelblue'), Rectangle((0, 0), 1, 1, fc='orange')],
+                  labels=['All data', 'Data where difference is >60s'], loc='upper right')
+        ax.axhline(1, ls='--', color='black')
+        ax.set_xticks([y + 1 for y in range(len(page['stages']))], labels=page['stages'], rotation=60, ha='right')
+        ax.set_ylabel('Ratio of time {0} / {1}'.format(page['pldir2'].split('/')[-1], page['pldir1'].split('/')[-1]))
+        ax.set_ylim(0, 4)
+    return fig
@@ -0,0 +1,168 @@
+# code to analyze the per-stage timing information (from the timetracker file) of many pipeline runs. The stage times
+# are collected into a dense stage x run matrix, on which the per-stage ratios, quantiles and regressions between two
+# sets of runs (e.g., two pipeline versions run on the same projects) are calculated without loops over the runs.
+import numpy as np
+from math import comb
+from comparestats import get_nway_stagemap
+
+
+class TimingMatrix:
+    """
+    Times of each stage (rows) in each run (columns). Missing times, i.e., stages that are not in a run or that have
+    no timing information, are NaN. Two matrices with the same stages and runs (e.g., the PL1 and PL2 times of a list
+    of diff dictionaries) can be compared with get_ratio, get_quantiles, get_regression and get_slowdowns, where the
+    matrix itself is the reference (e.g., the old pipeline version).
+    """
+    def __init__(self, stages, runs, times):
+        self.stages = list(stages)
+        self.runs = list(runs)
+        self.times = np.asarray(times, dtype=float).reshape(len(self.stages), len(self.runs))
+
+    @classmethod
+    def from_plstats(cls, pllist, mode='total_time', runs=None):
+        """
+        Matrix of the stage times of a list of PLStats objects (e.g., several runs of the same MOUS). The stages of
+        the runs are aligned with comparestats.get_nway_stagemap and labeled by the number and name of the stage in
+        the first run that has the stage.
+        :param pllist: list of PLStats objects
+        :param mode: time to use, one of task_time, result_time or total_time
+        :param runs: labels of the runs, default is the mous uid of each object
+        :return: TimingMatrix
+        """
+        if runs is None:
+            runs = [x.mous['mous_uid']['value'] if 'mous_uid' in x.mous else str(idx) for idx, x in enumerate(pllist)]
+        stagemap = get_nway_stagemap(pllist)
+        stages, times = [], np.full((len(stagemap), len(pllist)), np.nan)
+        for row, numbers in enumerate(stagemap):
+            run = [x is not None for x in numbers].index(True)
+            stages.append(numbers[run] + ':' + pllist[run].mous['STAGE'][numbers[run]]['stage_name']['value'])
+            for run, number in enumerate(numbers):
+                if number is not None and mode in pllist[run].mous['STAGE'][number]:
+                    times[row, run] = __get_time__(pllist[run].mous['STAGE'][number][mode]['value'])
+        return cls(stages, runs, times)
+
+    @classmethod
+    def from_diffs(cls, diffs, mode='task_time', pl='PL1', runs=None):
+        """
+        Matrix of the stage times of one of the two pipeline runs in a list of diff dictionaries (see
+        comparestats.compare_benchmarks). The stages are labeled as number:name, and stages that are not in every
+        diff dictionary are NaN for the missing runs.
+        :param diffs: list of diff dictionaries
+        :param mode: time to use, one of task_time, result_time or total_time
+        :param pl: pipeline run to take the times from, PL1 or PL2
+        :param runs: labels of the runs, default is the mous uid of each diff dictionary
+        :return: TimingMatrix
+        """
+        if runs is None:
+            runs = [x['MOUS']['mous_uid'][pl]['value'] if 'mous_uid' in x['MOUS'] else str(idx)
+                    for idx, x in enumerate(diffs)]
+        stages = {}
+        for diff in diffs:
+            for key in diff['STAGE']:
+                if key.split(':')[-1] == mode:
+                    stages.setdefault(':'.join(key.split(':')[:-1]), len(stages))
+        times = np.full((len(stages), len(diffs)), np.nan)
+        for run, diff in enumerate(diffs):
+            for key in diff['STAGE']:
+                stage = ':'.join(key.split(':')[:-1])
+                if key.split(':')[-1] == mode and pl in diff['STAGE'][key]:
+                    times[stages[stage], run] = __get_time__(diff['STAGE'][key][pl]['value'])
+        return cls(list(stages.keys()), runs, times)
+
+    def get_stage(self, stage):
+        """
+        The times of a stage (row label or index) in all runs.
+        """
+        return self.times[self.stages.index(stage) if type(stage) == str else stage]
+
+    def get_valid(self, other):
+        """
+        Boolean matrix of the stages and runs that have a (positive) time in both matrices.
+        """
+        self.__check__(other)
+        return np.isfinite(self.times) & np.isfinite(other.times) & (self.times > 0) & (other.times > 0)
+
+    def get_ratio(self, other):
+        """
+        Ratio of the times (other / self) for each stage and run, NaN if either time is missing.
+        """
+        valid = self.get_valid(other)
+        ratio = np.full(self.times.shape, np.nan)
+        ratio[valid] = other.times[valid] / self.times[valid]
+        return ratio
+
+    def get_quantiles(self, other=None, q=(0.16, 0.5, 0.84)):
+        """
+        Quantiles over the runs of the time ratio (other / self) of each stage, or of the times if other is not set.
+        :return: array of shape (number of stages, number of quantiles), NaN for stages without any value
+        """
+        values = self.times if other is None else self.get_ratio(other)
+        quantiles = np.full((len(self.stages), len(q)), np.nan)
+        valid = np.any(np.isfinite(values), axis=1)
+        if np.any(valid):
+            quantiles[valid] = np.nanquantile(values[valid], q, axis=1).T
+        return quantiles
+
+    def get_regression(self, other):
+        """
+        Least squares fit of log10(other) = intercept + slope * log10(self) for each stage. A slope of 1 means that
+        the time of the stage changed by a constant factor (10**intercept), while a slope above 1 means that the
+        longer runs slowed down more than the short ones.
+        :return: dictionary with the slope, intercept and the number of runs (n) used for each stage; the slope and
+        intercept are NaN for stages with fewer than two runs or only a single time
+        """
+        valid = self.get_valid(other)
+        n = np.sum(valid, axis=1)
+        x = np.log10(np.where(valid, self.times, 1.))
+        y = np.log10(np.where(valid, other.times, 1.))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xmean, ymean = np.sum(x, axis=1) / n, np.sum(y, axis=1) / n
+            dx, dy = np.where(valid, x - xmean[:, None], 0.), np.where(valid, y - ymean[:, None], 0.)
+            sxx, sxy = np.sum(dx * dx, axis=1), np.sum(dx * dy, axis=1)
+            # the slope is undefined if all runs of a stage took (nearly) the same time
+            slope = np.where((n > 1) & (sxx > 1E-10), sxy / sxx, np.nan)
+            intercept = ymean - slope * xmean
+        return {'stages': self.stages, 'slope': slope, 'intercept': intercept, 'n': n}
+
+    def get_slowdowns(self, other, alpha=0.05, min_diff=0., min_ratio=1.):
+        """
+        Flags the stages that are significantly slower in other than in self, with an exact (one-sided) sign test on
+        the runs: under the null hypothesis a stage is equally likely to be faster or slower in each run, so the
+        p-value is the binomial probability to find at least the observed number of slower runs. Runs where the time
+        difference is not above min_diff (seconds) are counted as ties and are not used.
+        :param other: TimingMatrix to compare to (e.g., the new pipeline version)
+        :param alpha: significance level
+        :param min_diff: minimum absolute time difference for a run to count as slower or faster
+        :param min_ratio: only flag stages where the median time ratio (other / self) is above this value
+        :return: dictionary with for each stage, the number of runs used in the test (n), the number of slower runs,
+        the p-value, the median ratio and whether the stage is flagged as a slowdown
+        """
+        valid = self.get_valid(other)
+        delta = np.where(valid, other.times - self.times, 0.)
+        n_slower = np.sum(valid & (delta > min_diff), axis=1)
+        n = n_slower + np.sum(valid & (delta < -min_diff), axis=1)
+        p_value = np.array([__get_signtest__(x, y) for x, y in zip(n_slower, n)])
+        median_ratio = self.get_quantiles(other, q=(0.5,))[:, 0]
+        return {'stages': self.stages, 'n': n, 'n_slower': n_slower, 'p_value': p_value,
+                'median_ratio': median_ratio,
+                'slowdown': (p_value < alpha) & (np.nan_to_num(median_ratio, nan=0.) > min_ratio)}
+
+    def __check__(self, other):
+        if self.stages != other.stages or len(self.runs) != len(other.runs):
+            raise ValueError('TimingMatrix: the stages and runs of both matrices should be the same')
+
+
+def __get_time__(value):
+    # times of stages without timing information are 'None' in the PLStats objects and -1 in the diff dictionaries
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return np.nan
+    return value if value >= 0 else np.nan
+
+
+def __get_signtest__(n_slower, n):
+    # exact one-sided p-value of the sign test: P(X >= n_slower) for X ~ Binomial(n, 0.5)
+    if n == 0:
+        return 1.
+    return sum(comb(int(n), k) for k in range(int(n_slower), int(n) + 1)) / 2 ** int(n)